@@ -13,7 +13,7 @@ def process_packet_in(event):
     Args:
         event
     Return:
-        ethernet: frame
+        data: raw Ethernet frame
         in_port: incoming port
         switch: incoming switch
     """
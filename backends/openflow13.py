@@ -3,36 +3,65 @@
 """
 
 
+from functools import lru_cache
+
 from kytos.core import KytosEvent, log
-from napps.amlight.sdntrace import settings
-from pyof.foundation.network_types import Ethernet
+from napps.amlight.sdntrace import constants, settings
 from pyof.v0x04.common.action import ActionOutput
 from pyof.v0x04.controller2switch.packet_out import PacketOut
 from napps.kytos.of_core.msg_prios import of_msg_prio
 
 
+@lru_cache(maxsize=8)
+def color_prefix(color_value):
+    """ Convert the color value (a full or partial MAC address,
+    such as 'ee:ee:ee:ee:ee:') into the bytes expected at the
+    beginning of a probe source MAC.
+
+    Args:
+        color_value: settings.COLOR_VALUE
+    Return:
+        bytes: source MAC prefix of trace probes
+    """
+    octets = [octet for octet in color_value.split(":") if octet]
+    return bytes(int(octet, 16) for octet in octets)
+
+
+def is_probe(data):
+    """ Check the source MAC of a raw Ethernet frame against the
+    color prefix, without unpacking the frame.
+
+    Args:
+        data: raw Ethernet frame (PacketIn data)
+    Return:
+        True if the frame is a trace probe
+    """
+    return data.startswith(color_prefix(settings.COLOR_VALUE),
+                           constants.ETH_SRC_OFFSET)
+
+
 def packet_in(event, packet_in_msg):
-    """ Process OpenFlow 1.3 PacketIn messages
+    """ Process OpenFlow 1.3 PacketIn messages. The frame is not
+    unpacked here, trace probes are parsed once by the TraceManager.
 
     Args:
         event: PacketIN event
         packet_in_msg: PacketIn msg
     Return:
-        ethernet: PacketIn data
+        data: PacketIn data (raw Ethernet frame)
         in_port: in_port
         switch: OpenFlow datapath
         0, 0, 0 if it is not a trace probe
     """
 
-    ethernet = Ethernet()
-    ethernet.unpack(packet_in_msg.data.value)
+    data = packet_in_msg.data.value
 
-    if settings.COLOR_VALUE in ethernet.source.value:
+    if is_probe(data):
         log.debug("OpenFlow 1.3 PacketIn Trace Msg Received")
 
         in_port = event.message.in_port
         switch = event.source.switch
-        return ethernet, in_port, switch
+        return data, in_port, switch
 
     log.debug("PacketIn is not a Data Trace Probe")
     return 0, 0, 0
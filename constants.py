@@ -3,9 +3,17 @@
 """
 
 ETHERNET_LEN = 14
+ETH_SRC_OFFSET = 6
 VLAN_LEN = 4
+IPV4_MIN_LEN = 20
+IPV6_LEN = 40
+UDP_LEN = 8
 VLAN = 33024
+VLAN_QINQ = 34984
+VLAN_STACK_MAX_DEPTH = 4
 IPV4 = 2048
+IPV6 = 34525
 ARP = 2054
 TCP = 6
 UDP = 17
+IPV6_NO_NEXT_HEADER = 59
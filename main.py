@@ -25,6 +25,7 @@ import pathlib
 
 from napps.amlight.sdntrace import settings
 from napps.amlight.sdntrace.backends.of_parser import process_packet_in
+from napps.amlight.sdntrace.shared.colors import Colors
 from napps.amlight.sdntrace.shared.switches import Switches
 from napps.amlight.sdntrace.tracing.trace_manager import TraceManager
 
@@ -38,6 +39,7 @@ class Main(KytosNApp):
 
     REST methods:
         /sdntrace/trace ['PUT'] - request a trace
+        /sdntrace/traces ['PUT'] - request a list of traces at once
         /sdntrace/trace ['GET'] - list of previous trace requests and results
         /sdntrace/trace/<trace_id> - get the results of trace requested
         /sdntrace/stats - Show the number of requests received and active
@@ -54,6 +56,9 @@ class Main(KytosNApp):
             self.controller.switches
         )  # noqa: E501  pylint: disable=attribute-defined-outside-init
 
+        # HTTP clients to query the coloring napp
+        Colors().start_clients()
+
         # Instantiate TraceManager
         self.tracing = TraceManager(self.controller)  # pylint: disable=W0201
 
@@ -66,6 +71,7 @@ class Main(KytosNApp):
         If you have some cleanup procedure, insert it here.
         """
         self.tracing.stop_traces()
+        Colors().close_clients(self.controller.loop)
 
     @alisten_to("kytos/of_core.v0x04.messages.in.ofpt_packet_in")
     async def handle_packet_in(self, event):
@@ -76,16 +82,55 @@ class Main(KytosNApp):
         Args:
             event (KycoPacketIn): Received Event
         """
-        ethernet, in_port, switch = process_packet_in(event)
-        if not isinstance(ethernet, int):
-            await self.tracing.queue_probe_packet(event, ethernet, in_port, switch)
+        data, in_port, switch = process_packet_in(event)
+        is_probe = not isinstance(data, int)
+        self.tracing.count_packet_in(is_probe)
+        if is_probe:
+            await self.tracing.queue_probe_packet(event, data, in_port, switch)
+
+    @alisten_to(
+        "kytos/topology.topology_loaded",
+        "kytos/topology.updated",
+        "kytos/topology.switch.(enabled|disabled)",
+        "kytos/topology.link_(up|down)",
+    )
+    async def on_topology_changed(self, _event):
+        """Drop the cached colors, the coloring may have changed, and
+        the cached trace results.
+
+        Args:
+            _event (KytosEvent): topology event
+        """
+        Colors().invalidate()
+        self.tracing.invalidate_results()
+
+    @alisten_to(
+        "kytos/of_core.v0x04.messages.out.ofpt_flow_mod",
+        "kytos/flow_manager.flow.(added|removed)",
+    )
+    async def on_flows_changed(self, _event):
+        """Drop the cached trace results, the paths may have changed.
+
+        Args:
+            _event (KytosEvent): flow event
+        """
+        self.tracing.invalidate_results()
 
     @rest("/v1/trace", methods=["PUT"])
     async def run_trace(self, request: Request) -> JSONResponse:
         """Submit a trace request."""
         await avalidate_openapi_request(self.spec, request)
         body = await aget_json_or_400(request)
-        return JSONResponse(await self.tracing.rest_new_trace(body))
+        source = request.client.host if request.client else None
+        return JSONResponse(await self.tracing.rest_new_trace(body, source))
+
+    @rest("/v1/traces", methods=["PUT"])
+    async def run_traces(self, request: Request) -> JSONResponse:
+        """Submit a list of trace requests."""
+        await avalidate_openapi_request(self.spec, request)
+        body = await aget_json_or_400(request)
+        source = request.client.host if request.client else None
+        return JSONResponse(await self.tracing.rest_new_traces(body, source))
 
     @rest("/v1/trace", methods=["GET"])
     def get_results(self, _request: Request) -> JSONResponse:
@@ -16,8 +16,59 @@ PARALLEL_TRACES = 10
 # URL for coloring app
 COLORS_URL = "http://localhost:8181/api/amlight/coloring/colors"
 
+# Seconds a fetched color map is used before being refreshed in background
+COLORS_CACHE_TTL = 10
+
+# HTTP client settings used to query the coloring app
+COLORS_HTTP_TIMEOUT = 5
+COLORS_MAX_CONNECTIONS = 4
+COLORS_MAX_KEEPALIVE = 2
+
 # Timeout to wait for packet-in
 TIMEOUT = 0.5
 
 # Maximum number of finished trace results kept in memory
 RESULTS_QUEUE_MAX_SIZE = 1000
+
+# Probe PacketIns accepted per trace step: a token bucket refilled at
+# PROBE_STORM_RATE per second, holding up to PROBE_STORM_BURST tokens.
+# PacketIns above it (f.i. a probe caught in a forwarding loop) are dropped.
+PROBE_STORM_RATE = 10
+PROBE_STORM_BURST = 10
+# Seconds the buckets of a trace are kept after it ended, to drop the
+# PacketIns of its probes still looping in the network
+PROBE_STORM_GRACE = 10
+
+# Per switch protection: PacketOuts sent to a switch are paced at
+# SWITCH_PROBE_RATE per second (bursts of SWITCH_PROBE_BURST) and at most
+# SWITCH_MAX_IN_FLIGHT probes sent to it wait for their PacketIn at a time.
+# Only the first try of a probe holds an in-flight slot: the last hop of
+# every trace never answers, and its retries would hold the slot for
+# 3 x TIMEOUT.
+SWITCH_PROBE_RATE = 100
+SWITCH_PROBE_BURST = 20
+SWITCH_MAX_IN_FLIGHT = 8
+
+# Adaptive number of parallel traces, starting at PARALLEL_TRACES. The
+# window grows while probe round-trip times stay below PROBE_RTT_TARGET
+# seconds and the Kytos msg_out buffer below MSG_OUT_DEPTH_TARGET, and
+# is halved (at most once per PARALLEL_TRACES_COOLDOWN seconds) otherwise
+PARALLEL_TRACES_MIN = 1
+PARALLEL_TRACES_MAX = 50
+PARALLEL_TRACES_COOLDOWN = 1
+PROBE_RTT_TARGET = 0.2
+MSG_OUT_DEPTH_TARGET = 100
+
+# Priority classes of the trace requests and their weights. Pending
+# traces are dispatched in weighted fair order across priorities and
+# across the clients requesting them
+TRACE_PRIORITY_WEIGHTS = {"interactive": 8, "scheduled": 4, "bulk": 1}
+TRACE_DEFAULT_PRIORITY = "interactive"
+
+# Maximum number of trace requests in a single PUT /v1/traces
+BULK_TRACES_MAX_SIZE = 1000
+
+# Seconds a trace result is reused for identical requests, as long as no
+# topology or flow change happened. 0 disables the result cache
+RESULT_CACHE_TTL = 0
+RESULT_CACHE_MAX_SIZE = 1000
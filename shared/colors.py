@@ -3,31 +3,137 @@
 """
 
 
+import asyncio
+import time
+
 import httpx
 from kytos.core import log
 from napps.amlight.sdntrace import settings
+from napps.amlight.sdntrace.shared.singleton import Singleton
 
 
-class Colors(object):
+class Colors(metaclass=Singleton):
     """ Class to handle the gathering of colors from
     amlight/coloring Napp
 
+    The color map is cached in memory and shared by all users of
+    Colors(). A cached map older than settings.COLORS_CACHE_TTL is
+    still served while it is refreshed in background. The cache is
+    dropped by invalidate(), called on topology changes, and the next
+    lookup fetches a new map.
     """
 
     def __init__(self):
         """ Instantiate Colors and get list of colors
         """
         self._url = settings.COLORS_URL
+        self._ttl = max(float(settings.COLORS_CACHE_TTL), 0)
         self._colors = dict()
+        # time.monotonic() of the last successful fetch, None if invalid
+        self._fetched_at = None
+        self._refresh_task = None
+        # Keep-alive HTTP clients, created by start_clients()
+        self._client = None
+        self._aclient = None
+        # ETag of the cached map, sent as If-None-Match
+        self._etag = None
+        # Counters
+        self._total_refreshes = 0
+        self._total_not_modified = 0
+
+    def start_clients(self):
+        """ Create the pooled keep-alive HTTP clients used to query
+        the Coloring Napp. Called by Main.setup.
+        """
+        limits = httpx.Limits(
+            max_connections=settings.COLORS_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.COLORS_MAX_KEEPALIVE,
+        )
+        timeout = httpx.Timeout(settings.COLORS_HTTP_TIMEOUT)
+        if self._client is None:
+            self._client = httpx.Client(limits=limits, timeout=timeout)
+        if self._aclient is None:
+            self._aclient = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    def close_clients(self, loop=None):
+        """ Close the HTTP clients. Called by Main.shutdown.
+
+        Args:
+            loop: event loop where the async client is closed. If None,
+                the async client is only dropped.
+        """
+        client, self._client = self._client, None
+        aclient, self._aclient = self._aclient, None
+        if client is not None:
+            client.close()
+        if aclient is not None and loop is not None:
+            asyncio.run_coroutine_threadsafe(aclient.aclose(), loop)
+
+    def invalidate(self):
+        """ Drop the cached color map. The next lookup fetches it
+        again from the Coloring Napp.
+        """
+        self._fetched_at = None
+
+    def _is_fresh(self):
+        """ Return True if the cached map is younger than the TTL """
+        return (self._fetched_at is not None and
+                time.monotonic() - self._fetched_at < self._ttl)
+
+    def _must_fetch(self, dpid):
+        """ Return True if a lookup for dpid has to wait for a fetch """
+        return self._fetched_at is None or dpid not in self._colors
+
+    def get_stats(self):
+        """ Number of color map refreshes and of refreshes avoided
+        because the map was not modified.
+        """
+        return {
+            "refreshes": self._total_refreshes,
+            "not_modified": self._total_not_modified,
+        }
+
+    def _request_headers(self):
+        """ Headers of a conditional request for the color map """
+        if self._etag is None or not self._colors:
+            return {}
+        return {"If-None-Match": self._etag}
+
+    def _handle_response(self, result):
+        """ Store the color map of a Coloring Napp response.
+
+        Args:
+            result: httpx.Response with status 200 or 304
+
+        Raises:
+            ValueError, KeyError or TypeError: if the body is not a
+                color map. The cached map is kept.
+        """
+        if result.status_code == 304:
+            self._total_refreshes += 1
+            self._total_not_modified += 1
+            self._fetched_at = time.monotonic()
+            return
+        colors = result.json()['colors']
+        self._total_refreshes += 1
+        self._etag = result.headers.get("ETag")
+        self._update_colors(colors)
+
+    def _update_colors(self, colors):
+        """ Store a color map fetched from the Coloring Napp """
+        self._colors = colors
+        self._fetched_at = time.monotonic()
 
     def _get_colors(self):
         """ Get list of colors
         """
+        if self._client is None:
+            self.start_clients()
         try:
-            result = httpx.get(self._url)
-            if result.status_code == 200:
-                result = result.json()
-                self._colors = result['colors']
+            result = self._client.get(self._url,
+                                      headers=self._request_headers())
+            if result.status_code in (200, 304):
+                self._handle_response(result)
             else:
                 raise Exception
         except Exception as err:  # pylint: disable=broad-except
@@ -35,8 +141,8 @@ class Colors(object):
 
     def get_switch_color(self, dpid):
         """ Get the color_field and color_value of a specific
-        switch. At every call, queries Coloring Napp to make sure
-        colors reflects a possible topology.
+        switch. Queries Coloring Napp only if the cached colors
+        are invalid, expired or do not have the switch.
 
         Args:
             dpid: switch.dpid
@@ -46,7 +152,8 @@ class Colors(object):
               or
             dict: {} if not found
         """
-        self._get_colors()
+        if self._must_fetch(dpid) or not self._is_fresh():
+            self._get_colors()
         try:
             return self._colors[dpid]
         except KeyError:
@@ -54,18 +161,57 @@ class Colors(object):
 
     async def _aget_colors(self):
         """Get list of colors asynchronously."""
-        async with httpx.AsyncClient() as client:
-            result = await client.get(self._url)
-            if result.is_server_error or result.status_code >= 400:
-                log.error(f'Error ocurred when getting colors: {result.text}')
-                return
-            result = result.json()
-            self._colors = result['colors']
+        if self._aclient is None:
+            self.start_clients()
+        try:
+            result = await self._aclient.get(self._url,
+                                             headers=self._request_headers())
+        except httpx.HTTPError as err:
+            log.error(f'Error: Can not connect to Kytos/Coloring: {err}')
+            return
+        if result.is_server_error or result.status_code >= 400:
+            log.error(f'Error ocurred when getting colors: {result.text}')
+            return
+        try:
+            self._handle_response(result)
+        except (ValueError, KeyError, TypeError) as err:
+            log.error(f'Error: Invalid colors from Kytos/Coloring: {err}')
+
+    def _arefresh(self):
+        """ Start a refresh of the color map unless one is already
+        running. Concurrent callers share the same request.
+
+        Return:
+            asyncio.Task fetching the colors
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._aget_colors())
+        return self._refresh_task
+
+    async def aget_colors(self, dpids=()):
+        """ Get the color map, with the colors of all the dpids if the
+        Coloring Napp has them. The Coloring Napp is queried at most
+        once, so every dpid is looked up in the same map.
+
+        Args:
+            dpids: iterable of switch.dpid
+
+        Return:
+            dict: {dpid: {'color_field': str, 'color_value': str}}
+        """
+        if self._fetched_at is None or any(
+            dpid not in self._colors for dpid in dpids
+        ):
+            await asyncio.shield(self._arefresh())
+        elif not self._is_fresh():
+            self._arefresh()
+        return self._colors
 
     async def aget_switch_color(self, dpid):
         """ Get the color_field and color_value of a specific
-        switch. At every call, queries Coloring Napp to make sure
-        colors reflects a possible topology.
+        switch. Only waits for the Coloring Napp if the cached colors
+        are invalid or do not have the switch. Expired colors are
+        returned right away and refreshed in background.
 
         Args:
             dpid: switch.dpid
@@ -75,8 +221,5 @@ class Colors(object):
               or
             dict: {} if not found
         """
-        await self._aget_colors()
-        try:
-            return self._colors[dpid]
-        except KeyError:
-            return {}
\ No newline at end of file
+        colors = await self.aget_colors((dpid,))
+        return colors.get(dpid, {})
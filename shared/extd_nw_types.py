@@ -6,10 +6,135 @@ Defines and Implements Basic Network packet types, such as TCP and UDP.
 from pyof.foundation.network_types import IPv4, IPv6
 from pyof.foundation.base import GenericStruct
 from pyof.foundation.basic_types import BinaryData, UBInt16, UBInt32
+from ipaddress import IPv4Address, IPv6Address
 from typing import Union
 from random import randrange
 
-__all__ = ('TCP', 'UDP')
+__all__ = ('TCP', 'UDP', 'checksum_adjust', 'internet_checksum',
+           'ones_complement_sum', 'update_checksum_field')
+
+
+def sum_16_bits(data) -> int:
+    """Sum data as big-endian 16-bit words, without folding the carries.
+
+    Runs in linear time over a memoryview, without copying data. An odd
+    trailing byte is padded with zero, as in RFC 1071.
+
+    Args:
+        data: bytes, bytearray or memoryview
+
+    Returns:
+        int: sum of the 16-bit words
+    """
+    view = memoryview(data).cast("B")
+    return (sum(view[0::2]) << 8) + sum(view[1::2])
+
+
+def _fold(block_sum: int) -> int:
+    """Fold the carries of a sum into 16 bits (end-around carry)."""
+    while block_sum > 0xFFFF:
+        block_sum = (block_sum & 0xFFFF) + (block_sum >> 16)
+    return block_sum
+
+
+def ones_complement_sum(data, initial: int = 0) -> int:
+    """16-bit one's complement sum of data (RFC 1071).
+
+    Args:
+        data: bytes, bytearray or memoryview
+        initial(int): sum of data checksummed before, e.g. a pseudo header
+
+    Returns:
+        int: folded sum
+    """
+    return _fold(initial + sum_16_bits(data))
+
+
+def internet_checksum(data, initial: int = 0) -> int:
+    """Internet checksum of data (RFC 1071).
+
+    Args:
+        data: bytes, bytearray or memoryview
+        initial(int): sum of data checksummed before, e.g. a pseudo header
+
+    Returns:
+        int: checksum
+    """
+    return ~ones_complement_sum(data, initial) & 0xFFFF
+
+
+def checksum_adjust(checksum: int, old, new) -> int:
+    """Update an Internet checksum after replacing old by new (RFC 1624,
+    eqn. 3), without summing the rest of the packet again.
+
+    Args:
+        checksum(int): checksum before the change
+        old: previous bytes, starting at an even offset of the
+            checksummed data
+        new: new bytes with the same length as old
+
+    Returns:
+        int: updated checksum
+    """
+    if len(old) != len(new) or len(old) % 2:
+        raise ValueError("old and new must have the same even length")
+    # Sum of the complements of the old words, ~m = 0xFFFF - m
+    old_complement = (len(old) // 2) * 0xFFFF - sum_16_bits(old)
+    block_sum = (~checksum & 0xFFFF) + old_complement + sum_16_bits(new)
+    return ~_fold(block_sum) & 0xFFFF
+
+
+def update_checksum_field(buff: bytearray, checksum_offset: int,
+                          offset: int, value, start: int = 0) -> None:
+    """Write value into an already packed buff and update, in place, the
+    Internet checksum covering it (RFC 1624).
+
+    Args:
+        buff(bytearray): packed packet
+        checksum_offset(int): offset of the 16-bit checksum in buff
+        offset(int): offset of the field in buff
+        value: new bytes of the field
+        start(int): offset where the checksummed data begins in buff, used
+            to align the field to 16-bit words
+    """
+    end = offset + len(value)
+    if end > len(buff):
+        raise ValueError("value does not fit in buff")
+    word_start = offset - (offset - start) % 2
+    word_end = end + (end - start) % 2
+    old = bytes(buff[word_start:word_end])
+    new = old[:offset - word_start] + bytes(value) + old[end - word_start:]
+    if len(old) % 2:
+        # Field ends at the last, odd, byte of buff
+        old += b"\x00"
+        new += b"\x00"
+    checksum = int.from_bytes(buff[checksum_offset:checksum_offset + 2], "big")
+    checksum = checksum_adjust(checksum, old, new)
+    buff[offset:end] = value
+    buff[checksum_offset:checksum_offset + 2] = checksum.to_bytes(2, "big")
+
+
+def _pseudo_header_sum(ip_header: Union[IPv4, IPv6], length: int) -> int:
+    """Sum of the IP pseudo header used by the TCP and UDP checksums.
+
+    Args:
+        ip_header: IP packet carrying the segment
+        length(int): length of the TCP/UDP segment
+
+    Returns:
+        int: sum of the pseudo header words, 0 if not IPv4 or IPv6
+    """
+    if isinstance(ip_header, IPv4):
+        addresses = (IPv4Address(ip_header.source).packed +
+                     IPv4Address(ip_header.destination).packed)
+        return sum_16_bits(addresses) + ip_header.protocol + length
+    if isinstance(ip_header, IPv6):
+        # RFC 8200 section 8.1, without extension headers
+        addresses = (IPv6Address(str(ip_header.source)).packed +
+                     IPv6Address(str(ip_header.destination)).packed)
+        return (sum_16_bits(addresses) + ip_header.next_header +
+                (length >> 16) + (length & 0xFFFF))
+    return 0
 
 
 class TCP(GenericStruct):
@@ -91,11 +216,7 @@ class TCP(GenericStruct):
 
     def _value_by_16_bits(self, value: bytes) -> int:
         """Calculate the integer value of the argument partitioned by 2 bytes."""
-        total = 0
-        while value:
-            total = total + int.from_bytes(value[-2:])
-            value = value[:-2]
-        return total
+        return sum_16_bits(value)
 
     def _update_checksum(self, ip_header:Union[IPv4, IPv6]=None):
         """Update the packet checksum to enable integrity check.
@@ -103,38 +224,15 @@ class TCP(GenericStruct):
         self.length = 5 + (len(self.options) // 4)
         self._length_flags = self.length << 12 | self.flags
 
-        sequence_hex = f'{self.seq:08x}'
-        acknowledgment_hex = f'{self.ack:08x}'
-        sequence_upper = int(sequence_hex[:4] or '0', 16)
-        sequence_lower = int(sequence_hex[-4:] or '0', 16)
-        acknowledgment_upper = int(acknowledgment_hex[:4] or '0', 16)
-        acknowledgment_lower = int(acknowledgment_hex[-4:] or '0', 16)
-
-        if isinstance(ip_header, IPv4):
-            source_list = [int(octet) for octet in ip_header.source.split(".")]
-            destination_list = [int(octet) for octet in
-                                ip_header.destination.split(".")]
-            source_upper = (source_list[0] << 8) + source_list[1]
-            source_lower = (source_list[2] << 8) + source_list[3]
-            destination_upper = (destination_list[0] << 8) + destination_list[1]
-            destination_lower = (destination_list[2] << 8) + destination_list[3]
-            ip_value = (source_upper + source_lower + destination_upper +
-                        destination_lower + ip_header.protocol + (self.length * 4) + len(self.data))
-        else:
-            # TODO: Implement IPv6 header analysis
-            ip_value = 0
+        ip_value = _pseudo_header_sum(ip_header, self.length * 4 + len(self.data))
 
-        block_sum = (self.src_port + self.dst_port + sequence_upper +
-                         sequence_lower + acknowledgment_upper + acknowledgment_lower +
-                         self._length_flags + self.window + 0 + self.urgent_pointer +
-                         self._value_by_16_bits(self.options) +
-                         self._value_by_16_bits(self.data) + ip_value)
-        
-        while block_sum > 65535:
-            carry = block_sum >> 16
-            block_sum = (block_sum & 65535) + carry
+        block_sum = (self.src_port + self.dst_port + (self.seq >> 16) +
+                     (self.seq & 0xFFFF) + (self.ack >> 16) + (self.ack & 0xFFFF) +
+                     self._length_flags + self.window + 0 + self.urgent_pointer +
+                     self._value_by_16_bits(self.options) +
+                     self._value_by_16_bits(self.data) + ip_value)
 
-        self.checksum = ~block_sum & 65535
+        self.checksum = ~_fold(block_sum) & 0xFFFF
 
     def pack(self, ip_header:Union[IPv4, IPv6]=None, value=None):
         """Pack the struct in a binary representation.
@@ -221,38 +319,19 @@ class UDP(GenericStruct):
 
     def _value_by_16_bits(self, value: bytes) -> int:
         """Calculate the integer value of the argument partitioned by 2 bytes."""
-        total = 0
-        while value:
-            total = total + int.from_bytes(value[-2:])
-            value = value[:-2]
-        return total
+        return sum_16_bits(value)
 
     def _update_checksum(self, ip_header:Union[IPv4, IPv6]=None):
         """Update the packet checksum to enable integrity check.
          Each addend is 16 bits."""
         self.length = 8 + len(self.data)
 
-        if isinstance(ip_header, IPv4):
-            source_list = [int(octet) for octet in ip_header.source.split(".")]
-            destination_list = [int(octet) for octet in
-                                ip_header.destination.split(".")]
-            source_upper = (source_list[0] << 8) + source_list[1]
-            source_lower = (source_list[2] << 8) + source_list[3]
-            destination_upper = (destination_list[0] << 8) + destination_list[1]
-            destination_lower = (destination_list[2] << 8) + destination_list[3]
-            ip_value = (source_upper + source_lower + destination_upper +
-                        destination_lower + ip_header.protocol + self.length)
-        else:
-            # TODO: Implement IPv6 header analysis
-            ip_value = 0
+        ip_value = _pseudo_header_sum(ip_header, self.length)
 
         block_sum = ip_value + self.src_port + self.dst_port + self.length + self._value_by_16_bits(self.data)
 
-        while block_sum > 65535:
-            carry = block_sum >> 16
-            block_sum = (block_sum & 65535) + carry
-
-        self.checksum = ~block_sum & 65535
+        # A computed 0 is sent as all ones, 0 means no checksum (RFC 768)
+        self.checksum = (~_fold(block_sum) & 0xFFFF) or 0xFFFF
 
     def pack(self, ip_header:Union[IPv4, IPv6]=None, value=None):
         """Pack the struct in a binary representation.
@@ -0,0 +1,208 @@
+"""
+    Token buckets used to rate limit PacketIns and PacketOuts.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class TokenBucket:
+    """ Classic token bucket: up to 'burst' tokens, refilled at 'rate'
+    tokens per second. Every consume() takes one token, or fails if
+    the bucket is empty.
+
+    It also counts what went through it, so the observed rate can be
+    reported once a flood is detected.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        """
+        Args:
+            rate: tokens added per second
+            burst: maximum number of tokens
+            now: time.monotonic() of the creation, for testing
+        """
+        self.rate = max(float(rate), 0)
+        self.burst = max(int(burst), 1)
+        now = time.monotonic() if now is None else now
+        self._tokens = float(self.burst)
+        self._updated_at = now
+        self.started_at = now
+        self.last_at = now
+        # Counters
+        self.total = 0
+        self.dropped = 0
+
+    def _refill(self, now):
+        """ Add the tokens earned since the last update """
+        elapsed = max(now - self._updated_at, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated_at = now
+
+    def consume(self, now=None):
+        """ Take one token from the bucket.
+
+        Args:
+            now: current time.monotonic(), for testing
+
+        Return:
+            True if a token was available
+            False if the bucket is empty
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.last_at = now
+        self.total += 1
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+    def wait_time(self, now=None):
+        """ Seconds until a token is available, 0 if there is one.
+        Counters are not changed.
+
+        Args:
+            now: current time.monotonic(), for testing
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self._tokens >= 1 or self.rate <= 0:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        """ Wait for a token and take it """
+        while (delay := self.wait_time()) > 0:
+            await asyncio.sleep(delay)
+        self.consume()
+
+    def get_rate(self):
+        """ Observed rate, consume() calls per second since creation """
+        elapsed = self.last_at - self.started_at
+        if elapsed <= 0:
+            return float(self.total)
+        return self.total / elapsed
+
+
+class ProbePacer:
+    """ Protect each switch from the trace probes: PacketOuts sent to a
+    switch are paced by a token bucket and only a few probes can wait
+    for their PacketIn at the same time. State is kept per dpid.
+    """
+
+    def __init__(self, rate, burst, max_in_flight):
+        """
+        Args:
+            rate: PacketOuts per second per switch, 0 disables pacing
+            burst: PacketOuts sent back to back per switch
+            max_in_flight: probes waiting for a PacketIn per switch
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self._buckets = dict()
+        self._in_flight = dict()
+
+    async def pace(self, dpid):
+        """ Wait until a PacketOut can be sent to the switch.
+
+        Args:
+            dpid: switch.dpid
+        """
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.get(dpid)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[dpid] = bucket
+        await bucket.acquire()
+
+    @asynccontextmanager
+    async def in_flight(self, dpid):
+        """ Hold one of the in-flight probe slots of the switch.
+
+        Args:
+            dpid: switch.dpid
+        """
+        semaphore = self._in_flight.get(dpid)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._in_flight[dpid] = semaphore
+        async with semaphore:
+            yield
+
+
+class AIMDWindow:
+    """ Concurrency window with an Additive Increase, Multiplicative
+    Decrease policy: it grows by 'increase' per window of good samples
+    and is multiplied by 'decrease' on congestion, at most once per
+    'cooldown' seconds, always within [minimum, maximum].
+    """
+
+    def __init__(self, initial, minimum, maximum, increase=1.0,
+                 decrease=0.5, cooldown=1.0):
+        """
+        Args:
+            initial: initial window
+            minimum: smallest window
+            maximum: largest window
+            increase: window growth per window of good samples
+            decrease: factor applied to the window on congestion
+            cooldown: seconds between two decreases
+        """
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.increase = float(increase)
+        self.decrease = min(max(float(decrease), 0), 1)
+        self.cooldown = float(cooldown)
+        self._window = float(min(max(initial, self.minimum), self.maximum))
+        self._decreased_at = None
+        self.reason = "initial"
+
+    @property
+    def limit(self):
+        """ Current window as an integer """
+        return int(self._window)
+
+    def on_success(self, reason):
+        """ Grow the window after a good sample.
+
+        Args:
+            reason: why the window grows
+
+        Return:
+            True if the limit changed
+        """
+        old_limit = self.limit
+        self._window = min(self._window + self.increase / self._window,
+                           self.maximum)
+        return self._changed(old_limit, reason)
+
+    def on_congestion(self, reason, now=None):
+        """ Shrink the window after a congestion sample.
+
+        Args:
+            reason: why the window shrinks
+            now: current time.monotonic(), for testing
+
+        Return:
+            True if the limit changed
+        """
+        now = time.monotonic() if now is None else now
+        if (self._decreased_at is not None and
+                now - self._decreased_at < self.cooldown):
+            return False
+        self._decreased_at = now
+        old_limit = self.limit
+        self._window = max(self._window * self.decrease, self.minimum)
+        return self._changed(old_limit, reason)
+
+    def _changed(self, old_limit, reason):
+        """ Keep the reason of a change of the limit """
+        if self.limit == old_limit:
+            return False
+        self.reason = reason
+        return True
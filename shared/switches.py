@@ -10,9 +10,37 @@ list_of_switches = Switches().get_switches()
 switch_01 = Switches().get_switch("00:00:00:00:00:00:00:01")
 """
 
+from functools import lru_cache
+
 from napps.amlight.sdntrace.shared.singleton import Singleton
 
 
+@lru_cache(maxsize=4096)
+def _normalize_dpid(dpid):
+    """Convert any DPID format accepted by TraceEntries ('1', 'a',
+    '0000000000000001', 'ab:cd:ef:ab:cd:ef:ab:cd') to the format used
+    by Kytos to index switches: 'ab:cd:ef:ab:cd:ef:ab:cd'.
+
+    Args:
+        dpid: datapath id 'str'
+
+    Returns:
+        normalized dpid or dpid itself if it can not be normalized
+    """
+    hex_dpid = dpid.replace(":", "").replace("-", "").lower()
+    if len(hex_dpid) > 16:
+        return dpid
+    hex_dpid = hex_dpid.zfill(16)
+    return ":".join(hex_dpid[i:i + 2] for i in range(0, 16, 2))
+
+
+def normalize_dpid(dpid):
+    """Normalize a DPID to the Kytos format. See _normalize_dpid."""
+    if not isinstance(dpid, str):
+        return dpid
+    return _normalize_dpid(dpid)
+
+
 class Switches(metaclass=Singleton):
     """This class is used to easy app development, decoupling
     modules from Kytos core. With a Singleton class for Switches,
@@ -28,7 +56,9 @@ class Switches(metaclass=Singleton):
         return len(self._switches)
 
     def get_switch(self, dpid):
-        """Query the self.switches
+        """Query the self.switches. Kytos indexes switches by the
+        normalized dpid, so any dpid format is a direct dict lookup.
+
         Args:
             dpid: datapath id 'str'
 
@@ -36,7 +66,10 @@ class Switches(metaclass=Singleton):
             a kytos.core.switch.Switch() object
             False if not found
         """
-        return self._switches.get(dpid, False)
+        switch = self._switches.get(dpid)
+        if switch is None:
+            switch = self._switches.get(normalize_dpid(dpid), False)
+        return switch
 
     def get_switches(self):
         """Return all switches """
@@ -27,9 +27,9 @@ class TestOFParser:
         event.content["message"].header.version.value = 4
         event.message.in_port = 1
 
-        ethernet, in_port, switch = process_packet_in(event)
+        data, in_port, switch = process_packet_in(event)
 
-        assert ethernet.source.value == "ee:ee:ee:ee:ee:01"
+        assert data == raw
         assert in_port == 1
         assert switch == "ee:ee:ee:ee:ee:01"
 
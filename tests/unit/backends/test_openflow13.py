@@ -4,6 +4,8 @@ from unittest.mock import MagicMock, patch, AsyncMock
 
 from napps.amlight.sdntrace import settings
 from napps.amlight.sdntrace.backends.openflow13 import (
+    color_prefix,
+    is_probe,
     packet_in,
     send_packet_out,
 )
@@ -27,9 +29,9 @@ class TestOpenflow13:
         event.source.switch = "ee:ee:ee:ee:ee:01"
         event.message.in_port = 1
 
-        ethernet, in_port, switch = packet_in(event, packet_in_msg)
+        data, in_port, switch = packet_in(event, packet_in_msg)
 
-        assert ethernet.source.value == "ee:ee:ee:ee:ee:01"
+        assert data == raw
         assert in_port == 1
         assert switch == "ee:ee:ee:ee:ee:01"
 
@@ -52,6 +54,36 @@ class TestOpenflow13:
         assert in_port == 0
         assert switch == 0
 
+    def test_lldp_packet_in(self):
+        """Test LLDP packet in without color is ignored."""
+        raw = b"\x01\x80\xc2\x00\x00\x0e\xca\xfe\xca\xfe\xca\xfe\x88\xcc"
+        packet_in_msg = MagicMock()
+        packet_in_msg.data.value = raw
+
+        assert packet_in(MagicMock(), packet_in_msg) == (0, 0, 0)
+
+    def test_color_prefix(self):
+        """Test color values converted to source MAC prefixes."""
+        assert color_prefix("ee:ee:ee:ee:ee:") == b"\xee" * 5
+        assert color_prefix("ee:ee:ee:ee:01:2c") == b"\xee" * 4 + b"\x01\x2c"
+
+    def test_is_probe(self):
+        """Test the probe classifier on raw frames."""
+        dst = b"\x00\x15\xaf\xd58\x98"
+        assert is_probe(dst + b"\xee\xee\xee\xee\xee\x01\x08\x00")
+        assert not is_probe(dst + b"\xee\xee\xee\xee\xef\x01\x08\x00")
+        assert not is_probe(b"\xee\xee\xee\xee\xee\x01" + dst)
+        assert not is_probe(dst + b"\xee\xee")
+        assert not is_probe(b"")
+
+    @patch("napps.amlight.sdntrace.backends.openflow13.settings")
+    def test_is_probe_color_value(self, mock_settings):
+        """Test the probe classifier follows settings.COLOR_VALUE."""
+        mock_settings.COLOR_VALUE = "aa:bb:"
+        dst = b"\x00\x15\xaf\xd58\x98"
+        assert is_probe(dst + b"\xaa\xbb\x00\x00\x00\x01\x08\x00")
+        assert not is_probe(dst + b"\xee\xee\xee\xee\xee\x01\x08\x00")
+
     def test_packet_out_with_color(self):
         """Test packet in with color ee:ee:ee:ee:ee:01."""
         data = b"\x00\x15\xaf\xd58\x98\xee\xee\xee\xee\xee\x01\x08\x00testdata"
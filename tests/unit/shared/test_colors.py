@@ -1,14 +1,38 @@
 """Test the /shared/colors.py."""
 
+import asyncio
 from unittest.mock import patch, MagicMock
+from napps.amlight.sdntrace import settings
 from napps.amlight.sdntrace.shared.colors import Colors
 
+COLORS = {
+    "colors": {
+        "aa:00:00:00:00:00:00:11": {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:01:2c",
+        },
+        "aa:00:00:00:00:00:00:12": {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:01:2d",
+        },
+    }
+}
+
 
 # pylint: disable=protected-access
 class TestColors:
     """Test the Colors class."""
 
-    @patch("httpx.get")
+    def setup_method(self):
+        """Start every test with an empty color cache."""
+        color_manager = Colors()
+        color_manager.invalidate()
+        color_manager._colors = {}
+        color_manager._refresh_task = None
+        color_manager.close_clients()
+        color_manager._etag = None
+
+    @patch("httpx.Client.get")
     def test_get_switch_colors_without_switches(self, mock_request_get):
         """Test rest call to /colors without switches."""
         result = MagicMock()
@@ -25,7 +49,7 @@ class TestColors:
         mock_request_get.assert_called_once()
         assert colors == {}
 
-    @patch("httpx.get")
+    @patch("httpx.Client.get")
     def test_get_switch_colors(self, mock_request_get):
         """Test rest call to /colors to retrieve all switches color."""
         result = MagicMock()
@@ -56,7 +80,7 @@ class TestColors:
 
         color = color_manager.get_switch_color("aa:00:00:00:00:00:00:12")
 
-        assert mock_request_get.call_count == 2
+        assert mock_request_get.call_count == 1
         assert color["color_field"] == "dl_src"
         assert color["color_value"] == "ee:ee:ee:ee:01:2d"
 
@@ -92,6 +116,193 @@ class TestColors:
 
         color = await color_manager.aget_switch_color("aa:00:00:00:00:00:00:12")
 
-        assert mock_request_get.call_count == 2
+        assert mock_request_get.call_count == 1
         assert color["color_field"] == "dl_src"
         assert color["color_value"] == "ee:ee:ee:ee:01:2d"
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_not_modified(self, mock_request_get):
+        """Test a 304 response reuses the cached color map."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.headers = {"ETag": '"v1"'}
+        result.json.return_value = COLORS
+        not_modified = MagicMock(status_code=304, is_server_error=False)
+        mock_request_get.side_effect = [result, not_modified]
+
+        color_manager = Colors()
+        stats = color_manager.get_stats()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        color_manager.invalidate()
+        color = await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+
+        assert color["color_value"] == "ee:ee:ee:ee:01:2c"
+        assert mock_request_get.call_args_list[0].kwargs["headers"] == {}
+        assert mock_request_get.call_args_list[1].kwargs["headers"] == {
+            "If-None-Match": '"v1"'
+        }
+        assert not_modified.json.call_count == 0
+        assert color_manager._is_fresh()
+        new_stats = color_manager.get_stats()
+        assert new_stats["refreshes"] == stats["refreshes"] + 2
+        assert new_stats["not_modified"] == stats["not_modified"] + 1
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_colors(self, mock_request_get):
+        """Test the colors of many switches come from a single fetch."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.headers = {}
+        result.json.return_value = COLORS
+        mock_request_get.return_value = result
+
+        color_manager = Colors()
+        colors = await color_manager.aget_colors(
+            {"aa:00:00:00:00:00:00:11", "aa:00:00:00:00:00:00:12"}
+        )
+        assert colors == COLORS["colors"]
+        assert mock_request_get.call_count == 1
+
+        # Cached switches do not fetch again
+        colors = await color_manager.aget_colors({"aa:00:00:00:00:00:00:11"})
+        assert colors == COLORS["colors"]
+        assert mock_request_get.call_count == 1
+
+    @patch("httpx.Client.get")
+    def test_get_switch_colors_not_modified(self, mock_request_get):
+        """Test a 304 response reuses the cached color map (sync)."""
+        result = MagicMock(status_code=200)
+        result.headers = {"ETag": '"v1"'}
+        result.json.return_value = COLORS
+        not_modified = MagicMock(status_code=304)
+        mock_request_get.side_effect = [result, not_modified]
+
+        color_manager = Colors()
+        color_manager.get_switch_color("aa:00:00:00:00:00:00:11")
+        color_manager.invalidate()
+        color = color_manager.get_switch_color("aa:00:00:00:00:00:00:12")
+
+        assert color["color_value"] == "ee:ee:ee:ee:01:2d"
+        assert mock_request_get.call_args_list[1].kwargs["headers"] == {
+            "If-None-Match": '"v1"'
+        }
+
+    def test_start_close_clients(self):
+        """Test the HTTP clients are kept between requests and closed."""
+        color_manager = Colors()
+        color_manager.close_clients()
+        color_manager.start_clients()
+        client, aclient = color_manager._client, color_manager._aclient
+        color_manager.start_clients()
+
+        assert color_manager._client is client
+        assert color_manager._aclient is aclient
+        assert aclient.timeout.read == settings.COLORS_HTTP_TIMEOUT
+
+        color_manager.close_clients()
+        assert client.is_closed
+        assert color_manager._client is None
+        assert color_manager._aclient is None
+
+    async def test_close_clients_async(self):
+        """Test the async client is closed on the given loop."""
+        color_manager = Colors()
+        color_manager.close_clients()
+        color_manager.start_clients()
+        aclient = color_manager._aclient
+
+        color_manager.close_clients(asyncio.get_running_loop())
+        await asyncio.sleep(0.1)
+        assert aclient.is_closed
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_invalidate(self, mock_request_get):
+        """Test the colors are fetched again after invalidate."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.json.return_value = COLORS
+        mock_request_get.return_value = result
+
+        color_manager = Colors()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        color_manager.invalidate()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+
+        assert mock_request_get.call_count == 2
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_expired(self, mock_request_get):
+        """Test expired colors are served while refreshed in background."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.json.return_value = COLORS
+        mock_request_get.return_value = result
+
+        color_manager = Colors()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        color_manager._fetched_at -= color_manager._ttl + 1
+
+        color = await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        assert color["color_value"] == "ee:ee:ee:ee:01:2c"
+        assert mock_request_get.call_count == 1
+
+        await color_manager._refresh_task
+        assert mock_request_get.call_count == 2
+        assert color_manager._is_fresh()
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_single_flight(self, mock_request_get):
+        """Test concurrent lookups share one request."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.json.return_value = COLORS
+
+        async def slow_get(*_args, **_kwargs):
+            await asyncio.sleep(0.1)
+            return result
+
+        mock_request_get.side_effect = slow_get
+
+        color_manager = Colors()
+        colors = await asyncio.gather(
+            *[
+                color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+                for _ in range(10)
+            ]
+        )
+
+        assert mock_request_get.call_count == 1
+        assert all(color["color_field"] == "dl_src" for color in colors)
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_unknown_switch(self, mock_request_get):
+        """Test a switch missing from the cache triggers a fetch."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.json.return_value = COLORS
+        mock_request_get.return_value = result
+
+        color_manager = Colors()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        color = await color_manager.aget_switch_color("aa:00:00:00:00:00:00:99")
+
+        assert color == {}
+        assert mock_request_get.call_count == 2
+
+    @patch("httpx.AsyncClient.get")
+    async def test_aget_switch_colors_invalid_body(self, mock_request_get):
+        """Test an invalid color map keeps the cached one."""
+        result = MagicMock(status_code=200, is_server_error=False)
+        result.json.return_value = COLORS
+        mock_request_get.return_value = result
+
+        color_manager = Colors()
+        await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        color_manager._fetched_at -= color_manager._ttl + 1
+
+        invalid = MagicMock(status_code=200, is_server_error=False)
+        invalid.json.side_effect = ValueError("not json")
+        no_colors = MagicMock(status_code=200, is_server_error=False)
+        no_colors.json.return_value = {}
+        for response in (invalid, no_colors):
+            mock_request_get.return_value = response
+            await color_manager.aget_colors()
+            await color_manager._refresh_task
+
+        assert not color_manager._is_fresh()
+        color = await color_manager.aget_switch_color("aa:00:00:00:00:00:00:11")
+        assert color["color_value"] == "ee:ee:ee:ee:01:2c"
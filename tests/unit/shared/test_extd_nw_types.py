@@ -1,8 +1,16 @@
 """Testing TCP and UPD struct packets"""
 
 # pylint: disable=protected-access
-from napps.amlight.sdntrace.shared.extd_nw_types import TCP, UDP
-from pyof.foundation.network_types import IPv4
+import pytest
+from napps.amlight.sdntrace.shared.extd_nw_types import (
+    TCP,
+    UDP,
+    checksum_adjust,
+    internet_checksum,
+    ones_complement_sum,
+    update_checksum_field,
+)
+from pyof.foundation.network_types import IPv4, IPv6
 
 
 class TestTCP:
@@ -67,7 +75,7 @@ class TestTCP:
         data = b"A word is 4 bytes"
         tcp_pk = TCP()
         actual_value = tcp_pk._value_by_16_bits(data)
-        assert actual_value == 163130
+        assert actual_value == 212090
 
 
 class TestUDP:
@@ -119,4 +127,102 @@ class TestUDP:
         data = b"A word is 4 bytes"
         udp_pk = UDP()
         actual_value = udp_pk._value_by_16_bits(data)
-        assert actual_value == 163130
+        assert actual_value == 212090
+
+
+class TestChecksumAdjust:
+    """Test checksum_adjust"""
+
+    def test_checksum_adjust(self):
+        """Test the incremental checksum matches a full one"""
+        ip_pk = IPv4()
+        ip_pk.source = "127.0.0.1"
+        ip_pk.destination = "127.0.0.2"
+        ip_pk.protocol = 17
+        udp_pk = UDP()
+        udp_pk.src_port = 1
+        udp_pk.dst_port = 2
+        udp_pk.data = b"mocked"
+        old = udp_pk.pack(ip_pk)
+        udp_pk.data = b"probe!"
+        new = udp_pk.pack(ip_pk)
+        old_checksum = int.from_bytes(old[6:8], "big")
+        new_checksum = int.from_bytes(new[6:8], "big")
+        assert checksum_adjust(old_checksum, b"mocked",
+                               b"probe!") == new_checksum
+
+    def test_checksum_adjust_invalid(self):
+        """Test old and new with different or odd lengths"""
+        with pytest.raises(ValueError):
+            checksum_adjust(0, b"ab", b"abcd")
+        with pytest.raises(ValueError):
+            checksum_adjust(0, b"abc", b"abd")
+
+
+class TestChecksum:
+    """Test one's complement sum and Internet checksum"""
+
+    def test_ones_complement_sum(self):
+        """Test the sum folds carries and pads an odd last byte"""
+        assert ones_complement_sum(b"\xff\xff\x00\x02") == 2
+        assert ones_complement_sum(b"\x01") == 0x0100
+        assert ones_complement_sum(memoryview(b"\x00\x01\x00\x02")) == 3
+        assert ones_complement_sum(b"\x00\x01", 0xFFFF) == 1
+
+    def test_internet_checksum(self):
+        """Test RFC 1071 example and that a checksummed buffer verifies"""
+        data = b"\x00\x01\xf2\x03\xf4\xf5\xf6\xf7"
+        checksum = internet_checksum(data)
+        assert checksum == 0x220D
+        assert internet_checksum(data + checksum.to_bytes(2, "big")) == 0
+
+    def test_udp_checksum_odd_data(self):
+        """Test UDP checksum of odd data verifies with the pseudo header"""
+        ip_pk = IPv4()
+        ip_pk.source = "127.0.0.1"
+        ip_pk.destination = "127.0.0.2"
+        ip_pk.protocol = 17
+        udp_pk = UDP(src_port=1, dst_port=2, data=b"odd")
+        packed = udp_pk.pack(ip_pk)
+        pseudo_header = (b"\x7f\x00\x00\x01\x7f\x00\x00\x02\x00\x11" +
+                         len(packed).to_bytes(2, "big"))
+        assert internet_checksum(pseudo_header + packed) == 0
+
+    @pytest.mark.parametrize("l4_class,protocol", [(TCP, 6), (UDP, 17)])
+    def test_checksum_ipv6(self, l4_class, protocol):
+        """Test TCP/UDP checksums over IPv6 verify with the pseudo header"""
+        ip_pk = IPv6(source="2001:db8::1", destination="2001:db8::2",
+                     next_header=protocol)
+        packed = l4_class(src_port=1, dst_port=2, data=b"mocked").pack(ip_pk)
+        pseudo_header = (
+            b"\x20\x01\x0d\xb8" + b"\x00" * 11 + b"\x01" +
+            b"\x20\x01\x0d\xb8" + b"\x00" * 11 + b"\x02" +
+            len(packed).to_bytes(4, "big") + b"\x00\x00\x00" +
+            bytes([protocol])
+        )
+        assert internet_checksum(pseudo_header + packed) == 0
+
+    @pytest.mark.parametrize("offset,value", [
+        (8, b"probe!"), (9, b"xy"), (9, b"xyz"), (13, b"!"), (0, b"\x00\x07")
+    ])
+    def test_update_checksum_field(self, offset, value):
+        """Test patching a field matches packing the segment again"""
+        ip_pk = IPv4()
+        ip_pk.source = "127.0.0.1"
+        ip_pk.destination = "127.0.0.2"
+        ip_pk.protocol = 17
+        data = b"mocked"
+        buff = bytearray(UDP(src_port=1, dst_port=2, data=data).pack(ip_pk))
+        update_checksum_field(buff, 6, offset, value)
+
+        patched = bytearray(buff)
+        patched[offset:offset + len(value)] = value
+        src_port = int.from_bytes(patched[0:2], "big")
+        expected = UDP(src_port=src_port, dst_port=2,
+                       data=bytes(patched[8:])).pack(ip_pk)
+        assert buff == expected
+
+    def test_update_checksum_field_too_long(self):
+        """Test value past the end of buff"""
+        with pytest.raises(ValueError):
+            update_checksum_field(bytearray(10), 6, 8, b"abc")
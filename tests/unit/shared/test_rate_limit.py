@@ -0,0 +1,140 @@
+"""Test the /shared/rate_limit.py."""
+
+import asyncio
+import time
+
+import pytest
+from napps.amlight.sdntrace.shared.rate_limit import (
+    AIMDWindow,
+    ProbePacer,
+    TokenBucket,
+)
+
+
+class TestTokenBucket:
+    """Test the TokenBucket class."""
+
+    def test_consume_burst(self):
+        """Test the bucket allows a burst and then drops."""
+        bucket = TokenBucket(rate=1, burst=3, now=0)
+        assert bucket.consume(now=0)
+        assert bucket.consume(now=0)
+        assert bucket.consume(now=0)
+        assert not bucket.consume(now=0)
+        assert bucket.total == 4
+        assert bucket.dropped == 1
+
+    def test_consume_refill(self):
+        """Test tokens are refilled at rate, up to burst."""
+        bucket = TokenBucket(rate=2, burst=2, now=0)
+        assert bucket.consume(now=0)
+        assert bucket.consume(now=0)
+        assert not bucket.consume(now=0.1)
+        assert bucket.consume(now=0.6)
+        assert not bucket.consume(now=0.6)
+        # A long idle time does not go above burst
+        assert bucket.consume(now=100)
+        assert bucket.consume(now=100)
+        assert not bucket.consume(now=100)
+
+    def test_get_rate(self):
+        """Test the observed rate of consume calls."""
+        bucket = TokenBucket(rate=1, burst=1, now=10)
+        assert bucket.get_rate() == 0
+        bucket.consume(now=10)
+        assert bucket.get_rate() == 1
+        for _ in range(9):
+            bucket.consume(now=12)
+        assert bucket.get_rate() == 5
+
+    def test_wait_time(self):
+        """Test the time until the next token, without taking it."""
+        bucket = TokenBucket(rate=4, burst=1, now=0)
+        assert bucket.wait_time(now=0) == 0
+        assert bucket.consume(now=0)
+        assert bucket.wait_time(now=0) == 0.25
+        assert bucket.wait_time(now=0.2) == pytest.approx(0.05)
+        assert bucket.total == 1
+
+    async def test_acquire(self):
+        """Test acquire waits for a token."""
+        bucket = TokenBucket(rate=20, burst=1)
+        await bucket.acquire()
+        start = time.monotonic()
+        await bucket.acquire()
+        assert time.monotonic() - start >= 0.04
+        assert bucket.total == 2
+        assert bucket.dropped == 0
+
+
+class TestProbePacer:
+    """Test the ProbePacer class."""
+
+    async def test_pace_per_switch(self):
+        """Test each switch has its own bucket."""
+        pacer = ProbePacer(rate=1, burst=1, max_in_flight=1)
+        await pacer.pace("00:01")
+        await asyncio.wait_for(pacer.pace("00:02"), timeout=0.1)
+        pending = asyncio.create_task(pacer.pace("00:01"))
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        pending.cancel()
+
+    async def test_pace_disabled(self):
+        """Test a rate of 0 does not pace."""
+        pacer = ProbePacer(rate=0, burst=1, max_in_flight=1)
+        for _ in range(5):
+            await asyncio.wait_for(pacer.pace("00:01"), timeout=0.1)
+
+    async def test_in_flight(self):
+        """Test the in-flight slots of a switch."""
+        pacer = ProbePacer(rate=0, burst=1, max_in_flight=2)
+        entered = []
+
+        async def probe(dpid):
+            async with pacer.in_flight(dpid):
+                entered.append(dpid)
+                await asyncio.sleep(0.05)
+
+        tasks = [asyncio.create_task(probe("00:01")) for _ in range(3)]
+        tasks.append(asyncio.create_task(probe("00:02")))
+        await asyncio.sleep(0.01)
+        assert entered == ["00:01", "00:01", "00:02"]
+        await asyncio.gather(*tasks)
+        assert len(entered) == 4
+
+
+class TestAIMDWindow:
+    """Test the AIMDWindow class."""
+
+    def test_on_success(self):
+        """Test the window grows by one per window of good samples."""
+        window = AIMDWindow(initial=2, minimum=1, maximum=3)
+        assert not window.on_success("ok")
+        assert not window.on_success("ok")
+        assert window.on_success("ok")
+        assert window.limit == 3
+        assert window.reason == "ok"
+        for _ in range(10):
+            window.on_success("ok")
+        assert window.limit == 3
+
+    def test_on_congestion(self):
+        """Test the window is halved at most once per cooldown."""
+        window = AIMDWindow(initial=8, minimum=3, maximum=10, cooldown=1)
+        assert window.on_congestion("slow", now=0)
+        assert window.limit == 4
+        assert window.reason == "slow"
+        assert not window.on_congestion("slow", now=0.5)
+        assert window.limit == 4
+        assert window.on_congestion("slower", now=2)
+        assert window.limit == 3
+        assert window.reason == "slower"
+        assert not window.on_congestion("slower", now=4)
+        assert window.limit == 3
+
+    def test_bounds(self):
+        """Test the initial window is kept within the bounds."""
+        assert AIMDWindow(initial=20, minimum=1, maximum=5).limit == 5
+        assert AIMDWindow(initial=0, minimum=2, maximum=5).limit == 2
+        assert AIMDWindow(initial=4, minimum=1, maximum=5).reason == "initial"
@@ -0,0 +1,59 @@
+"""Test the /shared/switches.py."""
+
+from unittest.mock import MagicMock
+
+import pytest
+from napps.amlight.sdntrace.shared.switches import Switches, normalize_dpid
+
+
+# pylint: disable=protected-access
+class TestSwitches:
+    """Test the Switches class."""
+
+    def setup_method(self):
+        """Index two switches the way Kytos does."""
+        self.switch_a = MagicMock(dpid="00:00:00:00:00:00:00:01")
+        self.switch_b = MagicMock(dpid="ab:cd:ef:ab:cd:ef:ab:cd")
+        self.switches = {
+            self.switch_a.dpid: self.switch_a,
+            self.switch_b.dpid: self.switch_b,
+        }
+        Switches(MagicMock())._switches = self.switches
+
+    @pytest.mark.parametrize(
+        "dpid,expected",
+        [
+            ("1", "00:00:00:00:00:00:00:01"),
+            ("a", "00:00:00:00:00:00:00:0a"),
+            ("0000000000000001", "00:00:00:00:00:00:00:01"),
+            ("ABCDEFABCDEFABCD", "ab:cd:ef:ab:cd:ef:ab:cd"),
+            ("AB:CD:EF:AB:CD:EF:AB:CD", "ab:cd:ef:ab:cd:ef:ab:cd"),
+            ("ab-cd-ef-ab-cd-ef-ab-cd", "ab:cd:ef:ab:cd:ef:ab:cd"),
+            ("00000000000000001", "00000000000000001"),
+        ],
+    )
+    def test_normalize_dpid(self, dpid, expected):
+        """Test all DPID formats are normalized."""
+        assert normalize_dpid(dpid) == expected
+
+    @pytest.mark.parametrize(
+        "dpid", ["1", "0000000000000001", "00:00:00:00:00:00:00:01"]
+    )
+    def test_get_switch(self, dpid):
+        """Test switches are found with any DPID format."""
+        assert Switches().get_switch(dpid) is self.switch_a
+
+    def test_get_switch_upper_case(self):
+        """Test switches are found with upper case DPIDs."""
+        assert Switches().get_switch("ABCDEFABCDEFABCD") is self.switch_b
+
+    def test_get_switch_unknown(self):
+        """Test unknown switches."""
+        assert Switches().get_switch("2") is False
+
+    def test_get_switch_live(self):
+        """Test switches added by Kytos are found without reindexing."""
+        switch_c = MagicMock(dpid="00:00:00:00:00:00:00:03")
+        self.switches[switch_c.dpid] = switch_c
+        assert Switches().get_switch("3") is switch_c
+        assert len(Switches()) == 3
@@ -28,12 +28,9 @@ class TestMain:
         self.api_client = get_test_client(self.controller, self.napp)
         self.base_endpoint = "amlight/sdntrace/v1"
 
-    @patch(
-        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager.avoid_duplicated_request"
-    )
     @patch("napps.amlight.sdntrace.tracing.trace_manager.TraceManager.is_entry_valid")
     @patch("napps.amlight.sdntrace.tracing.trace_manager.TraceManager.new_trace")
-    async def test_run_trace(self, mock_trace, mock_entry, mock_duplicate):
+    async def test_run_trace(self, mock_trace, mock_entry):
         """Test run_trace"""
         self.napp.controller.loop = asyncio.get_running_loop()
         payload = {
@@ -51,17 +48,8 @@ class TestMain:
         expected_result = {"result": {"error": "not_entry"}}
         assert actual_result == expected_result
 
-        # Error duplicated trace
-        mock_entry.return_value = TraceEntries()
-        mock_duplicate.return_value = True
-        url = f"{self.base_endpoint}/trace"
-        response = await self.api_client.put(url, json=payload)
-        assert response.status_code == 200
-        result = response.json()
-        assert result["result"]["error"] == "Duplicated Trace Request ignored"
-
         # Success
-        mock_duplicate.return_value = False
+        mock_entry.return_value = TraceEntries()
         trace_id = 9999
         mock_trace.return_value = trace_id
         url = f"{self.base_endpoint}/trace"
@@ -70,6 +58,34 @@ class TestMain:
         result = response.json()
         assert result["result"]["trace_id"] == trace_id
 
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager.rest_new_traces"
+    )
+    async def test_run_traces(self, mock_new_traces):
+        """Test run_traces"""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [
+            {
+                "trace": {
+                    "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1},
+                    "eth": {"dl_vlan": vlan},
+                }
+            }
+            for vlan in (100, 200)
+        ]
+        mock_new_traces.return_value = {
+            "result": [{"trace_id": 30001}, {"trace_id": 30002}]
+        }
+        url = f"{self.base_endpoint}/traces"
+        response = await self.api_client.put(url, json=payload)
+        assert response.status_code == 200
+        assert response.json() == mock_new_traces.return_value
+        assert mock_new_traces.call_args[0][0] == payload
+
+        # Not a list of trace requests
+        response = await self.api_client.put(url, json=payload[0])
+        assert response.status_code == 400
+
     @patch("napps.amlight.sdntrace.tracing.trace_manager.TraceManager.get_results")
     async def test_get_results(self, mock_rest_results):
         """Test get_results"""
@@ -121,10 +137,10 @@ class TestMain:
         assert result == "success_mock"
 
     # pylint: disable=protected-access
-    @patch("napps.amlight.sdntrace.tracing.trace_manager.new_thread")
-    async def test_get_stats(self, mock_thread):
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.get_stats")
+    async def test_get_stats(self, mock_colors_stats):
         """Test get_stats"""
-        mock_thread.return_value = True
+        mock_colors_stats.return_value = {"refreshes": 0, "not_modified": 0}
         traces_n = 99
         self.napp.tracing.stop_traces()
         traces_running = {"mock": "request"}
@@ -143,9 +159,40 @@ class TestMain:
             "number_of_running_traces": len(traces_running),
             "number_of_pending_traces": len(dict_request),
             "list_of_pending_traces": queue_result,
+            "number_of_probe_packet_ins": 0,
+            "number_of_other_packet_ins": 0,
+            "number_of_unknown_probes": 0,
+            "number_of_stale_probes": 0,
+            "number_of_storm_probes": 0,
+            "number_of_coalesced_traces": 0,
+            "number_of_result_cache_hits": 0,
+            "number_of_result_cache_misses": 0,
+            "concurrency_window": settings.PARALLEL_TRACES,
+            "concurrency_window_reason": "initial",
+            "pending_traces_per_priority": {
+                "interactive": 0,
+                "scheduled": 0,
+                "bulk": 0,
+            },
+            "number_of_color_refreshes": 0,
+            "number_of_color_refreshes_not_modified": 0,
         }
         assert actual_result == expected_result
 
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.invalidate")
+    async def test_on_topology_changed(self, mock_invalidate):
+        """Test topology events drop the cached colors and results."""
+        self.napp.tracing = MagicMock()
+        await self.napp.on_topology_changed(MagicMock())
+        mock_invalidate.assert_called_once()
+        self.napp.tracing.invalidate_results.assert_called_once()
+
+    async def test_on_flows_changed(self):
+        """Test flow events drop the cached results."""
+        self.napp.tracing = MagicMock()
+        await self.napp.on_flows_changed(MagicMock())
+        self.napp.tracing.invalidate_results.assert_called_once()
+
     async def test_list_settings(self):
         """Test list_settings"""
         url = f"{self.base_endpoint}/settings"
@@ -0,0 +1,100 @@
+"""
+    Test tracing.request_queue
+"""
+
+import asyncio
+
+import pytest
+from napps.amlight.sdntrace.tracing.request_queue import FairRequestQueue
+
+WEIGHTS = {"interactive": 8, "scheduled": 4, "bulk": 1}
+
+
+class TestFairRequestQueue:
+    """Test the FairRequestQueue class."""
+
+    @staticmethod
+    async def drain(queue):
+        """Get all the queued request ids."""
+        return [await queue.get() for _ in range(queue.qsize())]
+
+    async def test_fifo_same_flow(self):
+        """Test requests of the same priority and source keep their order."""
+        queue = FairRequestQueue(WEIGHTS)
+        for request_id in range(5):
+            await queue.put(request_id, "bulk", "a")
+        assert await self.drain(queue) == [0, 1, 2, 3, 4]
+
+    async def test_interactive_not_blocked_by_bulk(self):
+        """Test an interactive request goes ahead of a bulk backlog."""
+        queue = FairRequestQueue(WEIGHTS)
+        for request_id in range(500):
+            await queue.put(request_id, "bulk", "job")
+        await queue.get()
+        await queue.put(1000, "interactive", "operator")
+        assert await queue.get() == 1000
+
+    async def test_weighted_share(self):
+        """Test priorities share the dispatched requests by weight."""
+        queue = FairRequestQueue(WEIGHTS)
+        for request_id in range(20):
+            await queue.put(("bulk", request_id), "bulk")
+            await queue.put(("scheduled", request_id), "scheduled")
+        first = [request[0] for request in await self.drain(queue)][:10]
+        assert first.count("scheduled") == 8
+        assert first.count("bulk") == 2
+
+    async def test_fair_across_sources(self):
+        """Test sources of the same priority alternate."""
+        queue = FairRequestQueue(WEIGHTS)
+        for request_id in range(3):
+            await queue.put(("a", request_id), "bulk", "a")
+        for request_id in range(3):
+            await queue.put(("b", request_id), "bulk", "b")
+        sources = [request[0] for request in await self.drain(queue)]
+        assert sources == ["a", "b", "a", "b", "a", "b"]
+
+    async def test_get_waits(self):
+        """Test get waits for a request."""
+        queue = FairRequestQueue(WEIGHTS)
+        task = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not task.done()
+        queue.put_nowait(1, "scheduled")
+        assert await asyncio.wait_for(task, timeout=1) == 1
+
+    async def test_depths(self):
+        """Test the number of queued requests per priority."""
+        queue = FairRequestQueue(WEIGHTS)
+        queue.put_nowait(1, "bulk")
+        queue.put_nowait(2, "bulk")
+        queue.put_nowait(3, "interactive")
+        assert queue.get_depths() == {"interactive": 1, "scheduled": 0, "bulk": 2}
+        await self.drain(queue)
+        assert queue.get_depths() == {"interactive": 0, "scheduled": 0, "bulk": 0}
+        assert not queue._finish  # pylint: disable=protected-access
+
+    def test_unknown_priority(self):
+        """Test an unknown priority is refused."""
+        queue = FairRequestQueue(WEIGHTS)
+        with pytest.raises(ValueError):
+            queue.put_nowait(1, "urgent")
+
+    async def test_promote(self):
+        """Test a queued bulk request promoted to interactive goes ahead
+        of the bulk backlog, and is not promoted to a lighter priority."""
+        queue = FairRequestQueue(WEIGHTS)
+        for request_id in range(100):
+            queue.put_nowait(request_id, "bulk", "job")
+        assert queue.promote(99, "interactive", "operator")
+        assert not queue.promote(99, "bulk")
+        assert not queue.promote(1000, "interactive")
+        assert queue.qsize() == 100
+        assert queue.get_depths() == {"interactive": 1, "scheduled": 0, "bulk": 99}
+
+        assert await queue.get() == 99
+        assert await self.drain(queue) == list(range(99))
+        assert queue.qsize() == 0
+        assert not queue._finish  # pylint: disable=protected-access
+        with pytest.raises(ValueError):
+            queue.promote(1, "urgent")
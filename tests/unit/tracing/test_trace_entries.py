@@ -5,6 +5,7 @@
 import pytest
 
 from napps.amlight.sdntrace.tracing.trace_entries import TraceEntries
+from napps.amlight.sdntrace.tracing.trace_pkt import ParsedProbe
 
 
 class TestDpid:
@@ -523,6 +524,66 @@ class TestLoadEntries:
         assert self.trace_entries.in_port == dpid["in_port"]
         assert self.trace_entries.timeout == 0.5
 
+    def test_vlans(self):
+        """Test a stack of VLAN tags."""
+        dpid = {"dpid": "a", "in_port": 1}
+        eth = {"vlans": [{"dl_vlan": 10, "tpid": 0x88A8},
+                         {"dl_vlan": 100, "dl_vlan_pcp": 3}]}
+        self.trace_entries.load_entries({"trace": {"switch": dpid, "eth": eth}})
+        assert self.trace_entries.vlans == ((0x88A8, 10, 0), (0x8100, 100, 3))
+        assert self.trace_entries.dl_vlan == 10
+        assert self.trace_entries.dl_vlan_pcp == 0
+
+    @pytest.mark.parametrize("eth", [
+        {"vlans": []},
+        {"vlans": {"dl_vlan": 10}},
+        {"vlans": [10]},
+        {"vlans": [{"dl_vlan_pcp": 1}]},
+        {"vlans": [{"dl_vlan": 4096}]},
+        {"vlans": [{"dl_vlan": 10, "dl_vlan_pcp": 8}]},
+        {"vlans": [{"dl_vlan": 10, "tpid": 0x0800}]},
+        {"vlans": [{"dl_vlan": 10}] * 5},
+        {"vlans": [{"dl_vlan": 10}], "dl_vlan": 10},
+    ])
+    def test_invalid_vlans(self, eth):
+        """Test invalid stacks of VLAN tags."""
+        dpid = {"dpid": "a", "in_port": 1}
+        with pytest.raises(ValueError):
+            self.trace_entries.load_entries({"trace": {"switch": dpid,
+                                                       "eth": eth}})
+
+    def test_ipv6(self):
+        """Test IPv6 addresses with dl_type IPv6."""
+        dpid = {"dpid": "a", "in_port": 1}
+        eth = {"dl_type": 0x86DD}
+        ip = {"nw_src": "2001:DB8:0::10", "nw_proto": 17}
+        tp = {"tp_src": 1, "tp_dst": 2}
+        self.trace_entries.load_entries(
+            {"trace": {"switch": dpid, "eth": eth, "ip": ip, "tp": tp}}
+        )
+        assert self.trace_entries.nw_src == "2001:db8::10"
+        assert self.trace_entries.nw_dst == "2001:db8::2"
+
+    @pytest.mark.parametrize("eth,ip", [
+        ({"dl_type": 0x86DD}, {"nw_src": "10.0.0.1"}),
+        ({}, {"nw_dst": "2001:db8::1"}),
+        ({"dl_type": 0x86DD}, {"nw_src": "2001:db8::g"}),
+    ])
+    def test_ip_version_mismatch(self, eth, ip):
+        """Test addresses of another IP version than dl_type."""
+        dpid = {"dpid": "a", "in_port": 1}
+        with pytest.raises(ValueError):
+            self.trace_entries.load_entries(
+                {"trace": {"switch": dpid, "eth": eth, "ip": ip}}
+            )
+
+    def test_dl_vlan_pcp_before_dl_vlan(self):
+        """Test PCP set before the VLAN ID is kept for the tag."""
+        self.trace_entries.dl_vlan_pcp = 5
+        assert not self.trace_entries.vlans
+        self.trace_entries.dl_vlan = 100
+        assert self.trace_entries.vlans == ((0x8100, 100, 5),)
+
     def test_timeout(self):
         """Test different timeout from default."""
         timeout = 5
@@ -536,6 +597,50 @@ class TestLoadEntries:
         assert self.trace_entries.in_port == dpid["in_port"]
         assert self.trace_entries.timeout == timeout
 
+    def test_priority_and_source(self):
+        """Test the priority class and source of a trace request."""
+        dpid = {"dpid": "a", "in_port": 1}
+        entries = {"trace": {"switch": dpid}}
+        self.trace_entries.load_entries(entries)
+        assert self.trace_entries.priority == "interactive"
+        assert self.trace_entries.source is None
+
+        entries["trace"]["priority"] = "bulk"
+        entries["trace"]["source"] = "nightly-check"
+        self.trace_entries.load_entries(entries)
+        assert self.trace_entries.priority == "bulk"
+        assert self.trace_entries.source == "nightly-check"
+
+        entries["trace"]["priority"] = "urgent"
+        with pytest.raises(ValueError):
+            self.trace_entries.load_entries(entries)
+
+    def test_fingerprint(self):
+        """Test requests for the same trace have the same fingerprint."""
+        entries = {
+            "trace": {
+                "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1},
+                "eth": {"dl_vlan": 100, "dl_dst": "ca:fe:ca:fe:ca:fe"},
+                "ip": {"nw_src": "10.0.0.1"},
+            }
+        }
+        self.trace_entries.load_entries(entries)
+
+        other = TraceEntries()
+        other.load_entries({
+            "trace": {
+                "switch": {"dpid": "1", "in_port": 1},
+                "eth": {"dl_vlan": 100, "dl_dst": "CA:FE:CA:FE:CA:FE"},
+                "ip": {"nw_src": "10.0.0.01"},
+                "priority": "bulk",
+            }
+        })
+        assert other.fingerprint() == self.trace_entries.fingerprint()
+        assert hash(other.fingerprint())
+
+        other.dl_vlan = 200
+        assert other.fingerprint() != self.trace_entries.fingerprint()
+
     def test_proto_missing_tp(self):
         """Test missing tp when nw_proto is present"""
         dpid = {"dpid": "a", "in_port": 1}
@@ -553,3 +658,62 @@ class TestLoadEntries:
         entries = {"trace": switch}
         self.trace_entries.load_entries(entries)
         assert self.trace_entries.nw_proto == ip["nw_proto"]
+
+
+class TestUpdateHeaders:
+    """Test update_headers with the fields of a parsed PacketIn"""
+
+    def setup_method(self):
+        """Set up before each test method"""
+        self.trace_entries = TraceEntries()
+        self.trace_entries.load_entries({"trace": {
+            "switch": {"dpid": "a", "in_port": 1},
+            "eth": {"dl_vlan": 100, "dl_vlan_pcp": 3},
+            "ip": {"nw_proto": 17},
+            "tp": {"tp_src": 1, "tp_dst": 2},
+        }})
+
+    def test_update_headers(self):
+        """Test all rewritten fields are copied"""
+        probe = ParsedProbe()
+        probe.dl_src = "ee:ee:ee:ee:ee:02"
+        probe.dl_dst = "00:00:00:00:00:aa"
+        probe.vlans = [(0x8100, 200, 5)]
+        probe.nw_src = "10.0.0.1"
+        probe.nw_dst = "10.0.0.2"
+        probe.nw_tos = 4
+        probe.nw_proto = 17
+        probe.tp_src = 1000
+        probe.tp_dst = 2000
+        self.trace_entries.update_headers(probe)
+
+        assert self.trace_entries.dl_src == 0
+        assert self.trace_entries.dl_dst == "00:00:00:00:00:aa"
+        assert self.trace_entries.dl_vlan == 200
+        assert self.trace_entries.dl_vlan_pcp == 5
+        assert self.trace_entries.nw_src == "10.0.0.1"
+        assert self.trace_entries.nw_dst == "10.0.0.2"
+        assert self.trace_entries.nw_tos == 4
+        assert self.trace_entries.tp_src == 1000
+        assert self.trace_entries.tp_dst == 2000
+
+    def test_update_headers_vlan_pushed(self):
+        """Test a pushed S-tag is added to the VLAN stack"""
+        probe = ParsedProbe()
+        probe.dl_dst = "ca:fe:ca:fe:ca:fe"
+        probe.vlans = [(0x88A8, 10, 0), (0x8100, 100, 3)]
+        self.trace_entries.update_headers(probe)
+
+        assert self.trace_entries.vlans == ((0x88A8, 10, 0), (0x8100, 100, 3))
+        assert self.trace_entries.dl_vlan == 10
+
+    def test_update_headers_vlan_popped(self):
+        """Test an untagged PacketIn clears the VLAN, no IP keeps IP"""
+        probe = ParsedProbe()
+        probe.dl_dst = "ca:fe:ca:fe:ca:fe"
+        self.trace_entries.update_headers(probe)
+
+        assert self.trace_entries.dl_vlan == 0
+        assert self.trace_entries.dl_vlan_pcp == 0
+        assert self.trace_entries.nw_src == "1.1.1.1"
+        assert self.trace_entries.tp_src == 1
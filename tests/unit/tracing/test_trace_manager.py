@@ -3,22 +3,22 @@
 """
 
 import asyncio
-import threading
-from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 
 import pytest
-from janus import Queue
 from kytos.lib.helpers import (
     get_controller_mock,
     get_interface_mock,
     get_link_mock,
     get_switch_mock,
 )
-from pyof.foundation.network_types import Ethernet
 from napps.amlight.sdntrace import settings
 from napps.amlight.sdntrace.shared.switches import Switches
 from napps.amlight.sdntrace.tracing.trace_entries import TraceEntries
 from napps.amlight.sdntrace.tracing.trace_manager import TraceManager
+from napps.amlight.sdntrace.tracing.trace_msg import TraceMsg
+from napps.amlight.sdntrace.tracing.trace_pkt import ParsedProbe
 
 
 # pylint: disable=protected-access
@@ -50,7 +50,6 @@ class TestTraceManager:
         self.create_basic_switches(get_controller_mock())
         TraceManager.run_traces = MagicMock()
         self.trace_manager = TraceManager(controller=get_controller_mock())
-        self.trace_manager._request_queue = AsyncMock()
 
     @classmethod
     def create_basic_switches(cls, controller):
@@ -153,6 +152,170 @@ class TestTraceManager:
         trace_id = await self.trace_manager.new_trace(trace_entries)
         assert trace_id == 30002
 
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_rest_new_trace_priority(self, mock_acolors):
+        """Test new traces are queued with their priority and source."""
+        mock_acolors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+        switch = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        entries = {"trace": {"switch": switch, "priority": "bulk"}}
+
+        result = await self.trace_manager.rest_new_trace(entries, "10.0.0.1")
+        trace_id = result["result"]["trace_id"]
+        assert self.trace_manager._request_dict[trace_id].source == "10.0.0.1"
+
+        entries = {
+            "trace": {"switch": switch, "source": "nightly", "timeout": 1}
+        }
+        result = await self.trace_manager.rest_new_trace(entries, "10.0.0.1")
+        trace_id = result["result"]["trace_id"]
+        # The client address can not be replaced by the request
+        assert self.trace_manager._request_dict[trace_id].source == "10.0.0.1"
+
+        entries = {
+            "trace": {"switch": switch, "source": "nightly", "timeout": 2}
+        }
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        assert self.trace_manager._request_dict[trace_id].source == "nightly"
+
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["pending_traces_per_priority"] == {
+            "interactive": 2,
+            "scheduled": 0,
+            "bulk": 1,
+        }
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_coalesced_request_promotes_pending(self, mock_acolors):
+        """Test a pending bulk trace takes the priority of an identical
+        interactive request attached to it."""
+        mock_acolors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+        switch = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        for request_id in range(3):
+            entries = {"trace": {"switch": switch, "priority": "bulk",
+                                 "timeout": request_id + 1}}
+            await self.trace_manager.rest_new_trace(entries, "job")
+
+        entries = {"trace": {"switch": switch, "timeout": 3}}
+        result = await self.trace_manager.rest_new_trace(entries, "operator")
+        assert result["result"]["trace_id"] == 30004
+        assert self.trace_manager._leaders == {30004: 30003}
+        assert self.trace_manager._request_dict[30003].priority == "interactive"
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["pending_traces_per_priority"] == {
+            "interactive": 1,
+            "scheduled": 0,
+            "bulk": 2,
+        }
+        assert await self.trace_manager._request_queue.get() == 30003
+
+        # A lighter request does not demote it
+        entries = {"trace": {"switch": switch, "priority": "bulk",
+                             "timeout": 1}}
+        await self.trace_manager.rest_new_trace(entries, "job")
+        assert self.trace_manager._request_queue.qsize() == 2
+        assert self.trace_manager._leaders[30005] == 30001
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_colors")
+    async def test_rest_new_traces(self, mock_acolors):
+        """Test a list of trace requests is validated and queued at once."""
+        mock_acolors.return_value = {
+            "00:00:00:00:00:00:00:01": {
+                "color_field": "dl_src",
+                "color_value": "ee:ee:ee:ee:ee:01",
+            },
+        }
+        switch = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        entries_list = [
+            {"trace": {"switch": switch, "eth": {"dl_vlan": vlan},
+                       "source": f"job-{vlan}"}}
+            for vlan in (100, 200, 300)
+        ]
+
+        result = await self.trace_manager.rest_new_traces(entries_list, "h1")
+        assert result["result"] == [
+            {"trace_id": 30001},
+            {"trace_id": 30002},
+            {"trace_id": 30003},
+        ]
+        mock_acolors.assert_called_once()
+        assert mock_acolors.call_args[0][0] == {"00:00:00:00:00:00:00:01"}
+        assert self.trace_manager._request_queue.qsize() == 3
+        assert self.trace_manager._request_dict[30002].source == "h1"
+        assert self.trace_manager._request_dict[30002].dl_vlan == 200
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_colors")
+    async def test_rest_new_traces_invalid(self, mock_acolors):
+        """Test no trace is queued if any request is invalid."""
+        mock_acolors.return_value = {
+            "00:00:00:00:00:00:00:01": {
+                "color_field": "dl_src",
+                "color_value": "ee:ee:ee:ee:ee:01",
+            },
+        }
+        entries_list = [
+            {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                  "in_port": 1}}},
+            {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:02",
+                                  "in_port": 1}}},
+            {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:05",
+                                  "in_port": 1}}},
+            {"trace": {}},
+        ]
+
+        result = await self.trace_manager.rest_new_traces(entries_list)
+        assert result["result"] == [
+            {},
+            {"error": "Switch not Colored"},
+            {"error": "Unknown Switch"},
+            {"error": "Error: switch key not provided"},
+        ]
+        assert self.trace_manager._request_queue.qsize() == 0
+        assert not self.trace_manager._request_dict
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_colors")
+    async def test_rest_new_traces_coalesced(self, mock_acolors):
+        """Test identical requests inside a list share one trace."""
+        mock_acolors.return_value = {
+            "00:00:00:00:00:00:00:01": {
+                "color_field": "dl_src",
+                "color_value": "ee:ee:ee:ee:ee:01",
+            },
+        }
+        entries_list = [
+            {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                  "in_port": 1}}},
+            {"trace": {"switch": {"dpid": "1", "in_port": 1}}},
+        ]
+
+        result = await self.trace_manager.rest_new_traces(entries_list)
+        assert result["result"] == [{"trace_id": 30001}, {"trace_id": 30002}]
+        assert self.trace_manager._request_queue.qsize() == 1
+        assert self.trace_manager._followers == {30001: [30002]}
+
+    async def test_rest_new_traces_too_many(self):
+        """Test the size limit of a list of trace requests."""
+        entries_list = [{}] * (settings.BULK_TRACES_MAX_SIZE + 1)
+        result = await self.trace_manager.rest_new_traces(entries_list)
+        assert "error" in result["result"]
+        assert self.trace_manager._request_queue.qsize() == 0
+
+    def test_count_packet_in(self):
+        """Test PacketIn counters exported by rest_list_stats."""
+        self.trace_manager.count_packet_in(True)
+        self.trace_manager.count_packet_in(False)
+        self.trace_manager.count_packet_in(False)
+
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_probe_packet_ins"] == 1
+        assert stats["number_of_other_packet_ins"] == 2
+
     def test_get_id(self):
         """Test trace manager ID control."""
         trace_id = self.trace_manager.get_id()
@@ -251,16 +414,14 @@ class TestTraceManager:
         switch = {"switch": dpid, "eth": eth, "timeout": 0.1}
         entries = {"trace": switch}
 
-        self.trace_manager._request_queue = Queue()
         self.trace_manager._is_tracing_running = True
         mock_is_running.side_effect = [True, False]
         trace_entries = await self.trace_manager.is_entry_valid(entries)
         trace_id = await self.trace_manager.new_trace(trace_entries)
         pending = self.trace_manager.number_pending_requests()
 
-        trace_thread = threading.Thread(target=self.trace_manager._run_traces)
-        trace_thread.start()
-        # Waiting thread to start processing the request
+        dispatcher = asyncio.create_task(self.trace_manager._run_traces())
+        # Waiting task to start processing the request
         count = 0
         while pending == 1:
             result = self.trace_manager.get_result(trace_id)
@@ -273,7 +434,7 @@ class TestTraceManager:
 
         count = 0
         result = self.trace_manager.get_result(trace_id)
-        # Waiting thread to process the request
+        # Waiting task to process the request
         while "msg" in result and result["msg"] == "trace in process":
             result = self.trace_manager.get_result(trace_id)
             await asyncio.sleep(0.1)
@@ -282,7 +443,7 @@ class TestTraceManager:
                 pytest.fail("Timeout waiting to process trace")
                 break
         self.trace_manager.stop_traces()
-        trace_thread.join()
+        await dispatcher
         assert result["request_id"] == 30001
         assert result["result"][0]["type"] == "starting"
         assert result["result"][0]["dpid"] == "00:00:00:00:00:00:00:01"
@@ -290,6 +451,7 @@ class TestTraceManager:
         assert result["result"][0]["time"] is not None
         assert result["start_time"] is not None
         assert result["total_time"] is not None
+        assert result["queue_time"] is not None
         assert result["request"]["trace"]["switch"]["dpid"] == "00:00:00:00:00:00:00:01"
         assert result["request"]["trace"]["switch"]["in_port"] == 1
 
@@ -312,12 +474,14 @@ class TestTraceManager:
         trace_id = await self.trace_manager.new_trace(trace_entries)
         assert trace_id == 30001
 
-        duplicated = self.trace_manager.avoid_duplicated_request(trace_entries)
-        assert duplicated is True
+        trace_id = await self.trace_manager.new_trace(trace_entries)
+        assert trace_id == 30002
+        assert self.trace_manager._leaders == {30002: 30001}
+        assert self.trace_manager._request_queue.qsize() == 1
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
-    async def test_avoid_duplicated_request(self, mock_colors):
-        """Test trace manager new trace creation."""
+    async def test_coalesced_request(self, mock_colors):
+        """Test identical requests share the trace in flight."""
         mock_colors.return_value = {
             "color_field": "dl_src",
             "color_value": "ee:ee:ee:ee:ee:01",
@@ -328,18 +492,186 @@ class TestTraceManager:
         switch = {"switch": dpid, "eth": eth}
         entries = {"trace": switch}
 
-        trace_entries = await self.trace_manager.is_entry_valid(entries)
-        assert isinstance(trace_entries, TraceEntries)
-
-        trace_id = await self.trace_manager.new_trace(trace_entries)
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
         assert trace_id == 30001
 
+        # Another trace
         entries["trace"]["switch"]["dpid"] = "00:00:00:00:00:00:00:02"
-        trace_entries = await self.trace_manager.is_entry_valid(entries)
-        assert isinstance(trace_entries, TraceEntries)
+        result = await self.trace_manager.rest_new_trace(entries)
+        assert result["result"]["trace_id"] == 30002
+
+        # Same trace, dpid and MAC written differently
+        entries["trace"]["switch"]["dpid"] = "1"
+        entries["trace"]["eth"]["dl_dst"] = "CA:FE:CA:FE:CA:FE"
+        result = await self.trace_manager.rest_new_trace(entries)
+        follower_id = result["result"]["trace_id"]
+        assert follower_id == 30003
+        assert self.trace_manager._request_queue.qsize() == 2
+        assert self.trace_manager.get_result(follower_id) == {
+            "msg": "trace pending"
+        }
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_requests"] == 3
+        assert stats["number_of_coalesced_traces"] == 1
+
+        # Both get the result of the trace
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        del self.trace_manager._request_dict[trace_id]
+        assert self.trace_manager.get_result(follower_id) == {
+            "msg": "trace in process"
+        }
+        self.trace_manager.add_result(
+            trace_id, {"request_id": trace_id, "result": "ok"}
+        )
+        assert self.trace_manager.get_result(trace_id)["result"] == "ok"
+        assert self.trace_manager.get_result(follower_id) == {
+            "request_id": follower_id,
+            "result": "ok",
+            "coalesced_with": trace_id,
+        }
+        assert not self.trace_manager._leaders
+        assert not self.trace_manager._followers
+
+        # Not attached once the trace is done
+        result = await self.trace_manager.rest_new_trace(entries)
+        assert result["result"]["trace_id"] == 30004
+        assert self.trace_manager._request_queue.qsize() == 3
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_result_cache(self, mock_colors):
+        """Test identical requests reuse a cached result."""
+        mock_colors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+        self.trace_manager._result_cache_ttl = 10
+        entries = {
+            "trace": {
+                "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+            }
+        }
+
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(
+            trace_id, {"request_id": trace_id, "result": [{"type": "last"}]}
+        )
+
+        result = await self.trace_manager.rest_new_trace(entries)
+        cached_id = result["result"]["trace_id"]
+        assert cached_id == 30002
+        assert self.trace_manager.get_result(cached_id) == {
+            "request_id": cached_id,
+            "result": [{"type": "last"}],
+            "cached_from": trace_id,
+        }
+        assert self.trace_manager._request_queue.qsize() == 1
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_result_cache_hits"] == 1
+        assert stats["number_of_result_cache_misses"] == 1
+
+        # Expired
+        fingerprint = next(iter(self.trace_manager._result_cache))
+        version, _, cached_from, cached = self.trace_manager._result_cache[
+            fingerprint
+        ]
+        self.trace_manager._result_cache[fingerprint] = (
+            version, 0, cached_from, cached
+        )
+        result = await self.trace_manager.rest_new_trace(entries)
+        assert self.trace_manager._request_queue.qsize() == 2
+        assert not self.trace_manager._result_cache
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_result_cache_misses"] == 2
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_result_cache_invalidated(self, mock_colors):
+        """Test topology changes invalidate the cached results, and the
+        results of the traces running while they happen."""
+        mock_colors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+        self.trace_manager._result_cache_ttl = 10
+        entries = {
+            "trace": {
+                "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+            }
+        }
+
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(trace_id, {"result": [{"type": "last"}]})
+        assert self.trace_manager._result_cache
+        self.trace_manager.invalidate_results()
+        assert not self.trace_manager._result_cache
+
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        self.trace_manager.invalidate_results()
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(trace_id, {"result": [{"type": "last"}]})
+        assert not self.trace_manager._result_cache
+
+        # Not attached to a trace requested before a topology change
+        result = await self.trace_manager.rest_new_trace(entries)
+        old_id = result["result"]["trace_id"]
+        self.trace_manager.invalidate_results()
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        assert trace_id not in self.trace_manager._leaders
+        assert trace_id in self.trace_manager._request_dict
+        assert self.trace_manager._fingerprint_index[
+            self.trace_manager._fingerprints[trace_id]
+        ] == trace_id
+        result = await self.trace_manager.rest_new_trace(entries)
+        assert self.trace_manager._leaders[result["result"]["trace_id"]] == (
+            trace_id
+        )
+        # The old trace ending keeps the new one indexed
+        self.trace_manager._running_traces[old_id] = MagicMock()
+        self.trace_manager.add_result(old_id, {"result": [{"type": "last"}]})
+        assert trace_id in self.trace_manager._fingerprint_index.values()
+        assert not self.trace_manager._result_cache
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(trace_id, {"result": [{"type": "last"}]})
+        assert self.trace_manager._result_cache
+        self.trace_manager.invalidate_results()
+
+        # Traces ended by stop_traces are not cached
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(
+            trace_id, {"result": [{"type": "pre-ended"}]}
+        )
+        assert not self.trace_manager._result_cache
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_result_cache_disabled(self, mock_colors):
+        """Test the result cache is disabled by default."""
+        mock_colors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+        entries = {
+            "trace": {
+                "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+            }
+        }
+        result = await self.trace_manager.rest_new_trace(entries)
+        trace_id = result["result"]["trace_id"]
+        self.trace_manager._running_traces[trace_id] = MagicMock()
+        self.trace_manager.add_result(trace_id, {"result": [{"type": "last"}]})
 
-        duplicated = self.trace_manager.avoid_duplicated_request(trace_entries)
-        assert duplicated is False
+        await self.trace_manager.rest_new_trace(entries)
+        assert not self.trace_manager._result_cache
+        assert self.trace_manager._request_queue.qsize() == 2
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_result_cache_misses"] == 0
 
     def test_limit_traces_reached(self):
         """Test trace manager limit for thread processing."""
@@ -354,8 +686,81 @@ class TestTraceManager:
         is_limit = self.trace_manager.limit_traces_reached()
         assert is_limit
 
+    async def test_run_traces_waits_for_slot(self):
+        """Test the dispatcher starts a pending trace once a slot frees."""
+        self.trace_manager._is_tracing_running = True
+        self.trace_manager._request_dict[30001] = MagicMock()
+        await self.trace_manager._request_queue.put(30001, "interactive")
+        for i in range(settings.PARALLEL_TRACES):
+            self.trace_manager._running_traces[i] = MagicMock()
+
+        with patch.object(self.trace_manager, "_spawn_trace") as mock_spawn:
+            dispatcher = asyncio.create_task(self.trace_manager._run_traces())
+            await asyncio.sleep(0.01)
+            mock_spawn.assert_not_called()
+
+            self.trace_manager.add_result(0, {"result": "ok"})
+            await asyncio.sleep(0.01)
+            mock_spawn.assert_called_once()
+            assert mock_spawn.call_args[0][0] == 30001
+
+            self.trace_manager.stop_traces()
+            dispatcher.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await dispatcher
+
+    @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.tracepath")
+    async def test_spawn_trace_queue_time(self, _mock_tracepath):
+        """Test the tracer gets the time its request was queued."""
+        queued_at = datetime.now() - timedelta(seconds=2)
+        self.trace_manager._request_times[30001] = queued_at
+
+        task = self.trace_manager._spawn_trace(30001, MagicMock())
+        tracer = self.trace_manager._running_traces[30001]
+        await task
+        assert tracer.queue_time >= timedelta(seconds=2)
+        assert not self.trace_manager._request_times
+
+    def test_record_probe_rtt(self):
+        """Test the concurrency window follows the probe round-trip times."""
+        self.trace_manager.controller.buffers.msg_out.qsize.return_value = 0
+        window = settings.PARALLEL_TRACES
+        for i in range(window):
+            self.trace_manager._running_traces[i] = MagicMock()
+
+        self.trace_manager.record_probe_rtt(settings.PROBE_RTT_TARGET * 2)
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["concurrency_window"] == window // 2
+        assert stats["concurrency_window_reason"].startswith("probe rtt")
+
+        for _ in range(window):
+            self.trace_manager.record_probe_rtt(0)
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["concurrency_window"] > window // 2
+        assert "below target" in stats["concurrency_window_reason"]
+        assert self.trace_manager._slot_freed.is_set()
+
+    def test_record_probe_rtt_msg_out(self):
+        """Test a deep msg_out buffer shrinks the concurrency window."""
+        buffers = self.trace_manager.controller.buffers
+        buffers.msg_out.qsize.return_value = settings.MSG_OUT_DEPTH_TARGET + 1
+
+        self.trace_manager.record_probe_rtt(0)
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["concurrency_window"] == settings.PARALLEL_TRACES // 2
+        assert stats["concurrency_window_reason"].startswith("msg_out depth")
+
+    def test_record_probe_rtt_not_full(self):
+        """Test the window only grows when it limits the traces."""
+        self.trace_manager.controller.buffers.msg_out.qsize.return_value = 0
+        for _ in range(100):
+            self.trace_manager.record_probe_rtt(0)
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["concurrency_window"] == settings.PARALLEL_TRACES
+        assert stats["concurrency_window_reason"] == "initial"
+
     @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.tracepath")
-    def test_spawn_trace(self, mock_tracepath):
+    async def test_spawn_trace(self, mock_tracepath):
         """Test spawn trace."""
         # mock_tracepath
         trace_id = 0
@@ -363,11 +768,80 @@ class TestTraceManager:
 
         self.trace_manager._running_traces[0] = 9999
 
-        self.trace_manager._spawn_trace(trace_id, trace_entries)
+        task = self.trace_manager._spawn_trace(trace_id, trace_entries)
+        assert self.trace_manager._running_traces[trace_id].trace_task is task
+        await task
         self.trace_manager.add_result(trace_id, {"result": "ok"})
         mock_tracepath.assert_called_once()
         assert len(self.trace_manager._running_traces) == 0
 
+    @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.tracepath")
+    async def test_spawn_trace_error(self, mock_tracepath):
+        """Test a failed trace task releases its running slot."""
+        mock_tracepath.side_effect = ValueError("boom")
+        trace_id = 0
+
+        task = self.trace_manager._spawn_trace(trace_id, MagicMock())
+        with pytest.raises(ValueError):
+            await task
+        await asyncio.sleep(0)
+        assert trace_id not in self.trace_manager._running_traces
+
+    @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.tracepath")
+    async def test_spawn_trace_error_result(self, mock_tracepath):
+        """Test a failed trace and the traces attached to it get an
+        error result, which is not cached."""
+        mock_tracepath.side_effect = ValueError("boom")
+        self.trace_manager._result_cache_ttl = 10
+        self.trace_manager._fingerprints[30001] = ("fingerprint",)
+        self.trace_manager._trace_versions[30001] = 0
+        self.trace_manager._followers[30001] = [30002]
+        self.trace_manager._leaders[30002] = 30001
+
+        task = self.trace_manager._spawn_trace(30001, MagicMock())
+        with pytest.raises(ValueError):
+            await task
+        await asyncio.sleep(0)
+
+        result = self.trace_manager.get_result(30001)
+        assert result["request_id"] == 30001
+        assert result["result"][-1]["type"] == "last"
+        assert result["result"][-1]["reason"] == "error"
+        assert result["result"][-1]["msg"] == "Trace failed: boom"
+        follower = self.trace_manager.get_result(30002)
+        assert follower["request_id"] == 30002
+        assert follower["coalesced_with"] == 30001
+        assert follower["result"] == result["result"]
+        assert not self.trace_manager._leaders
+        assert not self.trace_manager._followers
+        assert not self.trace_manager._result_cache
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.tracepath_loop")
+    async def test_run_many_traces_concurrently(self, mock_trace_loop, mock_acolors):
+        """Test that traces run as concurrent tasks on the event loop."""
+        mock_acolors.return_value = {
+            "color_field": "dl_src",
+            "color_value": "ee:ee:ee:ee:ee:01",
+        }
+
+        async def wrap_tracepath_loop(*_args):
+            await asyncio.sleep(0.1)
+
+        mock_trace_loop.side_effect = wrap_tracepath_loop
+        entries = {
+            "trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}}
+        }
+        trace_entries = await self.trace_manager.is_entry_valid(entries)
+
+        tasks = [
+            self.trace_manager._spawn_trace(trace_id, trace_entries)
+            for trace_id in range(200)
+        ]
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=2)
+        assert len(self.trace_manager._results_queue) == 200
+        assert not self.trace_manager._running_traces
+
 
 class TestTraceManagerTheadTest:
     """Now, load all entries at once"""
@@ -411,23 +885,20 @@ class TestTraceManagerTheadTest:
         entries = {"trace": switch}
         trace_entries = TraceEntries()
         trace_entries.load_entries(entries)
-        self.trace_manager._request_queue = Queue()
         _ = await self.trace_manager.new_trace(trace_entries)
 
-        trace_thread = threading.Thread(target=self.trace_manager._run_traces)
         with patch.object(
             TraceManager, "is_tracing_running", side_effect=self.run_trace_once
         ):
-            trace_thread.start()
-            trace_thread.join()
+            await self.trace_manager._run_traces()
 
-        assert self.trace_manager._request_queue.async_q.qsize() == 0
+        assert self.trace_manager._request_queue.qsize() == 0
         assert self.trace_manager.number_pending_requests() == 0
 
     async def test_queue_probe_packet_error(self):
         """Test queue_probe_packet handle error."""
-        self.trace_manager._trace_pkt_in = {30001: MagicMock()}
-        self.trace_manager._trace_pkt_in[30001].async_q.put = AsyncMock()
+        waiter = asyncio.get_running_loop().create_future()
+        self.trace_manager._trace_pkt_in = {30001: (0, waiter)}
         mock_msg = (
             b"\01\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x88\xa8\x00\x01"
             b"\x81\x00\x00\x01\x08\x00E\x00\x00{\x00\x00\x00\x00\xff\x00\xb7~\x01"
@@ -436,8 +907,218 @@ class TestTraceManagerTheadTest:
             b"\x94\x93\x94)\x81\x94}\x94(\x8c\x0b_request_id\x94M1u\x8c\x05_step"
             b"\x94K\x00ub."
         )
-        eth = Ethernet()
-        eth.unpack(mock_msg)
-        await self.trace_manager.queue_probe_packet("event_mock", eth, 1, MagicMock())
+        await self.trace_manager.queue_probe_packet(
+            "event_mock", mock_msg, 1, MagicMock()
+        )
+
+        assert not waiter.done()
+        assert self.trace_manager.rest_list_stats()[
+            "number_of_unknown_probes"
+        ] == 1
+
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_msg"
+    )
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_packet"
+    )
+    async def test_queue_probe_packet(self, mock_parse, mock_parse_msg):
+        """Test queue_probe_packet resolves the waiter of its step."""
+        probe = ParsedProbe()
+        probe.msg = TraceMsg(30001, 2)
+        mock_parse.return_value = probe
+        mock_parse_msg.return_value = probe.msg
+        switch = MagicMock(dpid="00:00:00:00:00:00:00:01")
+        waiter = self.trace_manager.register_probe_waiter(30001, 2)
+
+        await self.trace_manager.queue_probe_packet("event_mock", "eth", 1, switch)
+
+        assert waiter.done()
+        assert waiter.result()["dpid"] == switch.dpid
+        assert waiter.result()["in_port"] == 1
+        assert waiter.result()["event"] == "event_mock"
+        assert waiter.result()["probe"] is probe
 
-        assert self.trace_manager._trace_pkt_in[30001].async_q.put.call_count == 0
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_msg"
+    )
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_packet"
+    )
+    async def test_queue_probe_packet_stale(self, mock_parse, mock_parse_msg):
+        """Test queue_probe_packet drops and counts stale probes."""
+        mock_parse_msg.return_value = TraceMsg(30001, 2)
+        switch = MagicMock(dpid="00:00:00:00:00:00:00:01")
+        waiter = self.trace_manager.register_probe_waiter(30001, 3)
+
+        # Late probe of a previous step
+        await self.trace_manager.queue_probe_packet("event_mock", "eth", 1, switch)
+        assert not waiter.done()
+
+        # Duplicated probe of a step already resolved
+        probe = ParsedProbe()
+        probe.msg = TraceMsg(30001, 3)
+        mock_parse.return_value = probe
+        mock_parse_msg.return_value = probe.msg
+        await self.trace_manager.queue_probe_packet("event_mock", "eth", 1, switch)
+        await self.trace_manager.queue_probe_packet("event_mock", "eth", 1, switch)
+        assert waiter.done()
+
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_stale_probes"] == 2
+        assert stats["number_of_unknown_probes"] == 0
+
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_packet"
+    )
+    async def test_queue_probe_packet_unknown(self, mock_parse):
+        """Test queue_probe_packet ignores probes nobody waits for,
+        without parsing the whole frame."""
+        pkt = TraceMsg(30001, 2).pack()
+
+        with patch(
+            "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+            ".parse_probe_msg",
+            return_value=TraceMsg.unpack(pkt),
+        ):
+            await self.trace_manager.queue_probe_packet(
+                "event_mock", "eth", 1, MagicMock()
+            )
+        assert not self.trace_manager._trace_pkt_in
+        assert self.trace_manager._total_unknown_probes == 1
+        mock_parse.assert_not_called()
+
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_msg"
+    )
+    async def test_queue_probe_packet_wrong_nonce(self, mock_parse_msg):
+        """Test queue_probe_packet ignores probes with another nonce."""
+        mock_parse_msg.return_value = TraceMsg(30001, 2, 1)
+        self.trace_manager._running_traces[30001] = MagicMock(nonce=2)
+        waiter = self.trace_manager.register_probe_waiter(30001, 2)
+
+        await self.trace_manager.queue_probe_packet(
+            "event_mock", "eth", 1, MagicMock()
+        )
+        assert not waiter.done()
+
+    @patch(
+        "napps.amlight.sdntrace.tracing.trace_manager.TraceManager"
+        ".parse_probe_packet"
+    )
+    async def test_queue_probe_packet_storm(self, mock_parse):
+        """Test queue_probe_packet drops PacketIns of a probe storm
+        before parsing the frame, also after the trace ended."""
+        pkt = (
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x88\xb5"
+            + TraceMsg(30001, 2, 1).pack()
+        )
+        self.trace_manager._running_traces[30001] = MagicMock(nonce=1, step=2)
+        waiter = self.trace_manager.register_probe_waiter(30001, 2)
+
+        with patch.object(settings, "PROBE_STORM_RATE", 0), \
+                patch.object(settings, "PROBE_STORM_BURST", 1):
+            await self.trace_manager.queue_probe_packet(
+                "event_mock", pkt, 1, MagicMock()
+            )
+            await self.trace_manager.queue_probe_packet(
+                "event_mock", pkt, 1, MagicMock()
+            )
+            assert waiter.done()
+            assert mock_parse.call_count == 1
+            stats = self.trace_manager.rest_list_stats()
+            assert stats["number_of_storm_probes"] == 1
+            assert stats["number_of_stale_probes"] == 0
+
+            # The probe keeps looping after the trace ended
+            self.trace_manager._release_slot(30001)
+            self.trace_manager.unregister_probe_waiter(30001, 2)
+            await self.trace_manager.queue_probe_packet(
+                "event_mock", pkt, 1, MagicMock()
+            )
+        assert mock_parse.call_count == 1
+        stats = self.trace_manager.rest_list_stats()
+        assert stats["number_of_storm_probes"] == 2
+        assert stats["number_of_unknown_probes"] == 0
+
+    def test_admit_probe(self):
+        """Test the PacketIns of a step above the storm rate are dropped."""
+        self.trace_manager._running_traces[30001] = MagicMock(nonce=7, step=2)
+
+        with patch.object(settings, "PROBE_STORM_RATE", 0), \
+                patch.object(settings, "PROBE_STORM_BURST", 2):
+            assert self.trace_manager.admit_probe(30001, 1, 7)
+            assert self.trace_manager.admit_probe(30001, 1, 7)
+            assert not self.trace_manager.admit_probe(30001, 1, 7)
+            assert not self.trace_manager.admit_probe(30001, 1, 7)
+            # Other steps have their own bucket
+            assert self.trace_manager.admit_probe(30001, 2, 7)
+            # Probes of traces not running are not limited here
+            for _ in range(3):
+                assert self.trace_manager.admit_probe(30002, 1, 7)
+
+        storms = self.trace_manager.get_probe_storms(30001)
+        assert len(storms) == 1
+        assert storms[0]["step"] == 1
+        assert storms[0]["packet_ins"] == 4
+        assert storms[0]["dropped"] == 2
+        assert storms[0]["rate"] > 0
+        assert not self.trace_manager.get_probe_storms(30002)
+
+    def test_admit_probe_forged(self):
+        """Test forged probes do not create buckets."""
+        self.trace_manager._running_traces[30001] = MagicMock(nonce=7, step=2)
+
+        for step in range(3, 1000):
+            assert self.trace_manager.admit_probe(30001, step, 7)
+        for step in range(3):
+            assert self.trace_manager.admit_probe(30001, step, 8)
+        assert not self.trace_manager._probe_buckets
+
+        # Ended traces only use the buckets they have
+        assert self.trace_manager.admit_probe(30001, 1, 7)
+        self.trace_manager._release_slot(30001)
+        assert self.trace_manager.admit_probe(30001, 2, 7)
+        assert list(self.trace_manager._probe_buckets[30001]) == [1]
+
+    def test_admit_probe_grace(self):
+        """Test the buckets of a trace are dropped after the grace
+        period following its end."""
+        self.trace_manager._running_traces[30001] = MagicMock(nonce=7, step=1)
+        assert self.trace_manager.admit_probe(30001, 1, 7)
+
+        with patch.object(settings, "PROBE_STORM_GRACE", 10):
+            self.trace_manager._release_slot(30001)
+        assert 30001 in self.trace_manager._probe_buckets
+
+        self.trace_manager._expire_probe_buckets(0)
+        assert 30001 in self.trace_manager._probe_buckets
+        self.trace_manager._expire_probe_buckets(float("inf"))
+        assert not self.trace_manager._probe_buckets
+        assert not self.trace_manager._probe_buckets_expiration
+
+    async def test_unregister_probe_waiter(self):
+        """Test unregister_probe_waiter cancels and removes the waiter."""
+        waiter = self.trace_manager.register_probe_waiter(30001, 0)
+        assert self.trace_manager.register_probe_waiter(30001, 0) is waiter
+        self.trace_manager.unregister_probe_waiter(30001, 0)
+        assert waiter.cancelled()
+        assert not self.trace_manager._trace_pkt_in
+
+    async def test_register_probe_waiter_next_step(self):
+        """Test a trace keeps a single slot, replaced on each step."""
+        waiter = self.trace_manager.register_probe_waiter(30001, 0)
+        next_waiter = self.trace_manager.register_probe_waiter(30001, 1)
+        assert waiter.cancelled()
+        assert self.trace_manager._trace_pkt_in == {30001: (1, next_waiter)}
+
+        # Unregistering an old step keeps the current one
+        self.trace_manager.unregister_probe_waiter(30001, 0)
+        assert not next_waiter.done()
+        assert 30001 in self.trace_manager._trace_pkt_in
@@ -0,0 +1,49 @@
+"""
+    Test tracing.trace_msg
+"""
+
+import pytest
+from napps.amlight.sdntrace.tracing.trace_msg import PROBE_HEADER, TraceMsg
+
+
+class TestTraceMsg:
+    """Test the TraceMsg probe header."""
+
+    def test_pack_unpack(self):
+        """Test a packed msg is decoded back."""
+        buff = TraceMsg(30001, 7, 0xCAFE).pack()
+        assert len(buff) == PROBE_HEADER.size
+
+        msg = TraceMsg.unpack(buff)
+        assert msg.request_id == 30001
+        assert msg.step == 7
+        assert msg.nonce == 0xCAFE
+
+    def test_unpack_offset(self):
+        """Test decoding a header in the middle of a buffer."""
+        buff = memoryview(b"\x00" * 4 + TraceMsg(30001, 1).pack() + b"\x00")
+        msg = TraceMsg.unpack(buff, 4)
+        assert msg.request_id == 30001
+        assert msg.step == 1
+
+    def test_unpack_invalid_magic(self):
+        """Test decoding a buffer without the probe magic."""
+        buff = b"\x00" * PROBE_HEADER.size
+        with pytest.raises(ValueError):
+            TraceMsg.unpack(buff)
+
+    def test_unpack_truncated(self):
+        """Test decoding a truncated buffer."""
+        buff = TraceMsg(30001, 1).pack()[:-1]
+        with pytest.raises(ValueError):
+            TraceMsg.unpack(buff)
+
+    def test_pack_invalid(self):
+        """Test packing values that do not fit in the header."""
+        with pytest.raises(ValueError):
+            TraceMsg(-1, 0).pack()
+
+    def test_invalid_nonce(self):
+        """Test setting an invalid nonce."""
+        with pytest.raises(ValueError):
+            TraceMsg(1, 0, "abc")
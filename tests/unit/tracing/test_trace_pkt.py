@@ -3,9 +3,9 @@
 """
 
 from unittest.mock import MagicMock, patch
-from pyof.foundation.network_types import Ethernet
 import pytest
 
+from napps.amlight.sdntrace.shared.extd_nw_types import internet_checksum
 from napps.amlight.sdntrace.tracing import trace_pkt
 from napps.amlight.sdntrace.shared.switches import Switches
 from napps.amlight.sdntrace.tracing.trace_entries import TraceEntries
@@ -44,6 +44,7 @@ class TestTracePkt:
     def setup_method(self):
         """Set up before each test method"""
         self.create_basic_switches(get_controller_mock())
+        trace_pkt.clear_probe_templates()
 
     @classmethod
     def create_basic_switches(cls, controller):
@@ -92,12 +93,10 @@ class TestTracePkt:
         assert entries["trace"]["switch"]["in_port"] == in_port
         assert (
             pkt == b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01"
-            b"\x81\x00\x00d\x08\x00E\x00\x00\x8f\x00\x00\x00\x00\xff\x06"
-            b"\xb7d\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00"
-            b"\x00\x00\x00\x00\x00\x00\x00P\x02\x00S\x86G\x00\x00\x80\x04"
-            b"\x95\\\x00\x00\x00\x00\x00\x00\x00\x8c(napps.amlight.sdntrace"
-            b".tracing.trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)\x81\x94}"
-            b"\x94(\x8c\x0b_request_id\x94M\xe7\x03\x8c\x05_step\x94K\tub."
+            b"\x81\x00\x00d\x08\x00E\x00\x008\x00\x00\x00\x00\xff\x06"
+            b"\xb7\xbb\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00"
+            b"\x00\x00\x00\x00\x00\x00\x00P\x02\x00SI\x0c\x00\x00"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x00"
         )
 
     @patch("napps.amlight.sdntrace.shared.extd_nw_types.randrange")
@@ -124,127 +123,303 @@ class TestTracePkt:
         assert entries["trace"]["switch"]["in_port"] == in_port
         assert (
             pkt == b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x81"
-            b"\x00\x00d\x08\x00E\x00\x00\x83\x00\x00\x00\x00\xff\x11\xb7e"
-            b"\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00o\xd6."
-            b"\x80\x04\x95\\\x00\x00\x00\x00\x00\x00\x00\x8c(napps.amlight"
-            b".sdntrace.tracing.trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94(\x8c\x0b_request_id\x94M\xe7\x03\x8c\x05_step"
-            b"\x94K\tub."
+            b"\x00\x00d\x08\x00E\x00\x00,\x00\x00\x00\x00\xff\x11\xb7\xbc"
+            b"\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00\x18\x99J"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x00"
         )
 
-    @patch("napps.amlight.sdntrace.shared.colors.Colors.get_switch_color")
-    def test_get_node_color_from_dpid(self, mock_switch_colors):
+    @pytest.mark.parametrize("nw_proto", [6, 17, 1])
+    @patch("napps.amlight.sdntrace.shared.extd_nw_types.randrange")
+    def test_probe_template_matches_full_pack(self, mock_rand, nw_proto):
+        """Test probes built from a template are equal to packing them."""
+        mock_rand.return_value = 0
+        entries = {
+            "trace": {
+                "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1},
+                "eth": {"dl_vlan": 100},
+                "ip": {"nw_proto": nw_proto},
+                "tp": {"tp_src": 1, "tp_dst": 2},
+            }
+        }
+        trace_entries = TraceEntries()
+        trace_entries.load_entries(entries)
+        color = {"color_value": "ee:ee:ee:ee:ee:01"}
+
+        template_frame = None
+        for step, vlan, pcp in [(0, 100, 0), (1, 200, 3), (7, 4095, 7)]:
+            trace_entries.dl_vlan = vlan
+            if pcp:
+                trace_entries.dl_vlan_pcp = pcp
+            _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color,
+                                                  70000 + step, step, step)
+            expected = trace_pkt._pack_trace_pkt(trace_entries, color,
+                                                 70000 + step, step, step)
+            assert pkt == expected
+            # Probes do not change the shared template frame
+            template = next(iter(trace_pkt._probe_templates.values()))
+            if template_frame is None:
+                template_frame = bytes(template._frame)
+            assert template._frame == template_frame
+        assert len(trace_pkt._probe_templates) == 1
+
+    def test_probe_template_without_vlan(self):
+        """Test entries with and without VLAN use different templates."""
+        trace_entries = TraceEntries()
+        trace_entries.load_entries({"trace": {"switch": {
+            "dpid": "00:00:00:00:00:00:00:01", "in_port": 1}}})
+        color = {"color_value": "ee:ee:ee:ee:ee:01"}
+
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 1, 0)
+        assert pkt == trace_pkt._pack_trace_pkt(trace_entries, color, 1, 0)
+        trace_entries.dl_vlan = 10
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 1, 1)
+        assert pkt[12:16] == b"\x81\x00\x00\x0a"
+        assert len(trace_pkt._probe_templates) == 2
+
+    @patch("napps.amlight.sdntrace.shared.extd_nw_types.randrange")
+    def test_probe_template_qinq(self, mock_rand):
+        """Test QinQ probes built from a template are equal to packing
+        them and are parsed back with the same VLAN stack."""
+        mock_rand.return_value = 0
+        trace_entries = TraceEntries()
+        trace_entries.load_entries({"trace": {
+            "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1},
+            "eth": {"vlans": [{"dl_vlan": 10, "tpid": 0x88A8},
+                              {"dl_vlan": 100}]},
+            "ip": {"nw_proto": 6},
+            "tp": {"tp_src": 1, "tp_dst": 2},
+        }})
+        color = {"color_value": "ee:ee:ee:ee:ee:01"}
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 1, 0)
+
+        # Swap of the C-tag and PCP change of the S-tag
+        trace_entries.vlans = [{"dl_vlan": 10, "dl_vlan_pcp": 2,
+                                "tpid": 0x88A8}, {"dl_vlan": 300}]
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 1, 1)
+        assert pkt == trace_pkt._pack_trace_pkt(trace_entries, color, 1, 1)
+        assert len(trace_pkt._probe_templates) == 1
+
+        probe = trace_pkt.parse_probe(pkt)
+        assert tuple(probe.vlans) == trace_entries.vlans
+        assert probe.msg.step == 1
+
+    @pytest.mark.parametrize("nw_proto", [6, 17, None])
+    @patch("napps.amlight.sdntrace.shared.extd_nw_types.randrange")
+    def test_probe_template_ipv6(self, mock_rand, nw_proto):
+        """Test IPv6 probes built from a template are equal to packing
+        them, have a valid checksum and are parsed back."""
+        mock_rand.return_value = 0
+        ip = {"nw_tos": 5}
+        trace = {
+            "switch": {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1},
+            "eth": {"dl_vlan": 100, "dl_type": 0x86DD},
+            "ip": ip,
+        }
+        if nw_proto:
+            ip["nw_proto"] = nw_proto
+            trace["tp"] = {"tp_src": 1, "tp_dst": 2}
+        trace_entries = TraceEntries()
+        trace_entries.load_entries({"trace": trace})
+        color = {"color_value": "ee:ee:ee:ee:ee:01"}
+
+        trace_pkt.generate_trace_pkt(trace_entries, color, 1, 0)
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 70000, 3, 9)
+        assert pkt == trace_pkt._pack_trace_pkt(trace_entries, color,
+                                                70000, 3, 9)
+
+        probe = trace_pkt.parse_probe(pkt)
+        assert probe.dl_type == 0x86DD
+        assert probe.nw_src == "2001:db8::1"
+        assert probe.nw_dst == "2001:db8::2"
+        assert probe.nw_tos == 5
+        assert probe.msg_offset == len(pkt) - 16
+        assert (probe.msg.request_id, probe.msg.step) == (70000, 3)
+        if nw_proto:
+            assert probe.nw_proto == nw_proto
+            assert (probe.tp_src, probe.tp_dst) == (1, 2)
+            segment = pkt[18 + 40:]
+            pseudo_header = (pkt[18 + 8:18 + 40] +
+                             len(segment).to_bytes(4, "big") +
+                             bytes([0, 0, 0, nw_proto]))
+            assert internet_checksum(pseudo_header + segment) == 0
+        else:
+            assert probe.nw_proto == 59
+
+    @patch("napps.amlight.sdntrace.tracing.trace_pkt.PROBE_TEMPLATES_MAX_SIZE",
+           2)
+    def test_probe_templates_eviction(self):
+        """Test the least recently used template is evicted."""
+        trace_entries = TraceEntries()
+        trace_entries.load_entries({"trace": {"switch": {
+            "dpid": "00:00:00:00:00:00:00:01", "in_port": 1}}})
+        for value in ("ee:ee:ee:ee:ee:01", "ee:ee:ee:ee:ee:02",
+                      "ee:ee:ee:ee:ee:01", "ee:ee:ee:ee:ee:03"):
+            trace_pkt.generate_trace_pkt(trace_entries,
+                                         {"color_value": value}, 1, 0)
+        colors = [key[0] for key in trace_pkt._probe_templates]
+        assert colors == ["ee:ee:ee:ee:ee:01", "ee:ee:ee:ee:ee:03"]
+
+    def test_generate_trace_pkt_nonce(self):
+        """Test the probe carries the tracer nonce."""
+        dpid = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        entries = {"trace": {"switch": dpid, "eth": {"dl_vlan": 100}}}
+
+        trace_entries = TraceEntries()
+        trace_entries.load_entries(entries)
+        color = {"color_value": "ee:ee:ee:ee:ee:01"}
+
+        _, pkt = trace_pkt.generate_trace_pkt(trace_entries, color, 999, 9, 1234)
+
+        msg = trace_pkt.parse_probe(pkt).msg
+        assert len(pkt) == 54
+        assert (msg.request_id, msg.step, msg.nonce) == (999, 9, 1234)
+
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    async def test_get_node_color_from_dpid(self, mock_switch_colors):
         """Test get color from dpid."""
         mock_switch_colors.return_value = "ee:ee:ee:ee:ee:01"
 
-        switch, color = trace_pkt._get_node_color_from_dpid("00:00:00:00:00:00:00:01")
+        switch, color = await trace_pkt._get_node_color_from_dpid(
+            "00:00:00:00:00:00:00:01"
+        )
 
         assert switch.dpid == "00:00:00:00:00:00:00:01"
         assert color == "ee:ee:ee:ee:ee:01"
         mock_switch_colors.assert_called_once()
 
-    def test_get_node_color_unknown_dpid(self):
+    async def test_get_node_color_unknown_dpid(self):
         """Test get color from unknown dpid."""
-        switch, color = trace_pkt._get_node_color_from_dpid("99:99:99:99:99:99:99:99")
+        switch, color = await trace_pkt._get_node_color_from_dpid(
+            "99:99:99:99:99:99:99:99"
+        )
 
         assert switch == 0
         assert color == 0
 
-    def test_get_vlan_from_pkt(self):
-        """Test get color from unknown dpid."""
+    def test_parse_probe_qinq(self):
+        """Test parse_probe with stacked VLAN tags."""
         pkt = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x81\x00\x00d\x08\x00E\x00\x00p\x00\x00"
-            b"\x00\x00\xff\x00\xb7\x89\x01\x01\x01\x01\x01"
-            b"\x01\x01\x02\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x88\xa8\xa0\x0a"
+            b"\x81\x00\x00\x64\x88\xb5]|\x01\x00\x00\x00\x03\xe7"
+            b"\x00\x00\x00\t\x00\x00\x00\x00"
         )
-
-        vid = trace_pkt._get_vlan_from_pkt(pkt)
-
-        assert vid == 100
-
-    def test_process_packet(self):
-        """Test process packet to find the trace message."""
+        probe = trace_pkt.parse_probe(pkt)
+        assert probe.vlans == [(0x88A8, 10, 5), (0x8100, 100, 0)]
+        assert probe.dl_vlan == 10
+        assert probe.dl_vlan_pcp == 5
+        assert probe.dl_type == 0x88B5
+        assert probe.nw_proto is None
+        assert probe.msg_offset == 22
+        assert probe.msg.request_id == 999
+
+    def test_parse_probe(self):
+        """Test parse_probe finds the header fields and trace message."""
         pkt = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x81\x00\x00d\x08\x00E\x00\x00p\x00\x00"
-            b"\x00\x00\xff\x00\xb7\x89\x01\x01\x01\x01\x01"
-            b"\x01\x01\x02\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x81"
+            b"\x00\x00d\x08\x00E\x00\x00$\x00\x00\x00\x00\xff\x00\xb7\xd5"
+            b"\x01\x01\x01\x01\x01\x01\x01\x02]|\x01\x00\x00\x00\x03\xe7"
+            b"\x00\x00\x00\t\x00\x00\x00\x00"
         )
-        expected = (
-            b"\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
-        )
-
-        ethernet = Ethernet()
-        ethernet.unpack(pkt)
 
-        trace_msg = trace_pkt.process_packet(ethernet)
-        assert trace_msg == expected
-
-    def test_process_packet_tcp(self):
-        """Test process TCP packet to find the trace message."""
+        probe = trace_pkt.parse_probe(pkt)
+        assert probe.dl_dst == "ca:fe:ca:fe:ca:fe"
+        assert probe.dl_src == "ee:ee:ee:ee:ee:01"
+        assert probe.dl_vlan == 100
+        assert probe.dl_vlan_pcp == 0
+        assert probe.dl_type == 0x0800
+        assert probe.nw_src == "1.1.1.1"
+        assert probe.nw_dst == "1.1.1.2"
+        assert probe.nw_proto == 0
+        assert probe.tp_src is None
+        assert probe.msg.request_id == 999
+        assert probe.msg.step == 9
+        assert probe.msg.nonce == 0
+
+    def test_parse_probe_tcp(self):
+        """Test parse_probe with a TCP probe."""
         pkt = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x81\x00\x00d\x08\x00E\x00\x00\x84\x00\x00\x00"
-            b"\x00\xff\x06\xb7o\x01\x01\x01\x01\x01\x01\x01\x02"
-            b"\x00\x01\x00\x02\x00\x00\x00\x00\x00\x00\x00\x00P"
-            b"\x02\x00\x00\xb5\x9f\x00\x00\x80\x04\x95Q\x00\x00"
-            b"\x00\x00\x00\x00\x00\x8c(napps.amlight.sdntrace."
-            b"tracing.trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7\x03sb."
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01"
+            b"\x81\x00\x00d\x08\x00E\x00\x008\x00\x00\x00\x00\xff\x06"
+            b"\xb7\xbb\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00"
+            b"\x00\x00\x00\x00\x00\x00\x00P\x02\x00SI\x0c\x00\x00"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x00"
         )
-        expected = (
-            b"\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
+        probe = trace_pkt.parse_probe(pkt)
+        assert probe.nw_proto == 6
+        assert (probe.tp_src, probe.tp_dst) == (1, 2)
+        assert probe.msg_offset == 58
+        assert probe.msg.request_id == 999
+        assert probe.msg.step == 9
+
+    def test_parse_probe_udp(self):
+        """Test parse_probe with an UDP probe."""
+        pkt = (
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x81"
+            b"\x00\x00d\x08\x00E\x00\x00,\x00\x00\x00\x00\xff\x11\xb7\xbc"
+            b"\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00\x18\x99J"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x00"
         )
-        ethernet = Ethernet()
-        ethernet.unpack(pkt)
-        trace_msg = trace_pkt.process_packet(ethernet)
-        assert trace_msg == expected
-
-    def test_process_packet_udp(self):
-        """Test process UDP packet to find the trace message."""
+        probe = trace_pkt.parse_probe(pkt)
+        assert probe.nw_proto == 17
+        assert (probe.tp_src, probe.tp_dst) == (1, 2)
+        assert probe.msg_offset == 46
+        assert probe.msg.request_id == 999
+        assert probe.msg.step == 9
+
+    def test_parse_probe_not_a_probe(self):
+        """Test parse_probe with a payload that is not a probe."""
         pkt = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x81\x00\x00d\x08\x00E\x00\x00x\x00\x00\x00\x00"
-            b"\xff\x11\xb7p\x01\x01\x01\x01\x01\x01\x01\x02\x00"
-            b"\x01\x00\x02\x00\x08\x05\x9b\x80\x04\x95Q\x00\x00"
-            b"\x00\x00\x00\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)\x81\x94}\x94"
-            b"\x8c\x0b_request_id\x94M\xe7\x03sb."
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x81"
+            b"\x00\x00d\x08\x00E\x00\x00$\x00\x00\x00\x00\xff\x00\xb7\xd5"
+            b"\x01\x01\x01\x01\x01\x01\x01\x02testdata"
         )
-        expected = (
-            b"\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
+        with pytest.raises(ValueError):
+            trace_pkt.parse_probe(pkt)
+
+    @pytest.mark.parametrize("length", [10, 16, 30, 40, 50])
+    def test_parse_probe_truncated(self, length):
+        """Test parse_probe with a truncated TCP probe."""
+        pkt = (
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01"
+            b"\x81\x00\x00d\x08\x00E\x00\x008\x00\x00\x00\x00\xff\x06"
+            b"\xb7\xbb\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00"
+            b"\x00\x00\x00\x00\x00\x00\x00P\x02\x00SI\x0c\x00\x00"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x00"
         )
-        ethernet = Ethernet()
-        ethernet.unpack(pkt)
-        trace_msg = trace_pkt.process_packet(ethernet)
-        assert trace_msg == expected
+        with pytest.raises(ValueError):
+            trace_pkt.parse_probe(pkt[:length])
+
+    @pytest.mark.parametrize(
+        "pkt",
+        [
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x88\xa8\xa0\x0a"
+            b"\x81\x00\x00\x64\x88\xb5]|\x01\x00\x00\x00\x03\xe7"
+            b"\x00\x00\x00\t\x00\x00\x00\x01",
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01"
+            b"\x81\x00\x00d\x08\x00E\x00\x008\x00\x00\x00\x00\xff\x06"
+            b"\xb7\xbb\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00"
+            b"\x00\x00\x00\x00\x00\x00\x00P\x02\x00SI\x0c\x00\x00"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x01",
+            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee\x01\x81"
+            b"\x00\x00d\x08\x00E\x00\x00,\x00\x00\x00\x00\xff\x11\xb7\xbc"
+            b"\x01\x01\x01\x01\x01\x01\x01\x02\x00\x01\x00\x02\x00\x18\x99J"
+            b"]|\x01\x00\x00\x00\x03\xe7\x00\x00\x00\t\x00\x00\x00\x01",
+        ],
+    )
+    def test_parse_probe_msg(self, pkt):
+        """Test parse_probe_msg decodes the same TraceMsg as parse_probe."""
+        msg = trace_pkt.parse_probe_msg(pkt)
+        assert (msg.request_id, msg.step, msg.nonce) == (999, 9, 1)
+        assert msg.pack() == trace_pkt.parse_probe(pkt).msg.pack()
+
+        with pytest.raises(ValueError):
+            trace_pkt.parse_probe_msg(pkt[:-1])
 
     @patch("napps.amlight.sdntrace.tracing.trace_pkt._get_node_color_from_dpid")
-    def test_prepare_next_packet(self, mock_get_color):
+    async def test_prepare_next_packet(self, mock_get_color):
         """Test trace prepare next packet."""
         color_switch = MagicMock()
-        color_switch.dpid = "00:00:00:00:00:00:00:01"
+        color_switch.dpid = "00:00:00:00:00:00:00:02"
         mock_get_color.return_value = [color_switch, "ee:ee:ee:ee:ee:01"]
 
         eth = {"dl_vlan": 100}
@@ -255,43 +430,28 @@ class TestTracePkt:
         trace_entries = TraceEntries()
         trace_entries.load_entries(entries)
 
-        raw = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x81\x00\x00d\x08\x00E\x00\x00p\x00\x00"
-            b"\x00\x00\xff\x00\xb7\x89\x01\x01\x01\x01\x01"
-            b"\x01\x01\x02\x80\x04\x95Q\x00\x00\x00\x00\x00"
-            b"\x00\x00\x8c(napps.amlight.sdntrace.tracing."
-            b"trace_msg\x94\x8c\x08TraceMsg\x94\x93\x94)"
-            b"\x81\x94}\x94\x8c\x0b_request_id\x94M\xe7"
-            b"\x03sb."
+        # dl_dst, VLAN and nw_dst rewritten by the previous switch
+        probe = trace_pkt.parse_probe(
+            b"\x00\x00\x00\x00\x00\xaa\xee\xee\xee\xee\xee\x01\x81"
+            b"\x00\x00\xc8\x08\x00E\x00\x00$\x00\x00\x00\x00\xff\x00\x00\x00"
+            b"\x01\x01\x01\x01\n\x00\x00\x02]|\x01\x00\x00\x00\x03\xe7"
+            b"\x00\x00\x00\t\x00\x00\x00\x00"
         )
-
-        packet_in_msg = MagicMock()
-        packet_in_msg.data.value = raw
-        packet_in_msg.in_port.value = 1
-        packet_in_msg.header.version = 1
-
-        event = MagicMock()
-        event.source.switch = "00:00:00:00:00:00:00:02"
-        event.content = {"message": packet_in_msg}
-
-        pkt_in = {
-            "dpid": "00:00:00:00:00:00:00:01",
-            "in_port": 1,
-            "msg": "",
-            "ethernet": "",
-            "event": event,
-        }
-        result = {"dpid": pkt_in["dpid"], "port": pkt_in["in_port"]}
+        result = {"dpid": "00:00:00:00:00:00:00:02", "port": 3}
 
         # result = [result_trace, result_color, result_switch]
-        result = trace_pkt.prepare_next_packet(trace_entries, result, event)
+        result = await trace_pkt.prepare_next_packet(trace_entries, result, probe)
         assert result[0] == trace_entries
-        assert result[1] == (mock_get_color())[1]
+        assert result[0].dpid == "00:00:00:00:00:00:00:02"
+        assert result[0].in_port == 3
+        assert result[0].dl_vlan == 200
+        assert result[0].dl_dst == "00:00:00:00:00:aa"
+        assert result[0].nw_dst == "10.0.0.2"
+        assert result[1] == "ee:ee:ee:ee:ee:01"
         assert result[2].dpid == color_switch.dpid
 
     @patch("napps.amlight.sdntrace.tracing.trace_pkt._get_node_color_from_dpid")
-    def test_prepare_next_packet_no_vlan(self, mock_get_color):
+    async def test_prepare_next_packet_no_vlan(self, mock_get_color):
         """Test trace prepare next packet."""
         color_switch = MagicMock()
         color_switch.dpid = "00:00:00:00:00:00:00:01"
@@ -305,28 +465,14 @@ class TestTracePkt:
         trace_entries = TraceEntries()
         trace_entries.load_entries(entries)
 
-        raw = (
-            b"\xca\xfe\xca\xfe\xca\xfe\xee\xee\xee\xee\xee"
-            b"\x01\x08\x00E\x14\x00\x84\x00\x00\x00\x00\xff"
-            b"\x06\xbb]\x00\x00\x00\x01\x00\x00\x00\x02\x00"
-            b"\x01\x00\x02\x19,Jh\x00\x00\x00\x00P\x02\x00"
-            b"\x00\xe4\xbd\x00\x00\x80\x04\x95Q\x00\x00\x00"
-            b"\x00\x00\x00\x00\x8c(napps.amlight.sdntrace."
-            b"tracing.trace_msg\x94\x8c\x08TraceMsg\x94\x93"
-            b"\x94)\x81\x94}\x94\x8c\x0b_request_id\x94M6usb."
-        )
-
-        packet_in_msg = MagicMock()
-        packet_in_msg.data.value = raw
-        packet_in_msg.in_port.value = 1
-        packet_in_msg.header.version = 1
-
-        event = MagicMock()
-        event.source.switch = "00:00:00:00:00:00:00:02"
-        event.content = {"message": packet_in_msg}
+        result = {"dpid": "00:00:00:00:00:00:00:01", "port": 1}
 
-        result = {"dpid": "00:00:00:00:00:00:00:01"}
+        probe = trace_pkt.parse_probe(trace_pkt._pack_trace_pkt(
+            trace_entries, {"color_value": "ee:ee:ee:ee:ee:01"}, 999, 9
+        ))
 
-        result = trace_pkt.prepare_next_packet(trace_entries, result, event)
+        result = await trace_pkt.prepare_next_packet(trace_entries, result, probe)
 
         assert result[0].dl_vlan == 0
+        assert result[0].nw_tos == 5
+        assert (result[0].tp_src, result[0].tp_dst) == (1, 2)
@@ -3,13 +3,16 @@
 """
 
 from unittest.mock import MagicMock, patch
+import asyncio
 import time
 import pytest
 from napps.amlight.sdntrace.tracing.trace_msg import TraceMsg
+from napps.amlight.sdntrace.tracing.trace_pkt import ParsedProbe
 from napps.amlight.sdntrace.tracing.trace_manager import TraceManager
 from napps.amlight.sdntrace.tracing.tracer import TracePath
 from napps.amlight.sdntrace.tracing.rest import FormatRest
 from napps.amlight.sdntrace.shared.switches import Switches
+from napps.amlight.sdntrace.shared.rate_limit import ProbePacer
 
 from kytos.lib.helpers import get_controller_mock
 
@@ -81,7 +84,7 @@ class TestTracePath:
         entries = {"trace": switch}
         trace_entries = await self.trace_manager.is_entry_valid(entries)
         tracer = TracePath(self.trace_manager, trace_id, trace_entries)
-        tracer.tracepath()
+        await tracer.tracepath()
 
         # Retrieve trace result created from tracepath
         result = self.trace_manager.get_result(trace_id)
@@ -95,8 +98,8 @@ class TestTracePath:
         assert result["request"]["trace"]["switch"]["dpid"] == dpid["dpid"]
         assert result["request"]["trace"]["switch"]["in_port"] == dpid["in_port"]
         assert result["request"]["trace"]["eth"]["dl_vlan"] == eth["dl_vlan"]
-        assert mock_switch_colors.call_count == 1
-        assert mock_aswitch_colors.call_count == 1
+        assert mock_switch_colors.call_count == 0
+        assert mock_aswitch_colors.call_count == 2
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
     @patch("napps.amlight.sdntrace.shared.colors.Colors.get_switch_color")
@@ -145,7 +148,7 @@ class TestTracePath:
         mock_trace_loop.side_effect = wrap_tracepath_loop
 
         # Execute tracepath
-        tracer.tracepath()
+        await tracer.tracepath()
 
         # Retrieve trace result created from tracepath
         result = self.trace_manager.get_result(trace_id)
@@ -163,8 +166,8 @@ class TestTracePath:
         assert result["request"]["trace"]["switch"]["dpid"] == dpid["dpid"]
         assert result["request"]["trace"]["switch"]["in_port"] == dpid["in_port"]
         assert result["request"]["trace"]["eth"]["dl_vlan"] == eth["dl_vlan"]
-        assert mock_switch_colors.call_count == 1
-        assert mock_aswitch_colors.call_count == 1
+        assert mock_switch_colors.call_count == 0
+        assert mock_aswitch_colors.call_count == 2
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
     @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
@@ -196,9 +199,15 @@ class TestTracePath:
         pkt_in["dpid"] = "00:00:00:00:00:00:00:01"
         pkt_in["in_port"] = 1
         pkt_in["msg"] = msg
-        pkt_in["ethernet"] = "fake_ethernet_object"
+        pkt_in["probe"] = "fake_probe_object"
         pkt_in["event"] = "fake_event_object"
-        self.trace_manager._trace_pkt_in[msg.request_id].sync_q.put(pkt_in)
+
+        # The PacketIn arrives right after the PacketOut is sent
+        def wrap_send_packet_out(*_args):
+            _, waiter = self.trace_manager._trace_pkt_in[msg.request_id]
+            waiter.set_result(pkt_in)
+
+        mock_send_packet_out.side_effect = wrap_send_packet_out
 
         # Trace id to recover the result
         trace_id = 111
@@ -215,13 +224,17 @@ class TestTracePath:
         in_port = 1
         probe_pkt = MagicMock()
 
-        result = tracer.send_trace_probe(switch_obj, in_port, probe_pkt)
+        start_time = time.time()
+        result = await tracer.send_trace_probe(switch_obj, in_port, probe_pkt)
+        actual_time = time.time() - start_time
 
         mock_send_packet_out.assert_called_once()
+        assert actual_time < trace_entries.step_timeout, "Trace was too slow."
 
         assert result[0]["dpid"] == "00:00:00:00:00:00:00:01"
         assert result[0]["port"] == 1
-        assert result[1] == "fake_event_object"
+        assert result[1] == "fake_probe_object"
+        assert not self.trace_manager._trace_pkt_in
         mock_aswitch_colors.assert_called_once()
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
@@ -267,7 +280,7 @@ class TestTracePath:
 
         expected_time = timeout * 3
         start_time = time.time()
-        result = tracer.send_trace_probe(switch_obj, in_port, probe_pkt)
+        result = await tracer.send_trace_probe(switch_obj, in_port, probe_pkt)
         actual_time = time.time() - start_time
 
         assert mock_send_packet_out.call_count == 3
@@ -303,7 +316,7 @@ class TestTracePath:
 
         tracer = TracePath(self.trace_manager, trace_id, trace_entries)
 
-        # Patch tracepath loop to create a second result item
+        # Each trace step is checked as it is added
         rest = FormatRest()
         rest.add_trace_step(
             tracer.trace_result,
@@ -311,18 +324,21 @@ class TestTracePath:
             dpid="00:00:00:00:00:00:00:01",
             port=1,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
             dpid="00:00:00:00:00:00:00:02",
             port=2,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
             dpid="00:00:00:00:00:00:00:03",
             port=3,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
@@ -333,6 +349,11 @@ class TestTracePath:
         result = tracer.check_loop()
         mock_aswitch_colors.assert_called_once()
         assert result is True
+        assert tracer.loop_cycle == [
+            {"dpid": "00:00:00:00:00:00:00:01", "port": 1},
+            {"dpid": "00:00:00:00:00:00:00:02", "port": 2},
+            {"dpid": "00:00:00:00:00:00:00:03", "port": 3},
+        ]
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
     @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
@@ -360,7 +381,7 @@ class TestTracePath:
 
         tracer = TracePath(self.trace_manager, trace_id, trace_entries)
 
-        # Patch tracepath loop to create a second result item
+        # Each trace step is checked as it is added
         rest = FormatRest()
         rest.add_trace_step(
             tracer.trace_result,
@@ -368,6 +389,7 @@ class TestTracePath:
             dpid="00:00:00:00:00:00:00:01",
             port=1,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
@@ -379,6 +401,51 @@ class TestTracePath:
         mock_aswitch_colors.assert_called_once()
         assert result == 0
 
+    @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
+    @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
+    async def test_check_loop_vlan_translation(
+        self, mock_get_switch, mock_aswitch_colors
+    ):
+        """Test check_loop with a port visited again with another VLAN."""
+        mock_aswitch_colors.return_value = "ee:ee:ee:ee:ee:01"
+
+        def wrap_get_switch(dpid):
+            switch = MagicMock()
+            switch.dpid = dpid
+            return switch
+
+        mock_get_switch.side_effect = wrap_get_switch
+
+        eth = {"dl_vlan": 100, "dl_type": 2048}
+        dpid = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        entries = {"trace": {"switch": dpid, "eth": eth}}
+        trace_entries = await self.trace_manager.is_entry_valid(entries)
+        tracer = TracePath(self.trace_manager, 111, trace_entries)
+
+        probes = []
+        for vlan in (100, 200, 100):
+            probe = ParsedProbe()
+            probe.vlans = [(0x8100, vlan, 0)]
+            probes.append(probe)
+
+        rest = FormatRest()
+        for step, (dpid, port) in enumerate([("00:00:00:00:00:00:00:01", 1),
+                                             ("00:00:00:00:00:00:00:02", 2)]):
+            rest.add_trace_step(tracer.trace_result, trace_type="trace",
+                                dpid=dpid, port=port)
+            assert tracer.check_loop(probes[step]) == 0
+
+        # Same port, translated VLAN
+        rest.add_trace_step(tracer.trace_result, trace_type="trace",
+                            dpid="00:00:00:00:00:00:00:01", port=1)
+        assert tracer.check_loop(probes[1]) == 0
+
+        rest.add_trace_step(tracer.trace_result, trace_type="trace",
+                            dpid="00:00:00:00:00:00:00:01", port=1)
+        assert tracer.check_loop(probes[2]) is True
+        assert len(tracer.loop_cycle) == 3
+        assert len(tracer.visited) == 3
+
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
     @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
     async def test_check_loop_port_different(
@@ -407,7 +474,7 @@ class TestTracePath:
 
         tracer = TracePath(self.trace_manager, trace_id, trace_entries)
 
-        # Patch tracepath loop to create a second result item
+        # Each trace step is checked as it is added
         rest = FormatRest()
         rest.add_trace_step(
             tracer.trace_result,
@@ -415,12 +482,14 @@ class TestTracePath:
             dpid="00:00:00:00:00:00:00:01",
             port=1,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
             dpid="00:00:00:00:00:00:00:02",
             port=2,
         )
+        assert tracer.check_loop() == 0
         rest.add_trace_step(
             tracer.trace_result,
             trace_type="trace",
@@ -457,7 +526,7 @@ class TestTracePath:
 
         mock_probe.return_value = [
             {"dpid": "00:00:00:00:00:00:00:01", "port": 1},
-            "fake_event_object",
+            ParsedProbe(),
         ]
 
         # Trace id to recover the result
@@ -474,7 +543,7 @@ class TestTracePath:
 
         # Mock the next packt to stop the trace loop
         # pylint: disable=unused-argument
-        def wrap_next_packet(entries, result, packet_in):
+        def wrap_next_packet(entries, result, probe):
             tracer.trace_ended = True
             return "", "", ""
 
@@ -483,7 +552,7 @@ class TestTracePath:
         color = {"color_field": "dl_src", "color_value": "ee:ee:ee:ee:01:2c"}
 
         # Execute tracepath
-        tracer.tracepath_loop(trace_entries, color, switch)
+        await tracer.tracepath_loop(trace_entries, color, switch)
         result = tracer.trace_result
 
         mock_probe.assert_called_once()
@@ -511,7 +580,7 @@ class TestTracePath:
 
         mock_get_switch.side_effect = wrap_get_switch
 
-        mock_probe.return_value = ["timeout", "fake_event_object"]
+        mock_probe.return_value = ["timeout", False]
 
         # Trace id to recover the result
         trace_id = 111
@@ -527,7 +596,7 @@ class TestTracePath:
 
         # Execute tracepath
         tracer = TracePath(self.trace_manager, trace_id, trace_entries)
-        tracer.tracepath_loop(trace_entries, color, switch)
+        await tracer.tracepath_loop(trace_entries, color, switch)
 
         result = tracer.trace_result
 
@@ -564,7 +633,7 @@ class TestTracePath:
 
         mock_probe.return_value = [
             {"dpid": "00:00:00:00:00:00:00:01", "port": 1},
-            "fake_event_object",
+            ParsedProbe(),
         ]
 
         # Trace id to recover the result
@@ -581,7 +650,7 @@ class TestTracePath:
 
         # Mock the next packt to stop the trace loop
         # pylint: disable=unused-argument
-        def wrap_next_packet(entries, result, packet_in):
+        def wrap_next_packet(entries, result, probe):
             tracer.trace_ended = True
             return "", "", ""
 
@@ -590,10 +659,11 @@ class TestTracePath:
         color = {"color_field": "dl_src", "color_value": "ee:ee:ee:ee:01:2c"}
 
         # Execute tracepath
-        tracer.tracepath_loop(trace_entries, color, switch)
+        await tracer.tracepath_loop(trace_entries, color, switch)
         result = tracer.trace_result
 
-        mock_check_loop.assert_called_once()
+        # Starting state and first trace step
+        assert mock_check_loop.call_count == 2
         mock_next_packet.assert_not_called()
         mock_probe.assert_called_once()
         assert mock_get_switch.call_count == 3
@@ -604,12 +674,17 @@ class TestTracePath:
 
     @patch("napps.amlight.sdntrace.shared.colors.Colors.aget_switch_color")
     @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
-    async def test_get_packet_in_empty(
+    @patch("napps.amlight.sdntrace.tracing.tracer.TracePath.send_trace_probe")
+    @patch("napps.amlight.sdntrace.tracing.tracer.prepare_next_packet")
+    async def test_tracepath_loop_reports_cycle(
         self,
+        mock_next_packet,
+        mock_probe,
         mock_get_switch,
         mock_aswitch_colors,
     ):
-        """Test get_packet_in when no packet in was caught."""
+        """Test the loop report has the cycle steps and its length."""
+        mock_aswitch_colors.return_value = "ee:ee:ee:ee:ee:01"
 
         def wrap_get_switch(dpid):
             switch = MagicMock()
@@ -617,27 +692,139 @@ class TestTracePath:
             return switch
 
         mock_get_switch.side_effect = wrap_get_switch
-        mock_aswitch_colors.return_value = "ee:ee:ee:ee:ee:01"
-        trace_id = 111
+        probe = ParsedProbe()
+        mock_probe.side_effect = [
+            ({"dpid": "00:00:00:00:00:00:00:02", "port": 2}, probe),
+            ({"dpid": "00:00:00:00:00:00:00:03", "port": 3}, probe),
+            ({"dpid": "00:00:00:00:00:00:00:02", "port": 2}, probe),
+        ]
+
         eth = {"dl_vlan": 100}
         dpid = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
-        switch = {"switch": dpid, "eth": eth}
-        entries = {"trace": switch}
+        entries = {"trace": {"switch": dpid, "eth": eth}}
         trace_entries = await self.trace_manager.is_entry_valid(entries)
-        tracer = TracePath(self.trace_manager, trace_id, trace_entries)
+        tracer = TracePath(self.trace_manager, 111, trace_entries)
+        color = {"color_field": "dl_src", "color_value": "ee:ee:ee:ee:01:2c"}
+        mock_next_packet.side_effect = lambda entries, result, probe: (
+            entries, color, wrap_get_switch(result["dpid"])
+        )
+        tracer.rest.add_trace_step(tracer.trace_result, trace_type="starting",
+                                   dpid="00:00:00:00:00:00:00:01", port=1)
+
+        await tracer.tracepath_loop(trace_entries, color, tracer.init_switch)
+
+        last = tracer.trace_result[-1]
+        assert last["type"] == "last"
+        assert last["reason"] == "loop"
+        assert last["cycle_length"] == 2
+        assert last["cycle"] == [
+            {"dpid": "00:00:00:00:00:00:00:02", "port": 2},
+            {"dpid": "00:00:00:00:00:00:00:03", "port": 3},
+        ]
+        assert mock_probe.call_count == 3
+
+    @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
+    @patch("napps.amlight.sdntrace.tracing.tracer.send_packet_out")
+    async def test_send_trace_probe_stop_traces(
+        self, mock_send_packet_out, mock_get_switch
+    ):
+        """Test stop_traces wakes up a tracer waiting for a PacketIn."""
+        mock_get_switch.return_value = True
+        initial_entries = MagicMock(dpid="00:01", timeout=10, step_timeout=0.5)
+        tracer = TracePath(self.trace_manager, 3001, initial_entries)
+        self.trace_manager._running_traces[3001] = tracer
 
-        # No packetIn
-        self.trace_manager._trace_pkt_in = {}
-        assert tracer.get_packet_in() is None
+        task = asyncio.create_task(
+            tracer.send_trace_probe(MagicMock(), 1, "probe_mock")
+        )
+        await asyncio.sleep(0.1)
+        self.trace_manager.stop_traces()
+        result, packet_in = await asyncio.wait_for(task, timeout=1)
+
+        mock_send_packet_out.assert_called_once()
+        assert result == "pre-ended"
+        assert packet_in is False
+        assert not self.trace_manager._trace_pkt_in
 
     @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
-    def test_send_trace_probe_pre_ended(self, mock_get_switch):
+    async def test_send_trace_probe_pre_ended(self, mock_get_switch):
         """Test send_trace_probe when trace ended prematurely."""
         mock_get_switch.return_value = True
-        initial_entries = MagicMock(dpid="00:01", step_timeout=0.5)
+        initial_entries = MagicMock(dpid="00:01", timeout=0.5, step_timeout=0.5)
         tracer = TracePath(self.trace_manager, 3001, initial_entries)
 
         tracer.trace_ended = True
-        result, packet_in = tracer.send_trace_probe("switch_mock", 1, "probe_mock")
+        result, packet_in = await tracer.send_trace_probe(
+            MagicMock(), 1, "probe_mock"
+        )
         assert result == "pre-ended"
         assert packet_in is False
+
+    @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
+    @patch("napps.amlight.sdntrace.tracing.tracer.send_packet_out")
+    async def test_send_trace_probe_in_flight_limit(
+        self, mock_send_packet_out, mock_get_switch
+    ):
+        """Test probes sent to a switch wait for its in-flight slots."""
+        mock_get_switch.return_value = True
+        self.trace_manager.probe_pacer = ProbePacer(0, 1, 1)
+        switch = MagicMock(dpid="00:00:00:00:00:00:00:01")
+        initial_entries = MagicMock(dpid="00:01", timeout=10, step_timeout=0.5)
+        tracers = [TracePath(self.trace_manager, r_id, initial_entries)
+                   for r_id in (3001, 3002)]
+        for tracer in tracers:
+            self.trace_manager._running_traces[tracer.id] = tracer
+        tasks = [asyncio.create_task(tracer.send_trace_probe(switch, 1, "pkt"))
+                 for tracer in tracers]
+        await asyncio.sleep(0.05)
+        assert mock_send_packet_out.call_count == 1
+
+        # The first probe gets its PacketIn, the second one is sent
+        _, waiter = self.trace_manager._trace_pkt_in[3001]
+        waiter.set_result({"dpid": switch.dpid, "in_port": 2, "probe": None})
+        await asyncio.sleep(0.05)
+        assert mock_send_packet_out.call_count == 2
+
+        self.trace_manager.stop_traces()
+        results = await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+        assert results[0][0] == {"dpid": switch.dpid, "port": 2}
+        assert results[1][0] == "pre-ended"
+
+    @patch("napps.amlight.sdntrace.shared.switches.Switches.get_switch")
+    @patch("napps.amlight.sdntrace.tracing.tracer.send_packet_out")
+    async def test_send_trace_probe_retries_free_slot(
+        self, mock_send_packet_out, mock_get_switch
+    ):
+        """Test retries of an unanswered probe do not hold the in-flight
+        slot of the switch."""
+        mock_get_switch.return_value = True
+        self.trace_manager.probe_pacer = ProbePacer(0, 1, 1)
+        switch = MagicMock(dpid="00:00:00:00:00:00:00:01")
+        last_hop = TracePath(self.trace_manager, 3001,
+                             MagicMock(dpid="00:01", timeout=0.1,
+                                       step_timeout=0.1))
+        other = TracePath(self.trace_manager, 3002,
+                          MagicMock(dpid="00:01", timeout=10,
+                                    step_timeout=0.5))
+        for tracer in (last_hop, other):
+            self.trace_manager._running_traces[tracer.id] = tracer
+
+        last_hop_task = asyncio.create_task(
+            last_hop.send_trace_probe(switch, 1, "pkt")
+        )
+        await asyncio.sleep(0.01)
+        other_task = asyncio.create_task(
+            other.send_trace_probe(switch, 1, "pkt")
+        )
+        await asyncio.sleep(0.05)
+        assert mock_send_packet_out.call_count == 1
+
+        # After the first timeout, the other probe gets the slot
+        await asyncio.sleep(0.1)
+        assert mock_send_packet_out.call_count == 3
+        assert not last_hop_task.done()
+
+        result = await asyncio.wait_for(last_hop_task, timeout=1)
+        assert result == ("timeout", False)
+        self.trace_manager.stop_traces()
+        assert (await asyncio.wait_for(other_task, timeout=1))[0] == "pre-ended"
@@ -0,0 +1,138 @@
+"""
+    Queue of pending trace requests, with priority classes and
+    fairness across the clients requesting traces.
+"""
+
+import asyncio
+import heapq
+import itertools
+
+
+class FairRequestQueue:
+    """ Weighted fair queue of trace request ids.
+
+    Every (priority, source) pair is a flow. Each request gets a virtual
+    finish time, 1 / weight of its priority after the previous request
+    of its flow or after the virtual time of the queue, and requests
+    leave in finish time order. The weight applies per flow: each
+    backlogged flow gets a share of the dispatched traces proportional
+    to the weight of its priority, so a priority with N busy sources
+    gets N shares. A source can not starve the others of its priority,
+    and a single bulk job does not block interactive traces and is not
+    starved by them either. Sources are the client addresses of the
+    REST requests, so a client can not claim more shares by labeling
+    its requests.
+
+    A queued request can be promoted to a heavier priority. Its old
+    entry stays in the heap, marked as removed, and is skipped by get.
+    """
+
+    def __init__(self, weights):
+        """
+        Args:
+            weights: dict {priority: weight}
+        """
+        self._weights = dict(weights)
+        # (finish, seq, request_id, flow)
+        self._heap = []
+        # flow -> finish time of its last queued request
+        self._finish = dict()
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        # request_id -> (seq, priority) of its entry in the heap
+        self._queued = dict()
+        # seq of the entries left in the heap by promote
+        self._removed = set()
+        self._depths = {priority: 0 for priority in self._weights}
+        self._not_empty = asyncio.Event()
+
+    def put_nowait(self, request_id, priority, source=None):
+        """ Queue a trace request.
+
+        Args:
+            request_id: trace request id
+            priority: one of the priorities of weights
+            source: client that requested the trace
+        Raises:
+            ValueError: unknown priority
+        """
+        if priority not in self._weights:
+            raise ValueError(f"Unknown priority: {priority}")
+        flow = (priority, source)
+        start = max(self._vtime, self._finish.get(flow, 0.0))
+        finish = start + 1 / self._weights[priority]
+        self._finish[flow] = finish
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (finish, seq, request_id, flow))
+        self._queued[request_id] = (seq, priority)
+        self._depths[priority] += 1
+        self._not_empty.set()
+
+    async def put(self, request_id, priority, source=None):
+        """ Queue a trace request, see put_nowait """
+        self.put_nowait(request_id, priority, source)
+
+    def promote(self, request_id, priority, source=None):
+        """ Queue a trace request again with a priority heavier than
+        the one it has, as a new request of the (priority, source) flow.
+
+        Args:
+            request_id: queued trace request id
+            priority: one of the priorities of weights
+            source: client the promotion is made for
+        Returns:
+            True if the request was promoted
+            False if it is not queued or its priority is not lighter
+        Raises:
+            ValueError: unknown priority
+        """
+        if priority not in self._weights:
+            raise ValueError(f"Unknown priority: {priority}")
+        queued = self._queued.get(request_id)
+        if queued is None:
+            return False
+        seq, old_priority = queued
+        if self._weights[priority] <= self._weights[old_priority]:
+            return False
+        self._removed.add(seq)
+        self._depths[old_priority] -= 1
+        self.put_nowait(request_id, priority, source)
+        return True
+
+    async def get(self):
+        """ Wait for and remove the next trace request.
+
+        Returns:
+            trace request id
+        """
+        while not self.qsize():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        self._drop_removed()
+        finish, _, request_id, flow = self._pop()
+        self._vtime = finish
+        self._depths[flow[0]] -= 1
+        del self._queued[request_id]
+        self._drop_removed()
+        return request_id
+
+    def _pop(self):
+        """ Remove the first entry of the heap """
+        finish, seq, request_id, flow = heapq.heappop(self._heap)
+        # Forget idle flows
+        if self._finish.get(flow) == finish:
+            del self._finish[flow]
+        return finish, seq, request_id, flow
+
+    def _drop_removed(self):
+        """ Remove the entries left by promote from the top of the heap """
+        while self._heap and self._heap[0][1] in self._removed:
+            self._removed.discard(self._pop()[1])
+
+    def qsize(self):
+        """ Number of queued trace requests """
+        return len(self._heap) - len(self._removed)
+
+    def get_depths(self):
+        """ Number of queued trace requests per priority """
+        return dict(self._depths)
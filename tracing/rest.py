@@ -31,7 +31,7 @@ class FormatRest:
         return str(time_diff) if to_str else time_diff
 
     def add_trace_step(self, trace_result, trace_type, reason='done',
-                       dpid=None, port=None, msg="none"):
+                       dpid=None, port=None, msg="none", cycle=None):
         """ Used to create the new REST result.vOnly this method
         should write to self.trace_result
 
@@ -42,6 +42,7 @@ class FormatRest:
             dpid: switch's dpid
             port: switch's OpenFlow port_no
             msg: message in case of reason == error
+            cycle: steps of the loop in case of reason == loop
         """
         step = dict()
         step["type"] = trace_type
@@ -60,6 +61,9 @@ class FormatRest:
             step["reason"] = reason
             step["msg"] = msg
             step["time"] = self.get_time()
+            if cycle is not None:
+                step["cycle"] = cycle
+                step["cycle_length"] = len(cycle)
 
         # Add to trace_result array by reference
         trace_result.append(step)
@@ -1,14 +1,41 @@
 """
     Class Entries. Used to evaluate entries provided.
 """
+import ipaddress
 import re
 from napps.amlight.sdntrace import constants
 from napps.amlight.sdntrace import settings
+from napps.amlight.sdntrace.shared.switches import normalize_dpid
 
 DPID_ADDR = re.compile('([0-9A-Fa-f]{2}[-:]){7}[0-9A-Fa-f]{2}$')
 MAC_ADDR = re.compile('([0-9A-Fa-f]{2}[-:]){5}[0-9A-Fa-f]{2}$')
 IP_ADDR = re.compile("^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\\.){3}"
                      "(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$")
+# Default probe addresses when dl_type is IPv6 (documentation prefix)
+IPV6_SRC = '2001:db8::1'
+IPV6_DST = '2001:db8::2'
+
+
+def _ipv6_address(address):
+    """ Return the compressed form of an IPv6 address, None if invalid """
+    try:
+        return str(ipaddress.IPv6Address(address))
+    except ValueError:
+        return None
+
+
+def _canonical_address(address):
+    """ Return a MAC, IPv4 or IPv6 address in a single form: lower case
+    MAC with ':' and IPv4 without leading zeros. IPv6 is already stored
+    compressed. Anything else is returned as is.
+    """
+    if not isinstance(address, str):
+        return address
+    if re.search(MAC_ADDR, address):
+        return address.replace('-', ':').lower()
+    if re.search(IP_ADDR, address):
+        return '.'.join(str(int(octet)) for octet in address.split('.'))
+    return address
 
 
 class TraceEntries(object):
@@ -19,7 +46,8 @@ class TraceEntries(object):
         self._in_port = 0
         self._dl_src = 0
         self._dl_dst = 'ca:fe:ca:fe:ca:fe'
-        self._dl_vlan = 0
+        # VLAN stack as (tpid, vid, pcp), outermost first
+        self._vlans = []
         self._dl_type = 0x800
         self._dl_vlan_pcp = 0
         self._nw_src = '1.1.1.1'
@@ -30,6 +58,8 @@ class TraceEntries(object):
         self._tp_dst = 0
         self.timeout = max(float(settings.TIMEOUT), 0)
         self.step_timeout = 0.5
+        self.priority = settings.TRACE_DEFAULT_PRIORITY
+        self.source = None  # Client requesting the trace
         self.init_entries = dict()  # User request
 
     @property
@@ -142,8 +172,8 @@ class TraceEntries(object):
 
     @property
     def dl_vlan(self):
-        """ dl_vlan Getter """
-        return self._dl_vlan
+        """ dl_vlan Getter: VID of the outermost VLAN tag """
+        return self._vlans[0][1] if self._vlans else 0
 
     @dl_vlan.setter
     def dl_vlan(self, dl_vlan):
@@ -154,7 +184,49 @@ class TraceEntries(object):
             if not 0 < dl_vlan <= 4095:
                 raise ValueError("Error: dl_vlan has to be between 0 and 4095")
 
-        self._dl_vlan = dl_vlan
+        if self._vlans:
+            tpid, _, pcp = self._vlans[0]
+            self._vlans[0] = (tpid, dl_vlan, pcp)
+        else:
+            self._vlans.append((constants.VLAN, dl_vlan, self._dl_vlan_pcp))
+
+    @property
+    def vlans(self):
+        """ vlans Getter: VLAN stack as (tpid, vid, pcp), outermost first """
+        return tuple(self._vlans)
+
+    @vlans.setter
+    def vlans(self, vlans):
+        """ vlans Setter: entries['trace']['eth']['vlans'], the stacked
+        VLAN tags (QinQ), outermost first. Each tag is a dict with
+        dl_vlan, and optionally dl_vlan_pcp and tpid.
+
+        Args:
+            vlans: list of dicts
+        """
+        if not isinstance(vlans, list) or not vlans:
+            raise ValueError("Error: vlans has to be a non-empty list")
+        if len(vlans) > constants.VLAN_STACK_MAX_DEPTH:
+            raise ValueError("Error: vlans allows up to "
+                             f"{constants.VLAN_STACK_MAX_DEPTH} tags")
+
+        stack = []
+        for tag in vlans:
+            if not isinstance(tag, dict):
+                raise ValueError("Error: each vlans tag has to be dict")
+            vid = tag.get('dl_vlan')
+            pcp = tag.get('dl_vlan_pcp', 0)
+            tpid = tag.get('tpid', constants.VLAN)
+            if not isinstance(vid, int) or not 0 < vid <= 4095:
+                raise ValueError("Error: dl_vlan has to be between 0 and 4095")
+            if not isinstance(pcp, int) or not 0 <= pcp <= 7:
+                raise ValueError("Error: dl_vlan_pcp has to be [0-7]")
+            if tpid not in (constants.VLAN, constants.VLAN_QINQ):
+                raise ValueError("Error: tpid has to be 33024 or 34984")
+            stack.append((tpid, vid, pcp))
+
+        self._vlans = stack
+        self._dl_vlan_pcp = stack[0][2]
 
     @property
     def dl_type(self):
@@ -174,8 +246,8 @@ class TraceEntries(object):
 
     @property
     def dl_vlan_pcp(self):
-        """ dl_vlan_pcp Getter """
-        return self._dl_vlan_pcp
+        """ dl_vlan_pcp Getter: PCP of the outermost VLAN tag """
+        return self._vlans[0][2] if self._vlans else self._dl_vlan_pcp
 
     @dl_vlan_pcp.setter
     def dl_vlan_pcp(self, dl_vlan_pcp):
@@ -187,6 +259,9 @@ class TraceEntries(object):
                 raise ValueError("Error: dl_vlan_pcp has to be [0-7]")
 
         self._dl_vlan_pcp = dl_vlan_pcp
+        if self._vlans:
+            tpid, vid, _ = self._vlans[0]
+            self._vlans[0] = (tpid, vid, dl_vlan_pcp)
 
     @property
     def nw_tos(self):
@@ -211,11 +286,17 @@ class TraceEntries(object):
 
     @nw_src.setter
     def nw_src(self, nw_src):
-        """ nw_src Setter """
+        """ nw_src Setter: IPv4 or IPv6 address """
 
         if not isinstance(nw_src, str):
             raise ValueError("Error: nw_src has to be string")
 
+        if ':' in nw_src:
+            # IPv6, stored in its compressed form
+            nw_src = _ipv6_address(nw_src)
+            if nw_src is None:
+                raise ValueError("Error: nw_src is not a proper IPv6")
+
         elif not re.search(IP_ADDR, nw_src):
             # Filters: 0.0.0.1 to 255.255.255.255
             msg = "Error: nw_src is not a proper IPv4"
@@ -230,11 +311,17 @@ class TraceEntries(object):
 
     @nw_dst.setter
     def nw_dst(self, nw_dst):
-        """ nw_dst Setter """
+        """ nw_dst Setter: IPv4 or IPv6 address """
 
         if not isinstance(nw_dst, str):
             raise ValueError("Error: nw_dst has to be string")
 
+        if ':' in nw_dst:
+            # IPv6, stored in its compressed form
+            nw_dst = _ipv6_address(nw_dst)
+            if nw_dst is None:
+                raise ValueError("Error: nw_dst is not a proper IPv6")
+
         elif not re.search(IP_ADDR, nw_dst):
             # Filters: 0.0.0.1 to 255.255.255.255
             msg = "Error: nw_dst is not a proper IPv4"
@@ -290,6 +377,71 @@ class TraceEntries(object):
 
         self._tp_dst = tp_dst
 
+    def fingerprint(self):
+        """ Canonical form of the trace request. Requests asking for
+        the same trace, even written differently (dpid format, MAC case,
+        omitted defaults), have the same fingerprint.
+
+        Returns:
+            hashable tuple
+        """
+        return (normalize_dpid(self._dpid), self._in_port,
+                _canonical_address(self._dl_src),
+                _canonical_address(self._dl_dst),
+                self.vlans, self.dl_vlan_pcp, self._dl_type,
+                _canonical_address(self._nw_src),
+                _canonical_address(self._nw_dst),
+                self._nw_tos, self._nw_proto, self._tp_src, self._tp_dst,
+                float(self.timeout))
+
+    def update_headers(self, probe):
+        """ Copy the header fields observed in a probe PacketIn, so the
+        next probe carries the rewrites done along the path. Values
+        come from a parsed frame and are not validated again. dl_src is
+        not copied: it carries the color of each switch. The whole VLAN
+        stack is copied, so push, pop and swap of any tag are followed.
+
+        Args:
+            probe: trace_pkt.ParsedProbe
+        """
+        self._dl_dst = probe.dl_dst
+        self._vlans = list(probe.vlans)
+        self._dl_vlan_pcp = probe.dl_vlan_pcp or 0
+
+        if probe.nw_proto is None:
+            return
+        self._nw_src = probe.nw_src
+        self._nw_dst = probe.nw_dst
+        self._nw_tos = probe.nw_tos
+
+        if probe.tp_src is None:
+            return
+        self._tp_src = probe.tp_src
+        self._tp_dst = probe.tp_dst
+
+    def _check_ip_version(self, ip_):
+        """ Use IPv6 default addresses if dl_type is IPv6 and check that
+        nw_src and nw_dst match the IP version of dl_type.
+
+        Args:
+            ip_: entries['trace']['ip']
+        """
+        if self.dl_type == constants.IPV6:
+            if 'nw_src' not in ip_:
+                self._nw_src = IPV6_SRC
+            if 'nw_dst' not in ip_:
+                self._nw_dst = IPV6_DST
+        elif self.dl_type != constants.IPV4:
+            return
+
+        is_ipv6 = self.dl_type == constants.IPV6
+        for address in (self.nw_src, self.nw_dst):
+            if (':' in address) != is_ipv6:
+                version = 'IPv6' if is_ipv6 else 'IPv4'
+                raise ValueError(f"Error: nw_src and nw_dst have to be "
+                                 f"{version} addresses for dl_type "
+                                 f"{self.dl_type}")
+
     def load_entries(self, entries):
         """ Import entries provided
 
@@ -330,6 +482,11 @@ class TraceEntries(object):
         if 'dl_vlan' in eth:
             self.dl_vlan = eth['dl_vlan']
 
+        if 'vlans' in eth:
+            if 'dl_vlan' in eth:
+                raise ValueError("Error: use either dl_vlan or vlans")
+            self.vlans = eth['vlans']
+
         if 'dl_src' in eth:
             self.dl_src = eth['dl_src']
 
@@ -361,6 +518,8 @@ class TraceEntries(object):
                      and 'tp' not in trace):
                     raise ValueError("Error: tp not provided")
 
+        self._check_ip_version(trace.get('ip', {}))
+
         # Basic entries['trace']['ip']
         if 'tp' in trace:
             tp_ = trace['tp']
@@ -374,4 +533,12 @@ class TraceEntries(object):
         if 'timeout' in trace:
             self.timeout = trace["timeout"]
 
+        if 'priority' in trace:
+            if trace['priority'] not in settings.TRACE_PRIORITY_WEIGHTS:
+                raise ValueError("Error: invalid priority")
+            self.priority = trace['priority']
+
+        if 'source' in trace:
+            self.source = str(trace['source'])
+
         self.init_entries = entries
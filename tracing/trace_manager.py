@@ -3,21 +3,30 @@
 """
 
 
-import dill
+import asyncio
 import time
-from janus import Queue
-from _thread import start_new_thread as new_thread
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
+from datetime import datetime
 from typing import Optional
 
 from kytos.core import log
 from napps.amlight.sdntrace import settings
 from napps.amlight.sdntrace.shared.switches import Switches
 from napps.amlight.sdntrace.shared.colors import Colors
+from napps.amlight.sdntrace.shared.rate_limit import (
+    AIMDWindow,
+    ProbePacer,
+    TokenBucket,
+)
 from napps.amlight.sdntrace.tracing.tracer import TracePath
-from napps.amlight.sdntrace.tracing.trace_pkt import process_packet
-from napps.amlight.sdntrace.tracing.trace_entries import TraceEntries
+from napps.amlight.sdntrace.tracing.request_queue import FairRequestQueue
 from napps.amlight.sdntrace.tracing.trace_msg import TraceMsg
+from napps.amlight.sdntrace.tracing.trace_pkt import (
+    ParsedProbe,
+    parse_probe,
+    parse_probe_msg,
+)
+from napps.amlight.sdntrace.tracing.trace_entries import TraceEntries
 
 
 class TraceManager(object):
@@ -39,109 +48,299 @@ class TraceManager(object):
 
         # Trace queues
         self._request_dict = dict()
-        self._request_queue = None
+        self._request_queue = FairRequestQueue(
+            settings.TRACE_PRIORITY_WEIGHTS
+        )
         self._results_queue = OrderedDict()
         self._running_traces:dict[int, TraceEntries] = dict()
+        # Fingerprint of each pending or running trace request, and the
+        # trace id of each fingerprint to find identical requests
+        self._fingerprints: dict[int, tuple] = dict()
+        self._fingerprint_index: dict[tuple, int] = dict()
+        # Identical requests attached to a trace in flight: trace id of
+        # the trace running the probes -> attached trace ids, and back
+        self._followers: dict[int, list[int]] = dict()
+        self._leaders: dict[int, int] = dict()
+        # Time each pending trace was requested, to get its queue time
+        self._request_times: dict[int, datetime] = dict()
+        # Set when a running trace ends and frees a slot
+        self._slot_freed = asyncio.Event()
+        # Token buckets of the probe PacketIns of each trace step:
+        # request_id -> {step: TokenBucket}. A probe caught in a loop
+        # keeps coming back after its trace ended, so the buckets of a
+        # trace are kept PROBE_STORM_GRACE seconds after its end.
+        self._probe_buckets: dict[int, dict[int, TokenBucket]] = dict()
+        # Ended traces -> time.monotonic() their buckets are dropped
+        self._probe_buckets_expiration = OrderedDict()
+        # Pacing and in-flight limit of the probes sent to each switch
+        self.probe_pacer = ProbePacer(settings.SWITCH_PROBE_RATE,
+                                      settings.SWITCH_PROBE_BURST,
+                                      settings.SWITCH_MAX_IN_FLIGHT)
+        # Number of parallel traces, adapted to the probe round-trip
+        # times and the msg_out buffer depth
+        self._window = AIMDWindow(settings.PARALLEL_TRACES,
+                                  settings.PARALLEL_TRACES_MIN,
+                                  settings.PARALLEL_TRACES_MAX,
+                                  cooldown=settings.PARALLEL_TRACES_COOLDOWN)
         self._results_queue_max_size = max(int(settings.RESULTS_QUEUE_MAX_SIZE), 1)
 
+        # Results of finished traces reused for identical requests:
+        # fingerprint -> (topology version, expiration, trace id, result).
+        # The version changes on every topology or flow change.
+        self._topology_version = 0
+        self._trace_versions: dict[int, int] = dict()
+        self._result_cache = OrderedDict()
+        self._result_cache_ttl = max(float(settings.RESULT_CACHE_TTL), 0)
+        self._result_cache_max_size = max(
+            int(settings.RESULT_CACHE_MAX_SIZE), 1
+        )
+
         # Counters
         self._total_traces_requested = 0
-
-        # PacketIn queue with Probes
-        self._trace_pkt_in = defaultdict(Queue)
+        self._total_probe_packet_ins = 0
+        self._total_other_packet_ins = 0
+        self._total_unknown_probes = 0
+        self._total_stale_probes = 0
+        self._total_storm_probes = 0
+        self._total_coalesced_traces = 0
+        self._total_result_cache_hits = 0
+        self._total_result_cache_misses = 0
+
+        # One slot per active trace: request_id -> (step, Future waiting
+        # for the probe PacketIn of that step)
+        self._trace_pkt_in: dict[int, tuple[int, asyncio.Future]] = dict()
 
         self._is_tracing_running = False
 
+        # Kytos event loop where the dispatcher and tracers run
         self._async_loop = None
+        self._dispatcher = None
         # To start traces
         self.run_traces()
 
     def stop_traces(self):
+        """Stop the dispatcher and signal all running tracers to end."""
         if self._is_tracing_running:
             self._is_tracing_running = False
-            self._request_queue.close()
+            if self._dispatcher is not None:
+                self._dispatcher.cancel()
         for trace_obj in self._running_traces.values():
             trace_obj.trace_ended = True
-            if trace_obj.id in self._trace_pkt_in:
-                self._trace_pkt_in[trace_obj.id].close()
+        # Wake up tracers waiting for a PacketIn so they notice the end
+        for _, waiter in list(self._trace_pkt_in.values()):
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(
+                    self._release_waiter, waiter
+                )
 
     def is_tracing_running(self):
         return self._is_tracing_running
 
     def run_traces(self):
         """
-        Create the task to search for traces _run_traces.
+        Create the task to search for traces _run_traces on the
+        Kytos event loop.
         """
-        self._request_queue = Queue()
         self._is_tracing_running = True
-        new_thread(self._run_traces, ())
+        self._async_loop = self.controller.loop
+        self._dispatcher = asyncio.run_coroutine_threadsafe(
+            self._run_traces(), self._async_loop
+        )
+
+    async def _run_traces(self):
+        """ Task that will keep reading the self._request_queue
+        looking for new trace requests to run. When the concurrency
+        window is full, it waits for a trace to end or the window to grow.
+        """
+        while self.is_tracing_running():
+            try:
+                await self._wait_for_slot()
+                request_id = await self._request_queue.get()
+                entries = self._request_dict[request_id]
+                self._spawn_trace(request_id, entries)
+                # After starting traces for new requests,
+                # remove them from self._request_dict
+                del self._request_dict[request_id]
+            except asyncio.CancelledError:
+                log.warning("Trace dispatcher stopped.")
+                raise
+            except Exception as error:  # pylint: disable=broad-except
+                log.error("Trace Error: %s" % error)
+
+    async def _wait_for_slot(self):
+        """Wait until the concurrency window has a free slot."""
+        while self.limit_traces_reached():
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+    def _release_slot(self, trace_id):
+        """Remove a trace from the running ones and wake up the
+        dispatcher waiting for a free slot.
 
-    def _run_traces(self):
-        """ Thread that will keep reading the self._request_dict
-        queue looking for new trace requests to run.
+        Args:
+            trace_id: trace request id
         """
-        try:
-            while self.is_tracing_running():
-                try:
-                    if not self.limit_traces_reached():
-                        request_id = self._request_queue.sync_q.get()
-                        entries = self._request_dict[request_id]
-                        new_thread(self._spawn_trace, (request_id, entries))
-                        # After starting traces for new requests,
-                        # remove them from self._request_dict
-                        del self._request_dict[request_id]
-                    else:
-                        # Wait for traces to end
-                        time.sleep(1)
-                except Exception as error:  # pylint: disable=broad-except
-                    log.error("Trace Error: %s" % error)
-        except RuntimeError:
-            log.warning("Ignored trace request while sdntrace was shutting down.")
+        if self._running_traces.pop(trace_id, None) is not None:
+            self._slot_freed.set()
+        if trace_id in self._probe_buckets:
+            self._probe_buckets_expiration.setdefault(
+                trace_id, time.monotonic() + settings.PROBE_STORM_GRACE
+            )
+        self._forget_fingerprint(trace_id)
+        for follower_id in self._followers.pop(trace_id, ()):
+            self._leaders.pop(follower_id, None)
+
+    def _forget_fingerprint(self, trace_id):
+        """Remove a finished trace from the fingerprint index.
+
+        Args:
+            trace_id: trace request id
+        """
+        self._trace_versions.pop(trace_id, None)
+        fingerprint = self._fingerprints.pop(trace_id, None)
+        if self._fingerprint_index.get(fingerprint) == trace_id:
+            del self._fingerprint_index[fingerprint]
+
+    def invalidate_results(self):
+        """Used on topology and flow changes: cached results and the
+        ones of the traces running now are not reused.
+        """
+        self._topology_version += 1
+        self._result_cache.clear()
+
+    def _cache_result(self, trace_id, result):
+        """Keep the result of a trace for identical requests, unless the
+        topology or the flows changed since it was requested or the
+        trace failed or did not end by itself.
+
+        Args:
+            trace_id: trace ID
+            result: trace result generated using tracer
+        """
+        fingerprint = self._fingerprints.get(trace_id)
+        version = self._trace_versions.get(trace_id)
+        if (not self._result_cache_ttl or fingerprint is None or
+                version != self._topology_version):
+            return
+        steps = result.get('result') or [{}]
+        if (steps[-1].get('type') == 'pre-ended' or
+                steps[-1].get('reason') == 'error'):
+            return
+        expires_at = time.monotonic() + self._result_cache_ttl
+        self._result_cache[fingerprint] = (version, expires_at, trace_id,
+                                           result)
+        self._result_cache.move_to_end(fingerprint)
+        while len(self._result_cache) > self._result_cache_max_size:
+            self._result_cache.popitem(last=False)
+
+    def _get_cached_result(self, fingerprint):
+        """Get a valid cached result for a request fingerprint.
+
+        Args:
+            fingerprint: TraceEntries.fingerprint()
+        Returns:
+            trace ID and result of the cached trace or None
+        """
+        if not self._result_cache_ttl:
+            return None
+        cached = self._result_cache.get(fingerprint)
+        if (cached is None or cached[0] != self._topology_version or
+                cached[1] <= time.monotonic()):
+            self._result_cache.pop(fingerprint, None)
+            self._total_result_cache_misses += 1
+            return None
+        self._total_result_cache_hits += 1
+        return cached[2], cached[3]
 
     def _spawn_trace(self, trace_id, trace_entries):
         """ Once a request is found by the run_traces method,
-        instantiate a TracePath class and run the tracepath
+        instantiate a TracePath class and schedule the tracepath
+        coroutine as a task on the running event loop.
 
         Args:
             trace_id: trace request id
             trace_entries: TraceEntries class
         """
-        
         log.info("Creating task to trace request id %s..." % trace_id)
-        tracer = TracePath(self, trace_id, trace_entries)
+        queued_at = self._request_times.pop(trace_id, None)
+        tracer = TracePath(self, trace_id, trace_entries, queued_at)
 
         self._running_traces[trace_id] = tracer
-        tracer.tracepath()
+        tracer.trace_task = asyncio.create_task(tracer.tracepath())
+        tracer.trace_task.add_done_callback(
+            lambda task: self._trace_done(trace_id, task)
+        )
+        return tracer.trace_task
+
+    def _trace_done(self, trace_id, task):
+        """Callback for finished trace tasks. Makes sure a failed
+        trace does not hold a running slot forever and that it and the
+        traces attached to it get an error result.
+
+        Args:
+            trace_id: trace request id
+            task: asyncio.Task that ran the tracepath
+        """
+        if task.cancelled():
+            error = "Trace cancelled"
+        elif task.exception() is not None:
+            log.error(f"Trace {trace_id} failed: {task.exception()}")
+            error = f"Trace failed: {task.exception()}"
+        else:
+            error = None
+        tracer = self._running_traces.get(trace_id)
+        if (error is not None and tracer is not None and
+                trace_id not in self._results_queue):
+            self.add_result(trace_id, tracer.get_error_result(error))
+        self._release_slot(trace_id)
 
     def add_result(self, trace_id, result):
-        """Used to save trace results to self._results_queue
+        """Used to save trace results to self._results_queue. Traces
+        attached to this one get the same result under their own ID.
+        The result is cached if the result cache is enabled.
 
         Args:
             trace_id: trace ID
             result: trace result generated using tracer
         """
         self._results_queue[trace_id] = result
+        self._cache_result(trace_id, result)
+        for follower_id in self._followers.get(trace_id, ()):
+            self._results_queue[follower_id] = dict(
+                result, request_id=follower_id, coalesced_with=trace_id
+            )
+        self._trim_results_queue()
+        self._release_slot(trace_id)
+
+    def _trim_results_queue(self):
+        """Drop the oldest results above RESULTS_QUEUE_MAX_SIZE."""
         while (
             self._results_queue
             and len(self._results_queue) > self._results_queue_max_size
         ):
             self._results_queue.popitem(last=False)
-        self._running_traces.pop(trace_id, None)
 
-    def avoid_duplicated_request(self, entries):
-        """Verify if any of the requested queries has the same entries.
-        If so, ignore it
+    @staticmethod
+    def _load_entries(entries):
+        """ Load the params provided and look up the switch/dpid
+        requested.
 
         Args:
-            entries: entries provided by user via REST.
-        Return:
-            True: if exists a similar request
-            False: otherwise
+            entries: dictionary with user request
+        Returns:
+            TraceEntries class and its initial Switch
+            Error msg and None
         """
-        for request in self._request_dict.copy():
-            if entries == self._request_dict[request]:
-                return True
-        return False
+        try:
+            trace_entries = TraceEntries()
+            trace_entries.load_entries(entries)
+        except (ValueError, TypeError) as msg:
+            return str(msg), None
+
+        init_switch = Switches().get_switch(trace_entries.dpid)
+        if isinstance(init_switch, bool):
+            return "Unknown Switch", None
+        return trace_entries, init_switch
 
     @staticmethod
     async def is_entry_valid(entries):
@@ -154,15 +353,9 @@ class TraceManager(object):
             TraceEntries class
             Error msg
         """
-        try:
-            trace_entries = TraceEntries()
-            trace_entries.load_entries(entries)
-        except (ValueError, TypeError) as msg:
-            return str(msg)
-
-        init_switch = Switches().get_switch(trace_entries.dpid)
-        if isinstance(init_switch, bool):
-            return "Unknown Switch"
+        trace_entries, init_switch = TraceManager._load_entries(entries)
+        if init_switch is None:
+            return trace_entries
         color = await Colors().aget_switch_color(init_switch.dpid)
 
         if len(color) == 0:
@@ -172,6 +365,29 @@ class TraceManager(object):
 
         return trace_entries
 
+    async def are_entries_valid(self, entries_list):
+        """ Validate a list of trace requests against a single
+        snapshot of the switches and colors.
+
+        Args:
+            entries_list: list of dictionaries with user requests
+        Returns:
+            list with a TraceEntries class or an error msg per request
+        """
+        loaded = [self._load_entries(entries) for entries in entries_list]
+        dpids = {switch.dpid for _, switch in loaded if switch is not None}
+        colors = await Colors().aget_colors(dpids)
+
+        results = []
+        for trace_entries, init_switch in loaded:
+            if init_switch is None:
+                results.append(trace_entries)
+            elif not colors.get(init_switch.dpid):
+                results.append("Switch not Colored")
+            else:
+                results.append(trace_entries)
+        return results
+
     def get_id(self):
         """ID generator for each trace. Useful in case
         of parallel requests
@@ -193,6 +409,8 @@ class TraceManager(object):
         try:
             return self._results_queue[trace_id]
         except (ValueError, KeyError):
+            # Attached traces follow the trace running the probes
+            trace_id = self._leaders.get(trace_id, trace_id)
             if trace_id in self._running_traces:
                 return {'msg': 'trace in process'}
             elif trace_id in self._request_dict:
@@ -214,13 +432,36 @@ class TraceManager(object):
 
         Returns:
             True: if the number of traces running is equal/more
-                than settings.PARALLEL_TRACES
+                than the concurrency window
             False: if it is not.
         """
-        if len(self._running_traces) >= settings.PARALLEL_TRACES:
+        if len(self._running_traces) >= self._window.limit:
             return True
         return False
 
+    def _msg_out_depth(self):
+        """Number of events waiting in the Kytos msg_out buffer."""
+        return int(self.controller.buffers.msg_out.qsize())
+
+    def record_probe_rtt(self, rtt):
+        """Adapt the concurrency window to a probe round-trip time.
+        The window shrinks if the PacketIn took longer than
+        PROBE_RTT_TARGET or msg_out is deeper than MSG_OUT_DEPTH_TARGET,
+        and grows while it is full and neither happens.
+
+        Args:
+            rtt: seconds between the PacketOut and its PacketIn
+        """
+        depth = self._msg_out_depth()
+        if rtt > settings.PROBE_RTT_TARGET:
+            self._window.on_congestion(f"probe rtt {rtt:.3f}s above target")
+        elif depth > settings.MSG_OUT_DEPTH_TARGET:
+            self._window.on_congestion(f"msg_out depth {depth} above target")
+        elif not self.limit_traces_reached():
+            return
+        elif self._window.on_success(f"probe rtt {rtt:.3f}s below target"):
+            self._slot_freed.set()
+
     async def new_trace(self, trace_entries):
         """Receives external requests for traces.
 
@@ -229,19 +470,71 @@ class TraceManager(object):
         Returns:
             int with the request/trace id
         """
+        return self._queue_trace(trace_entries)
 
-        trace_id = self.get_id()
+    def new_traces(self, trace_entries_list):
+        """Receives a list of external requests for traces. They are
+        all queued at once, before the dispatcher can start any of them.
 
-        # Add to request_queue
-        self._request_dict[trace_id] = trace_entries
-        try:
-            await self._request_queue.async_q.put(trace_id)
-        except RuntimeError:
-            pass
+        Args:
+            trace_entries_list: list of TraceEntries Class
+        Returns:
+            list with the request/trace ids
+        """
+        return [self._queue_trace(trace_entries)
+                for trace_entries in trace_entries_list]
+
+    def _queue_trace(self, trace_entries):
+        """Add a trace request to the request queue. A request identical
+        to a pending or running trace requested since the last topology
+        or flow change is attached to it instead, and one
+        with a valid cached result gets a copy of it: it gets its own ID
+        but no probes are sent for it. A pending trace is promoted to
+        the priority of a request attached to it if it is heavier, so
+        the request does not wait in a lighter priority.
+
+        Args:
+            trace_entries: TraceEntries Class
+        Returns:
+            int with the request/trace id
+        """
+        trace_id = self.get_id()
 
         # Statistics
         self._total_traces_requested += 1
 
+        fingerprint = trace_entries.fingerprint()
+        cached = self._get_cached_result(fingerprint)
+        if cached is not None:
+            cached_id, result = cached
+            self._results_queue[trace_id] = dict(
+                result, request_id=trace_id, cached_from=cached_id
+            )
+            self._trim_results_queue()
+            return trace_id
+
+        # Traces requested before a topology or flow change probe the
+        # old network: a new trace replaces them in the index
+        leader_id = self._fingerprint_index.get(fingerprint)
+        if (leader_id is not None and
+                self._trace_versions.get(leader_id) == self._topology_version):
+            if self._request_queue.promote(leader_id, trace_entries.priority,
+                                           trace_entries.source):
+                self._request_dict[leader_id].priority = trace_entries.priority
+            self._followers.setdefault(leader_id, []).append(trace_id)
+            self._leaders[trace_id] = leader_id
+            self._total_coalesced_traces += 1
+            return trace_id
+
+        # Add to request_queue
+        self._request_dict[trace_id] = trace_entries
+        self._fingerprints[trace_id] = fingerprint
+        self._fingerprint_index[fingerprint] = trace_id
+        self._trace_versions[trace_id] = self._topology_version
+        self._request_times[trace_id] = datetime.now()
+        self._request_queue.put_nowait(trace_id, trace_entries.priority,
+                                       trace_entries.source)
+
         return trace_id
 
     def number_pending_requests(self):
@@ -252,52 +545,206 @@ class TraceManager(object):
         """
         return len(self._request_dict)
 
-    def get_unpickled_packet_eth(self, ethernet) -> Optional[TraceMsg]:
-        """Unpickle PACKET_IN ethernet or catch errors."""
+    def count_packet_in(self, is_probe):
+        """Count the PacketIns received, probes or not.
+
+        Args:
+            is_probe: True if the PacketIn carried a trace probe
+        """
+        if is_probe:
+            self._total_probe_packet_ins += 1
+        else:
+            self._total_other_packet_ins += 1
+
+    @staticmethod
+    def parse_probe_msg(data) -> Optional[TraceMsg]:
+        """Decode only the probe header of a PACKET_IN frame or catch
+        errors."""
         try:
-            msg = dill.loads(process_packet(ethernet))
-        except dill.UnpicklingError as err:
+            return parse_probe_msg(data)
+        except (ValueError, IndexError) as err:
             log.error(f"Error getting msg from PacketIn: {err}")
             return None
-        return msg
 
-    async def queue_probe_packet(self, event, ethernet, in_port, switch):
+    @staticmethod
+    def parse_probe_packet(data) -> Optional[ParsedProbe]:
+        """Parse the headers of a PACKET_IN probe frame or catch errors."""
+        try:
+            return parse_probe(data)
+        except (ValueError, IndexError) as err:
+            log.error(f"Error getting msg from PacketIn: {err}")
+            return None
+
+    def _expire_probe_buckets(self, now):
+        """Drop the probe buckets of the traces ended more than
+        PROBE_STORM_GRACE seconds ago.
+
+        Args:
+            now: current time.monotonic()
+        """
+        while self._probe_buckets_expiration:
+            trace_id, expires_at = next(
+                iter(self._probe_buckets_expiration.items())
+            )
+            if expires_at > now:
+                return
+            del self._probe_buckets_expiration[trace_id]
+            self._probe_buckets.pop(trace_id, None)
+
+    def admit_probe(self, request_id, step, nonce):
+        """ Rate limit the probe PacketIns of a trace step. A probe
+        flooding the controller, f.i. caught in a forwarding loop,
+        runs out of tokens and its PacketIns are dropped, also for
+        PROBE_STORM_GRACE seconds after its trace ended.
+
+        Buckets are only created for the steps a running trace has
+        reached, by probes with its nonce, so forged PacketIns can not
+        grow them. Other probes are not limited here and are dropped
+        as unknown or stale afterwards.
+
+        Args:
+            request_id: trace request id carried by the probe
+            step: trace step carried by the probe
+            nonce: nonce carried by the probe
+
+        Return:
+            True if the PacketIn can be processed
+            False if it must be dropped
+        """
+        now = time.monotonic()
+        self._expire_probe_buckets(now)
+        tracer = self._running_traces.get(request_id)
+        if tracer is not None and (nonce != tracer.nonce or
+                                   step > tracer.step):
+            return True
+        buckets = self._probe_buckets.get(request_id)
+        bucket = buckets.get(step) if buckets is not None else None
+        if bucket is None:
+            if tracer is None:
+                return True
+            if buckets is None:
+                buckets = self._probe_buckets[request_id] = dict()
+            bucket = buckets[step] = TokenBucket(settings.PROBE_STORM_RATE,
+                                                 settings.PROBE_STORM_BURST,
+                                                 now)
+        if bucket.consume(now):
+            return True
+        if bucket.dropped == 1:
+            log.warning('Trace %s: PacketIn storm on step %s' %
+                        (request_id, step))
+        return False
+
+    def get_probe_storms(self, request_id):
+        """ PacketIn storms seen by a trace.
+
+        Args:
+            request_id: trace request id
+
+        Return:
+            list of {'step', 'packet_ins', 'dropped', 'rate'} of the
+            steps with dropped PacketIns, rate in PacketIns per second
+        """
+        buckets = self._probe_buckets.get(request_id, {})
+        return [{'step': step,
+                 'packet_ins': bucket.total,
+                 'dropped': bucket.dropped,
+                 'rate': round(bucket.get_rate(), 2)}
+                for step, bucket in sorted(buckets.items())
+                if bucket.dropped]
+
+    def register_probe_waiter(self, request_id, step) -> asyncio.Future:
+        """Register interest in the PacketIn of a given trace step.
+        Must be called before the PacketOut is sent. Each trace has a
+        single slot, so registering a new step replaces the previous one.
+
+        Args:
+            request_id: trace request id
+            step: trace step the probe was generated for
+        Returns:
+            asyncio.Future resolved with the pkt_in dict
+        """
+        entry = self._trace_pkt_in.get(request_id)
+        if entry is not None:
+            old_step, waiter = entry
+            if old_step == step and not waiter.done():
+                return waiter
+            if not waiter.done():
+                waiter.cancel()
+        waiter = asyncio.get_running_loop().create_future()
+        self._trace_pkt_in[request_id] = (step, waiter)
+        return waiter
+
+    def unregister_probe_waiter(self, request_id, step):
+        """Remove the waiter of a trace step once it is not needed."""
+        entry = self._trace_pkt_in.get(request_id)
+        if entry is None or entry[0] != step:
+            return
+        del self._trace_pkt_in[request_id]
+        waiter = entry[1]
+        if not waiter.done():
+            waiter.cancel()
+
+    @staticmethod
+    def _release_waiter(waiter):
+        """Resolve a waiter without a PacketIn."""
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def queue_probe_packet(self, event, data, in_port, switch):
         """Used by sdntrace.packet_in_handler. Only tracing probes
-        get to this point. Adds the PacketIn msg received to the
-        trace_pkt_in queue.
+        get to this point. Only the probe header is decoded first:
+        probes above the PacketIn rate of their trace step and probes
+        nobody is waiting for are counted and dropped before the frame
+        is parsed. The parsed frame wakes up the tracer registered for
+        the request_id and step of the PacketIn msg.
 
         Args:
             event: PacketIn msg
-            ethernet: ethernet frame
+            data: raw Ethernet frame
             in_port: in_port
             switch: kytos.core.switch.Switch() class
         """
-        msg = self.get_unpickled_packet_eth(ethernet)
+        msg = self.parse_probe_msg(data)
         if msg is None:
+            self._total_unknown_probes += 1
+            return
+        if not self.admit_probe(msg.request_id, msg.step, msg.nonce):
+            self._total_storm_probes += 1
+            return
+        tracer = self._running_traces.get(msg.request_id)
+        entry = self._trace_pkt_in.get(msg.request_id)
+        if entry is None or (tracer is not None and
+                             msg.nonce != tracer.nonce):
+            self._total_unknown_probes += 1
+            log.debug(f"Dropping probe of unknown trace {msg.request_id}")
+            return
+        step, waiter = entry
+        if step != msg.step or waiter.done():
+            self._total_stale_probes += 1
+            log.debug(f"Dropping stale probe of trace {msg.request_id} "
+                      f"step {msg.step}")
+            return
+        probe = self.parse_probe_packet(data)
+        if probe is None:
+            self._total_unknown_probes += 1
             return
         pkt_in = dict()
         pkt_in["dpid"] = switch.dpid
         pkt_in["in_port"] = in_port
-        pkt_in["msg"] = msg
-        pkt_in["ethernet"] = ethernet
+        pkt_in["msg"] = probe.msg
+        pkt_in["probe"] = probe
         pkt_in["event"] = event
-        request_id = pkt_in['msg'].request_id
-
-        if request_id not in self._results_queue:
-            # This queue stores all PacketIn message received
-            try:
-                await self._trace_pkt_in[request_id].async_q.put(pkt_in)
-            except RuntimeError:
-                # If queue was close do nothing
-                pass
+        waiter.set_result(pkt_in)
 
     # REST calls
 
-    async def rest_new_trace(self, entries: dict):
+    async def rest_new_trace(self, entries: dict, source=None):
         """Used for the REST PUT call
 
         Args:
             entries: user provided parameters to trace
+            source: client requesting the trace. It replaces the source
+                of entries, used only when the client is unknown
         Returns:
             Trace_ID in JSON format
             Error msg if entries has invalid data
@@ -308,14 +755,47 @@ class TraceManager(object):
             result['result'] = {'error': trace_entries}
             return result
 
-        if self.avoid_duplicated_request(entries):
-            result['result'] = {'error': "Duplicated Trace Request ignored"}
-            return result
-
+        if source is not None:
+            trace_entries.source = source
         trace_id = await self.new_trace(trace_entries)
         result['result'] = {'trace_id': trace_id}
         return result
 
+    async def rest_new_traces(self, entries_list: list, source=None):
+        """Used for the REST PUT call with many trace requests. Either
+        all the requests are queued or none of them is.
+
+        Args:
+            entries_list: list of user provided parameters to trace
+            source: client requesting the traces. It replaces the
+                source of entries, used only when the client is unknown
+        Returns:
+            A trace_id per request in JSON format
+            An error msg per invalid request if any is invalid
+        """
+        result = dict()
+        if len(entries_list) > settings.BULK_TRACES_MAX_SIZE:
+            result['result'] = {
+                'error': f"More than {settings.BULK_TRACES_MAX_SIZE} "
+                         f"trace requests"
+            }
+            return result
+
+        checked = await self.are_entries_valid(entries_list)
+        if not all(isinstance(entry, TraceEntries) for entry in checked):
+            result['result'] = [
+                {} if isinstance(entry, TraceEntries) else {'error': entry}
+                for entry in checked
+            ]
+            return result
+
+        for trace_entries in checked:
+            if source is not None:
+                trace_entries.source = source
+        trace_ids = self.new_traces(checked)
+        result['result'] = [{'trace_id': trace_id} for trace_id in trace_ids]
+        return result
+
     def rest_get_result(self, trace_id):
         """Used for the REST GET call
 
@@ -335,17 +815,44 @@ class TraceManager(object):
     def rest_list_stats(self):
         """ Used to export some info about the TraceManager.
         Total number of requests, number of active traces, number of
-        pending traces, list of traces pending
+        pending traces, list of traces pending, PacketIns received
         Returns:
                 Total number of requests
                 number of active traces
                 number of pending traces
                 list of traces pending
+                number of probe and other PacketIns
+                number of unknown, stale and storm probes dropped
+                concurrency window and the reason of its last change
+                number of pending traces per priority
+                number of traces attached to an identical one
+                number of result cache hits and misses
+                number of color map refreshes and the ones not modified
         """
         stats = dict()
         stats['number_of_requests'] = self._total_traces_requested
         stats['number_of_running_traces'] = len(self._running_traces)
         stats['number_of_pending_traces'] = len(self._request_dict)
         stats['list_of_pending_traces'] = self._results_queue
+        stats['number_of_probe_packet_ins'] = self._total_probe_packet_ins
+        stats['number_of_other_packet_ins'] = self._total_other_packet_ins
+        stats['number_of_unknown_probes'] = self._total_unknown_probes
+        stats['number_of_stale_probes'] = self._total_stale_probes
+        stats['number_of_storm_probes'] = self._total_storm_probes
+        stats['concurrency_window'] = self._window.limit
+        stats['concurrency_window_reason'] = self._window.reason
+        stats['number_of_coalesced_traces'] = self._total_coalesced_traces
+        stats['number_of_result_cache_hits'] = self._total_result_cache_hits
+        stats['number_of_result_cache_misses'] = (
+            self._total_result_cache_misses
+        )
+        stats['pending_traces_per_priority'] = (
+            self._request_queue.get_depths()
+        )
+        color_stats = Colors().get_stats()
+        stats['number_of_color_refreshes'] = color_stats['refreshes']
+        stats['number_of_color_refreshes_not_modified'] = (
+            color_stats['not_modified']
+        )
 
         return stats
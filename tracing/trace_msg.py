@@ -3,33 +3,51 @@ Ethernet payload of the PacketOut. This msg is important to
 differentiate parallel traces.
 """
 
+import struct
+
+# Probe header: magic, version, reserved, request_id, step, nonce
+PROBE_HEADER = struct.Struct("!HBxIII")
+PROBE_MAGIC = 0x5D7C
+PROBE_VERSION = 1
+
 
 class TraceMsg(object):
     """ This class will be used to create, retrieve and update the
     payload message sent through the trace process
 
-    Basically the msg is a dictionary:
+    On the wire, the msg is a fixed-layout header (network byte order):
 
-    {"trace": {
-            "request_id": "number to identify this trace"
-        }
-    }
+     0                   1                   2                   3
+     0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |          Magic 0x5D7C         |    Version    |   Reserved    |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |                          Request ID                           |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |                             Step                              |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |                             Nonce                             |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     """
 
-    def __init__(self, r_id='0', step=0):
+    def __init__(self, r_id='0', step=0, nonce=0):
         self._request_id = None
         self._step = None
-        self._instantiate_vars(r_id, step)
+        self._nonce = None
+        self._instantiate_vars(r_id, step, nonce)
 
-    def _instantiate_vars(self, r_id, step):
+    def _instantiate_vars(self, r_id, step, nonce):
         """ Attributes in the TraceMsg are processed as
         Getter and Setters.
 
         Args:
             r_id: request ID
+            step: step number
+            nonce: random number chosen by the tracer
         """
         self.request_id = r_id
         self.step = step
+        self.nonce = nonce
 
     @property
     def request_id(self):
@@ -62,3 +80,57 @@ class TraceMsg(object):
                 self._step = int(step)
         except ValueError:
             raise ValueError(f"Invalid step number provided: f{step}")
+
+    @property
+    def nonce(self):
+        """ Getter: Nonce """
+        return self._nonce
+
+    @nonce.setter
+    def nonce(self, nonce):
+        """ Setter: Nonce """
+        try:
+            if isinstance(nonce, int):
+                self._nonce = nonce
+            else:
+                self._nonce = int(nonce)
+        except ValueError:
+            raise ValueError(f"Invalid nonce provided: {nonce}")
+
+    def pack(self):
+        """ Pack the msg in its binary representation.
+
+        Returns:
+            bytes: probe header
+        """
+        try:
+            return PROBE_HEADER.pack(PROBE_MAGIC, PROBE_VERSION,
+                                     self._request_id, self._step,
+                                     self._nonce)
+        except struct.error as err:
+            raise ValueError(f"Invalid TraceMsg: {err}")
+
+    @classmethod
+    def unpack(cls, buff, offset=0):
+        """ Create a TraceMsg from a probe header without copying
+        the buffer.
+
+        Args:
+            buff: bytes, bytearray or memoryview with the header
+            offset: where the header starts in buff
+
+        Returns:
+            TraceMsg
+
+        Raises:
+            ValueError: if buff does not carry a valid probe header
+        """
+        try:
+            magic, version, r_id, step, nonce = PROBE_HEADER.unpack_from(
+                buff, offset
+            )
+        except struct.error as err:
+            raise ValueError(f"Invalid probe header: {err}")
+        if magic != PROBE_MAGIC or version != PROBE_VERSION:
+            raise ValueError("Invalid probe header: unknown magic or version")
+        return cls(r_id, step, nonce)
@@ -4,19 +4,165 @@
 """
 
 
-import dill
-from pyof.foundation.network_types import Ethernet, IPv4, VLAN
+import socket
+from collections import OrderedDict
+
+from pyof.foundation.network_types import Ethernet, IPv4, IPv6, VLAN
 from napps.amlight.sdntrace import constants
-from napps.amlight.sdntrace.tracing.trace_msg import TraceMsg
-from napps.amlight.sdntrace.shared.extd_nw_types import TCP, UDP
+from napps.amlight.sdntrace.tracing.trace_msg import PROBE_HEADER, TraceMsg
+from napps.amlight.sdntrace.shared.extd_nw_types import (
+    TCP,
+    UDP,
+    update_checksum_field,
+)
 from napps.amlight.sdntrace.shared.switches import Switches
 from napps.amlight.sdntrace.shared.colors import Colors
 
 
-def generate_trace_pkt(trace_entries, color, r_id, step):
+# Maximum number of compiled probe templates kept in memory
+PROBE_TEMPLATES_MAX_SIZE = 256
+_probe_templates = OrderedDict()
+
+
+class ProbeTemplate:
+    """ Probe frame packed once per (entries, color). Probes are
+    generated by patching the TraceMsg and the VLAN TCIs of a copy of
+    the frame, fixing the TCP/UDP checksum incrementally from the one
+    of the template. The template frame itself is never changed, so
+    it can be shared by all the traces using it.
+    """
+
+    def __init__(self, trace_entries, color):
+        """
+        Args:
+            trace_entries: TraceEntries used to pack the frame
+            color: result from Coloring Napp for a specific DPID
+        """
+        frame = _pack_trace_pkt(trace_entries, color, 0, 0)
+        self._frame = bytearray(frame)
+        self._msg_offset = len(frame) - PROBE_HEADER.size
+        # Offsets of the TCI of each VLAN tag, outermost first
+        self._tci_offsets = []
+        self._csum_offset = None
+        self._l4_offset = None
+
+        offset = constants.ETHERNET_LEN
+        for _ in trace_entries.vlans:
+            self._tci_offsets.append(offset)
+            offset += constants.VLAN_LEN
+        if trace_entries.dl_type == constants.IPV4:
+            protocol = frame[offset + 9]
+            offset += (frame[offset] & 0x0F) * 4
+        elif trace_entries.dl_type == constants.IPV6:
+            protocol = frame[offset + 6]
+            offset += constants.IPV6_LEN
+        else:
+            protocol = None
+        if protocol == constants.TCP:
+            self._csum_offset = offset + 16
+            self._l4_offset = offset
+        elif protocol == constants.UDP:
+            self._csum_offset = offset + 6
+            self._l4_offset = offset
+        self._udp = protocol == constants.UDP
+
+    def build(self, r_id, step, nonce=0, vlans=()):
+        """ Generate a probe frame.
+
+        Args:
+            r_id: request ID
+            step: trace step
+            nonce: random number chosen by the tracer
+            vlans: VLAN stack as (tpid, vid, pcp), with the same TPIDs
+                as the template
+
+        Returns:
+            bytes: serialized Ethernet frame
+        """
+        msg = TraceMsg(r_id, step, nonce).pack()
+        frame = bytearray(self._frame)
+        if self._csum_offset is not None:
+            update_checksum_field(frame, self._csum_offset, self._msg_offset,
+                                  msg, self._l4_offset)
+            csum_end = self._csum_offset + 2
+            if self._udp and not any(frame[self._csum_offset:csum_end]):
+                # UDP sends a computed 0 as all ones (RFC 768)
+                frame[self._csum_offset:csum_end] = b"\xff\xff"
+        else:
+            frame[self._msg_offset:] = msg
+
+        for tci_offset, (_, vid, pcp) in zip(self._tci_offsets, vlans):
+            frame[tci_offset:tci_offset + 2] = ((pcp << 13) | vid).to_bytes(
+                2, "big"
+            )
+        return bytes(frame)
+
+
+def _template_key(trace_entries, color):
+    """ Fields that define a probe template. VLAN IDs and PCPs are
+    patched per probe, only the TPIDs of the VLAN stack are part of
+    the key.
+    """
+    return (color['color_value'], trace_entries.dl_dst,
+            tuple(tag[0] for tag in trace_entries.vlans),
+            trace_entries.dl_type,
+            trace_entries.nw_src, trace_entries.nw_dst,
+            trace_entries.nw_tos, trace_entries.nw_proto,
+            trace_entries.tp_src, trace_entries.tp_dst)
+
+
+def get_probe_template(trace_entries, color):
+    """ Get the compiled ProbeTemplate of (entries, color), creating
+    it on the first use.
+
+    Args:
+        trace_entries: TraceEntries provided by user or collected from PacketIn
+        color: result from Coloring Napp for a specific DPID
+
+    Returns:
+        ProbeTemplate
+    """
+    key = _template_key(trace_entries, color)
+    template = _probe_templates.get(key)
+    if template is None:
+        template = ProbeTemplate(trace_entries, color)
+        _probe_templates[key] = template
+        while len(_probe_templates) > PROBE_TEMPLATES_MAX_SIZE:
+            _probe_templates.popitem(last=False)
+    else:
+        _probe_templates.move_to_end(key)
+    return template
+
+
+def clear_probe_templates():
+    """ Drop all compiled probe templates """
+    _probe_templates.clear()
+
+
+def generate_trace_pkt(trace_entries, color, r_id, step, nonce=0):
+    """ Generate the PacketOut data of a trace probe from the
+    compiled template of (trace_entries, color). See _pack_trace_pkt.
+
+    Args:
+        trace_entries: TraceEntries provided by user or collected from PacketIn
+        color: result from Coloring Napp for a specific DPID
+        r_id: request ID
+        step: trace step
+        nonce: random number chosen by the tracer
+
+    Returns:
+        in_port: in_port
+        pkt: serialized Ethernet frame
+    """
+    template = get_probe_template(trace_entries, color)
+    pkt = template.build(r_id, step, nonce, trace_entries.vlans)
+    return trace_entries.in_port, pkt
+
+
+def _pack_trace_pkt(trace_entries, color, r_id, step, nonce=0):
     """ Receives the REST/PUT to generate a PacketOut
     data needs to be serialized. The goal is always to create
-    a packet with data being the TraceMsg to differentiate different
+    a packet with data being the packed TraceMsg to differentiate different
     traces running in parallel. We will stack layers depending of
     the user request. If user submits just a VLAN ID, we will use
     ethertype 88b5 and add TraceMsg after it. Same for IP, however
@@ -28,101 +174,224 @@ def generate_trace_pkt(trace_entries, color, r_id, step):
         trace_entries: TraceEntries provided by user or collected from PacketIn
         color: result from Coloring Napp for a specific DPID
         r_id: request ID
+        step: trace step
+        nonce: random number chosen by the tracer
 
     Returns:
-        in_port: in_port
         pkt: serialized Ethernet frame
     """
 
     ethernet = _create_ethernet_frame(trace_entries, color)
 
-    msg = TraceMsg(r_id, step)
+    msg = TraceMsg(r_id, step, nonce).pack()
 
-    if ethernet.ether_type == constants.IPV4:
-        ip_pkt = _create_ip_packet(trace_entries)
-        if ip_pkt.protocol == constants.TCP:
+    if ethernet.ether_type in (constants.IPV4, constants.IPV6):
+        if ethernet.ether_type == constants.IPV4:
+            ip_pkt = _create_ip_packet(trace_entries)
+            protocol = ip_pkt.protocol
+        else:
+            ip_pkt = _create_ipv6_packet(trace_entries)
+            protocol = ip_pkt.next_header
+        if protocol == constants.TCP:
             tp_pkt = _create_tcp_packet(trace_entries)
-            tp_pkt.data = dill.dumps(msg)
+            tp_pkt.data = msg
             ip_pkt.data = tp_pkt.pack(ip_pkt)
-        elif ip_pkt.protocol == constants.UDP:
+        elif protocol == constants.UDP:
             udp_pkt = _create_udp_packet(trace_entries)
-            udp_pkt.data = dill.dumps(msg)
+            udp_pkt.data = msg
             ip_pkt.data = udp_pkt.pack(ip_pkt)
         else:
-            ip_pkt.data = dill.dumps(msg)
+            ip_pkt.data = msg
 
         ethernet.data = ip_pkt.pack()
     else:
-        ethernet.data = dill.dumps(msg)
+        ethernet.data = msg
 
-    pkt = ethernet.pack()
-    return trace_entries.in_port, pkt
+    return ethernet.pack()
 
 
-def prepare_next_packet(trace_entries, result, event):
-    """ Used to support VLAN translation. Currently, it does not
-    support translation of other fields, such as MAC addresses.
+async def prepare_next_packet(trace_entries, result, probe):
+    """ Used to support header rewrites along the path (MAC addresses,
+    VLAN, PCP, IP addresses, DSCP and TCP/UDP ports): the fields of the
+    PacketIn received are used by the next probe.
 
     Args:
         trace_entries: TraceEntries provided by user or collected from PacketIn
         result: Result of the last Trace Probe sent.
-        event: PacketIn event
+        probe: ParsedProbe of the PacketIn
 
     Returns:
-        trace_entries: TraceEntries customized with new VLAN
+        trace_entries: TraceEntries customized with the PacketIn headers
         color: result from Coloring Napp for a specific DPID
         switch: DPID
     """
     dpid = result['dpid']
-    switch, color = _get_node_color_from_dpid(dpid)
+    switch, color = await _get_node_color_from_dpid(dpid)
 
     trace_entries.dpid = dpid
+    trace_entries.in_port = result['port']
+    trace_entries.update_headers(probe)
+    return trace_entries, color, switch
 
-    if event.content['message'].header.version == 1:
-        in_port = event.content['message'].in_port.value
-        trace_entries.in_port = in_port
-    else:
-        in_port = event.message.in_port
-        trace_entries.in_port = in_port
 
-    vlan = _get_vlan_from_pkt(event.content['message'].data.value)
-    if vlan:
-        trace_entries.dl_vlan = vlan
-    return trace_entries, color, switch
+class ParsedProbe(object):
+    """ Header fields observed in a probe PacketIn, filled by
+    parse_probe. Fields of headers not present are None.
+    """
 
+    def __init__(self):
+        self.dl_dst = None
+        self.dl_src = None
+        # VLAN tags as (tpid, vid, pcp), outermost first
+        self.vlans = []
+        self.dl_type = None
+        self.nw_src = None
+        self.nw_dst = None
+        self.nw_tos = None
+        self.nw_proto = None
+        self.tp_src = None
+        self.tp_dst = None
+        self.msg = None
+        # Offset of the probe header in the frame
+        self.msg_offset = None
+
+    @property
+    def dl_vlan(self):
+        """ VID of the outermost VLAN tag, None if untagged """
+        return self.vlans[0][1] if self.vlans else None
+
+    @property
+    def dl_vlan_pcp(self):
+        """ PCP of the outermost VLAN tag, None if untagged """
+        return self.vlans[0][2] if self.vlans else None
+
+    def fingerprint(self):
+        """ Header fields of the probe, used to tell apart visits of a
+        port with different headers. dl_src (the color) and the probe
+        header are not part of it.
+
+        Returns:
+            tuple: hashable header fields
+        """
+        return (self.dl_dst, tuple(self.vlans), self.dl_type,
+                self.nw_src, self.nw_dst, self.nw_tos, self.nw_proto,
+                self.tp_src, self.tp_dst)
+
+
+def _check_len(view, length, header):
+    """ Raise ValueError if view is shorter than length """
+    if len(view) < length:
+        raise ValueError(f"Invalid probe: truncated {header} header")
+
+
+def parse_probe(data):
+    """ Walk the Ethernet, VLAN, IPv4/IPv6 and TCP/UDP headers of a
+    PacketIn once, without copying or unpacking the frame, and decode
+    the TraceMsg after them.
+
+    Args:
+        data: raw Ethernet frame (PacketIn data)
+
+    Returns:
+        ParsedProbe
 
-def process_packet(ethernet):
-    """Navigates through the Ethernet payload looking for the
-    TraceMsg(). TraceMsg is the payload after all protocols of
-    the TCP/IP stack.
+    Raises:
+        ValueError: if the frame is truncated or does not carry a
+            valid probe header
+    """
+    view = memoryview(data)
+    probe = ParsedProbe()
+
+    _check_len(view, constants.ETHERNET_LEN, "Ethernet")
+    probe.dl_dst = view[0:6].hex(":")
+    probe.dl_src = view[6:12].hex(":")
+    ether_type = int.from_bytes(view[12:14], "big")
+    offset = constants.ETHERNET_LEN
+
+    while ether_type in (constants.VLAN, constants.VLAN_QINQ):
+        _check_len(view, offset + constants.VLAN_LEN, "VLAN")
+        tci = int.from_bytes(view[offset:offset + 2], "big")
+        probe.vlans.append((ether_type, tci & 0x0FFF, tci >> 13))
+        ether_type = int.from_bytes(view[offset + 2:offset + 4], "big")
+        offset += constants.VLAN_LEN
+    probe.dl_type = ether_type
+
+    if ether_type == constants.IPV4:
+        _check_len(view, offset + constants.IPV4_MIN_LEN, "IPv4")
+        probe.nw_tos = view[offset + 1] >> 2
+        probe.nw_proto = view[offset + 9]
+        probe.nw_src = socket.inet_ntoa(view[offset + 12:offset + 16])
+        probe.nw_dst = socket.inet_ntoa(view[offset + 16:offset + 20])
+        offset += (view[offset] & 0x0F) * 4
+    elif ether_type == constants.IPV6:
+        _check_len(view, offset + constants.IPV6_LEN, "IPv6")
+        probe.nw_tos = (view[offset] & 0x0F) << 2 | view[offset + 1] >> 6
+        probe.nw_proto = view[offset + 6]
+        probe.nw_src = socket.inet_ntop(socket.AF_INET6,
+                                        view[offset + 8:offset + 24])
+        probe.nw_dst = socket.inet_ntop(socket.AF_INET6,
+                                        view[offset + 24:offset + 40])
+        offset += constants.IPV6_LEN
+
+    if probe.nw_proto in (constants.TCP, constants.UDP):
+        _check_len(view, offset + 4, "TCP/UDP")
+        probe.tp_src = int.from_bytes(view[offset:offset + 2], "big")
+        probe.tp_dst = int.from_bytes(view[offset + 2:offset + 4], "big")
+    if probe.nw_proto == constants.TCP:
+        _check_len(view, offset + 13, "TCP")
+        offset += (view[offset + 12] >> 4) * 4
+    elif probe.nw_proto == constants.UDP:
+        offset += constants.UDP_LEN
+
+    probe.msg = TraceMsg.unpack(view, offset)
+    probe.msg_offset = offset
+    return probe
+
+
+def parse_probe_msg(data):
+    """ Decode only the TraceMsg of a PacketIn. The Ethernet, VLAN,
+    IPv4/IPv6 and TCP/UDP headers are skipped using their lengths,
+    none of their fields is decoded. Used to drop probes before
+    parse_probe.
 
     Args:
-        ethernet: ethernet frame
+        data: raw Ethernet frame (PacketIn data)
 
     Returns:
-        TraceMsg in the binary format
+        TraceMsg
+
+    Raises:
+        ValueError: if the frame is truncated or does not carry a
+            valid probe header
     """
-    offset = 0
+    view = memoryview(data)
 
-    trace_msg = ethernet.data.value
+    _check_len(view, constants.ETHERNET_LEN, "Ethernet")
+    ether_type = int.from_bytes(view[12:14], "big")
+    offset = constants.ETHERNET_LEN
 
-    if ethernet.ether_type == constants.IPV4:
-        ip_pkt = IPv4()
-        ip_pkt.unpack(ethernet.data.value, offset)
-        offset += ip_pkt.length
-        trace_msg = ip_pkt.data
+    while ether_type in (constants.VLAN, constants.VLAN_QINQ):
+        _check_len(view, offset + constants.VLAN_LEN, "VLAN")
+        ether_type = int.from_bytes(view[offset + 2:offset + 4], "big")
+        offset += constants.VLAN_LEN
 
-        if ip_pkt.protocol == constants.TCP:
-            transport = TCP()
-            transport.unpack(ip_pkt.data)
-            trace_msg = transport.data
+    nw_proto = None
+    if ether_type == constants.IPV4:
+        _check_len(view, offset + constants.IPV4_MIN_LEN, "IPv4")
+        nw_proto = view[offset + 9]
+        offset += (view[offset] & 0x0F) * 4
+    elif ether_type == constants.IPV6:
+        _check_len(view, offset + constants.IPV6_LEN, "IPv6")
+        nw_proto = view[offset + 6]
+        offset += constants.IPV6_LEN
 
-        elif ip_pkt.protocol == constants.UDP:
-            transport = UDP()
-            transport.unpack(ip_pkt.data)
-            trace_msg = transport.data
+    if nw_proto == constants.TCP:
+        _check_len(view, offset + 13, "TCP")
+        offset += (view[offset + 12] >> 4) * 4
+    elif nw_proto == constants.UDP:
+        offset += constants.UDP_LEN
 
-    return trace_msg
+    return TraceMsg.unpack(view, offset)
 
 
 def _create_ethernet_frame(trace_entries, color):
@@ -141,9 +410,9 @@ def _create_ethernet_frame(trace_entries, color):
     ethernet.source = color['color_value']
     ethernet.destination = trace_entries.dl_dst
 
-    if trace_entries.dl_vlan:
-        vlan = VLAN(vid=trace_entries.dl_vlan,
-                    pcp=trace_entries.dl_vlan_pcp)
+    for tpid, vid, pcp in trace_entries.vlans:
+        vlan = VLAN(vid=vid, pcp=pcp)
+        vlan.tpid = tpid
         ethernet.vlans.append(vlan)
     return ethernet
 
@@ -164,6 +433,22 @@ def _create_ip_packet(trace_entries) -> IPv4:
     return ip_pkt
 
 
+def _create_ipv6_packet(trace_entries) -> IPv6:
+    """ Create an IPv6 packet using TraceEntries. Without nw_proto,
+    the probe header follows the IPv6 header (No Next Header).
+
+    Args:
+        trace_entries: TraceEntries provided by user or collected from PacketIn
+    Returns:
+        ipv6 packet
+    """
+    return IPv6(tclass=trace_entries.nw_tos << 2,
+                next_header=(trace_entries.nw_proto or
+                             constants.IPV6_NO_NEXT_HEADER),
+                source=trace_entries.nw_src,
+                destination=trace_entries.nw_dst)
+
+
 def _create_tcp_packet(trace_entries) -> TCP:
     """ Create a TCP packet using TraceEntries (FUTURE)
 
@@ -191,7 +476,7 @@ def _create_udp_packet(trace_entries) -> UDP:
     udp_pkt.dst_port = trace_entries.tp_dst
     return udp_pkt
 
-def _get_node_color_from_dpid(dpid):
+async def _get_node_color_from_dpid(dpid):
     """ Get node color from Coloring Napp
 
     Args:
@@ -200,23 +485,7 @@ def _get_node_color_from_dpid(dpid):
         switch and color
         0 for not Found
     """
-    for switch in Switches().get_switches():
-        if dpid == switch.dpid:
-            return switch, Colors().get_switch_color(switch.dpid)
-    return 0, 0
-
-
-def _get_vlan_from_pkt(data):
-    """ Get VLAN ID from frame. Used for VLAN Translation
-
-    Args:
-        data: Ethernet Frame
-    Returns:
-        VLAN VID
-    """
-    ethernet = Ethernet()
-    ethernet.unpack(data)
-    vlans = ethernet.vlans
-    if vlans:
-        return vlans[0].vid
-    return None
+    switch = Switches().get_switch(dpid)
+    if not switch:
+        return 0, 0
+    return switch, await Colors().aget_switch_color(switch.dpid)
@@ -1,12 +1,15 @@
 """
     Tracer main class
 """
-import time
-import queue
+import asyncio
 import copy
+import time
+from datetime import timedelta
+from random import randrange
 from kytos.core import log
 from napps.amlight.sdntrace.tracing.trace_pkt import generate_trace_pkt
 from napps.amlight.sdntrace.tracing.trace_pkt import prepare_next_packet
+from napps.amlight.sdntrace.tracing.trace_pkt import parse_probe
 from napps.amlight.sdntrace.tracing.rest import FormatRest
 from napps.amlight.sdntrace.backends.of_parser import send_packet_out
 from napps.amlight.sdntrace.shared.switches import Switches
@@ -22,21 +25,22 @@ class TracePath(object):
     There are a few possibilities of result (except for errors):
     - Timeouts ({'trace': 'completed'}) - even positive results end w/
         timeouts.
-    - Loops ({'trace': 'loop'}) - every time an entry is seen twice
-        in the trace_result queue, we stop
+    - Loops ({'trace': 'loop'}) - every time a (dpid, in_port, headers)
+        state is seen twice, we stop
 
     Some things to take into consideration:
     - we can have parallel traces
     - we can have flow rewrite along the path (vlan translation, f.i)
     """
 
-    def __init__(self, trace_manager, r_id, initial_entries):
+    def __init__(self, trace_manager, r_id, initial_entries, queued_at=None):
         """
         Args:
             trace_manager: main TraceManager class - needed for
             Kytos.controller
             r_id: request ID
             initial_entries: user entries for trace
+            queued_at: datetime the trace was requested
         """
         self.switches = Switches()
         self.trace_mgr = trace_manager
@@ -45,10 +49,21 @@ class TracePath(object):
 
         self.trace_task = None
         self.step = 0
+        # Random number carried by every probe of this trace
+        self.nonce = randrange(2**32)
         self.trace_result = []
+        # (dpid, port, header fingerprint) -> index in trace_result
+        self.visited = dict()
+        # Steps of the loop found by check_loop, as {'dpid', 'port'}
+        self.loop_cycle = []
         self.trace_ended = False
         self.init_switch = self.get_init_switch()
         self.rest = FormatRest()
+        # Time waited in the request queue before the trace started
+        self.queue_time = timedelta(0)
+        if queued_at is not None:
+            self.queue_time = max(self.rest.start_time - queued_at,
+                                  timedelta(0))
 
     def get_init_switch(self):
         """Get the Switch class of the switch requested by user
@@ -58,7 +73,7 @@ class TracePath(object):
         """
         return Switches().get_switch(self.init_entries.dpid)
 
-    def tracepath(self):
+    async def tracepath(self):
         """
             Do the trace path
             The logic is very simple:
@@ -73,7 +88,7 @@ class TracePath(object):
         """
         log.warning("Starting Trace Path ID: %s" % self.id)
         entries = copy.deepcopy(self.init_entries)
-        color = Colors().get_switch_color(self.init_switch.dpid)
+        color = await Colors().aget_switch_color(self.init_switch.dpid)
         switch = self.init_switch
         # Add initial trace step
         self.rest.add_trace_step(self.trace_result, trace_type='starting',
@@ -81,26 +96,55 @@ class TracePath(object):
                                  port=entries.in_port)
         # A loop waiting for 'trace_ended'.
         # It changes to True when reaches timeout
-        self.tracepath_loop(entries, color, switch)
+        await self.tracepath_loop(entries, color, switch)
         # Add final result to trace_results_queue
+        self.trace_mgr.add_result(self.id, self.get_result())
+
+    def get_result(self):
+        """ Result of the trace with the steps traced so far
+
+        Returns:
+            dict with the trace result
+        """
         t_result = {"request_id": self.id,
                     "result": self.trace_result,
                     "start_time": str(self.rest.start_time),
                     "total_time": self.rest.get_time(),
+                    "queue_time": str(self.queue_time),
                     "request": self.init_entries.init_entries}
-        self.trace_mgr.add_result(self.id, t_result)
-        self.clear_trace_pkt_in()
+        storms = self.trace_mgr.get_probe_storms(self.id)
+        if storms:
+            t_result["probe_storms"] = storms
+        return t_result
+
+    def get_error_result(self, msg):
+        """ Result of a trace that failed: the steps traced so far
+        followed by a last step with reason 'error'.
 
-    def tracepath_loop(self, entries, color, switch):
+        Args:
+            msg: why the trace failed
+
+        Returns:
+            dict with the trace result
+        """
+        self.rest.add_trace_step(self.trace_result, trace_type='last',
+                                 reason='error', msg=msg)
+        return self.get_result()
+
+    async def tracepath_loop(self, entries, color, switch):
         """ This method sends the packet_out per hop, create the result
         to be posted via REST.
         """
         # A loop waiting for 'trace_ended'.
         # It changes to True when reaches timeout
         while not self.trace_ended:
-            in_port, probe_pkt = generate_trace_pkt(entries, color, self.id, self.step)
-            result, packet_in = self.send_trace_probe(switch, in_port,
-                                                      probe_pkt)
+            in_port, probe_pkt = generate_trace_pkt(entries, color, self.id,
+                                                    self.step, self.nonce)
+            if not self.visited:
+                # Starting state: headers of the first probe at in_port
+                self.check_loop(parse_probe(probe_pkt))
+            result, probe = await self.send_trace_probe(switch, in_port,
+                                                        probe_pkt)
             self.step += 1
             if result == 'pre-ended':
                 # Trace got canceled. Kytos may have shut down.
@@ -115,19 +159,26 @@ class TracePath(object):
                                          trace_type='trace',
                                          dpid=result['dpid'],
                                          port=result['port'])
-                if self.check_loop():
+                if self.check_loop(probe):
                     self.rest.add_trace_step(self.trace_result,
                                              trace_type='last',
-                                             reason='loop')
+                                             reason='loop',
+                                             cycle=self.loop_cycle)
                     self.trace_ended = True
                     break
                 # If we got here, that means we need to keep going.
-                entries, color, switch = prepare_next_packet(entries, result,
-                                                             packet_in)
+                entries, color, switch = await prepare_next_packet(
+                    entries, result, probe
+                )
 
-    def send_trace_probe(self, switch, in_port, probe_pkt):
-        """ This method sends the PacketOut and checks if the
-        PacketIn was received in 3 seconds.
+    async def send_trace_probe(self, switch, in_port, probe_pkt):
+        """ This method sends the PacketOut and waits for the PacketIn
+        of the current step. The wait ends as soon as the PacketIn
+        arrives or after init_entries.timeout, with three tries.
+        PacketOuts are paced per switch and the first try holds one of
+        the in-flight slots of the switch while it waits. Retries do
+        not: a probe unanswered once is most likely at the last hop of
+        its trace, which never answers.
 
         Args:
             switch: target switch to start with
@@ -136,69 +187,98 @@ class TracePath(object):
 
         Returns:
             Timeout
-            {switch & port}
+            {switch & port} and the ParsedProbe of the PacketIn
         """
+        # step_timeout is the shortest time to wait for each PacketIn
         step_timeout = self.init_entries.step_timeout
         if step_timeout <= 0:
             step_timeout = 0.5
-        timeout_control = 0  # Controls the timeout of 1 second and two tries
-        while not self.trace_ended:
-            log.info(f'Trace {self.id}: Sending POut to switch:'
-                        f' {switch.dpid} and in_port {in_port}.'
-                        f' Timeout: {self.init_entries.timeout}')
-            send_packet_out(self.trace_mgr.controller,
-                            switch, in_port, probe_pkt)
-
-            remaining_time = self.init_entries.timeout
-            pkt_in_msg = None
-            while True:
-                time.sleep(step_timeout)
-                remaining_time -= step_timeout
-                pkt_in_msg = self.get_packet_in()
-                if remaining_time <= 0 or pkt_in_msg is not None:
-                    break
+        timeout = max(self.init_entries.timeout, step_timeout)
+        timeout_control = 0  # Controls the timeout and three tries
+        waiter = self.trace_mgr.register_probe_waiter(self.id, self.step)
+        pacer = self.trace_mgr.probe_pacer
+        try:
+            while not self.trace_ended:
+                try:
+                    if timeout_control == 0:
+                        async with pacer.in_flight(switch.dpid):
+                            pkt_in_msg = await self.send_and_wait(
+                                switch, in_port, probe_pkt, waiter, timeout
+                            )
+                    else:
+                        pkt_in_msg = await self.send_and_wait(
+                            switch, in_port, probe_pkt, waiter, timeout
+                        )
+                except asyncio.TimeoutError:
+                    pkt_in_msg = None
+                    timeout_control += 1
+                    if timeout_control >= 3:
+                        return 'timeout', False
 
-            if pkt_in_msg:
-                result = {"dpid": pkt_in_msg["dpid"],
-                          "port": pkt_in_msg["in_port"]}
-                return result, pkt_in_msg["event"]
+                if pkt_in_msg:
+                    result = {"dpid": pkt_in_msg["dpid"],
+                              "port": pkt_in_msg["in_port"]}
+                    return result, pkt_in_msg["probe"]
+            return 'pre-ended', False
+        finally:
+            self.trace_mgr.unregister_probe_waiter(self.id, self.step)
 
-            timeout_control += 1
-            if timeout_control >= 3:
-                return 'timeout', False
-        return 'pre-ended', False
+    async def send_and_wait(self, switch, in_port, probe_pkt, waiter,
+                            timeout):
+        """ Send the probe once, paced, and wait for its PacketIn.
 
-    def get_packet_in(self):
-        """Wait for a PacketIn and verify if it is from the correct step."""
-        while not self.trace_ended:
-            if self.id not in self.trace_mgr._trace_pkt_in:
-                return None
-            try:
-                pkt_in_msg = self.trace_mgr._trace_pkt_in[self.id].sync_q.get(block=False)
-            except queue.Empty:
-                return None
-            msg = pkt_in_msg["msg"]
-            if msg.step == self.step:
-                return pkt_in_msg
-
-    def clear_trace_pkt_in(self):
-        """ Once the probe PacketIn was processed, delete it from queue."""
-        if self.id in self.trace_mgr._trace_pkt_in:
-            self.trace_mgr._trace_pkt_in[self.id].close()
-            del self.trace_mgr._trace_pkt_in[self.id]
-
-    def check_loop(self):
-        """ Check if there are equal entries
+        Args:
+            switch: target switch
+            in_port: target port
+            probe_pkt: ethernet frame to send (PacketOut.data)
+            waiter: asyncio.Future of the PacketIn of the step
+            timeout: seconds to wait for the PacketIn
+
+        Returns:
+            pkt_in dict, or None if the trace ended while waiting
+
+        Raises:
+            asyncio.TimeoutError: if the PacketIn did not arrive
+        """
+        pacer = self.trace_mgr.probe_pacer
+        await pacer.pace(switch.dpid)
+        log.info(f'Trace {self.id}: Sending POut to switch:'
+                 f' {switch.dpid} and in_port {in_port}.'
+                 f' Timeout: {self.init_entries.timeout}')
+        send_packet_out(self.trace_mgr.controller,
+                        switch, in_port, probe_pkt)
+        sent_at = time.monotonic()
+
+        pkt_in_msg = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        if pkt_in_msg:
+            self.trace_mgr.record_probe_rtt(time.monotonic() - sent_at)
+        return pkt_in_msg
+
+    def check_loop(self, probe=None):
+        """ Check if the state of the last trace step, its dpid and port
+        plus the headers of its probe, was already visited. Each check
+        takes O(1) and registers the state. Visiting a port again with
+        other headers, f.i. after a VLAN translation, is not a loop.
+
+        Args:
+            probe: ParsedProbe of the PacketIn of the last step
 
         Return:
-            True if loop
+            True if loop, the steps of the cycle are in loop_cycle
             0 if not
         """
-        last = self.trace_result[-1]
-        for result in self.trace_result[:-1]:
-            if result['dpid'] == last['dpid']:
-                if result['port'] == last['port']:
-                    log.warning('Trace %s: Loop Detected on %s port %s!!' %
-                                (self.id, last['dpid'], last['port']))
-                    return True
-        return 0
+        if not self.trace_result:
+            return 0
+        last_index = len(self.trace_result) - 1
+        last = self.trace_result[last_index]
+        fingerprint = probe.fingerprint() if probe is not None else None
+        state = (last['dpid'], last['port'], fingerprint)
+        first_index = self.visited.setdefault(state, last_index)
+        if first_index == last_index:
+            return 0
+
+        self.loop_cycle = [{'dpid': step['dpid'], 'port': step['port']}
+                           for step in self.trace_result[first_index:last_index]]
+        log.warning('Trace %s: Loop Detected on %s port %s!! Cycle length: %s' %
+                    (self.id, last['dpid'], last['port'], len(self.loop_cycle)))
+        return True